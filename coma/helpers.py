@@ -1,28 +1,84 @@
+import os
 import os.path as op
+import errno
 import gzip
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
 import nibabel as nb
 import numpy as np
 from nipype.utils.filemanip import split_filename
 
 
-def nifti_to_analyze(nii):
-    nifti = nb.load(nii)
-    if nii[-3:] == '.gz':
-        nif = gzip.open(nii, 'rb')
+def scale_to_dtype(data, dtype):
+    '''
+    Returns the raw values nibabel would store for data saved as dtype,
+    i.e. after its slope/intercept scaling, without writing a file.
+    '''
+    from io import BytesIO
+    from nibabel.arraywriters import make_array_writer
+    data = np.asarray(data)
+    if data.dtype == np.dtype(dtype):
+        return data
+    writer = make_array_writer(data, dtype, True, True)
+    buf = BytesIO()
+    writer.to_fileobj(buf)
+    return np.frombuffer(buf.getvalue(), dtype).reshape(data.shape, order='F')
+
+
+def array_to_analyze(data, affine, out_file, header=None):
+    '''
+    Writes an in-memory array as an Analyze .img/.hdr pair in its own dtype
+    '''
+    if header is None:
+        header = nb.analyze.AnalyzeHeader()
     else:
-        nif = open(nii, 'rb')
-    hdr = nb.nifti1.Nifti1Header.from_fileobj(nif)
+        header = header.copy()
+    header.set_data_dtype(data.dtype)
+    img = nb.AnalyzeImage(dataobj=data, affine=affine, header=header)
+    _, name, _ = split_filename(out_file)
+    img_file = op.abspath(name + '.img')
+    nb.analyze.save(img, img_file)
+    return img_file, op.abspath(name + '.hdr')
+
 
+def nifti_to_analyze(nii, dt=None, out_name=None):
+    '''
+    Converts a NIfTI image to an Analyze pair in the current directory.
+    The stored (unscaled) values are copied as they are, or, if dt is
+    given, converted the way switch_datatype would have saved them.
+    '''
+    nifti = nb.load(nii)
+    hdr = nifti.get_header()
+    if dt is None:
+        arrb = nifti.dataobj.get_unscaled()
+    else:
+        arrb = scale_to_dtype(nifti.get_data(), dt)
     arr_hdr = nb.analyze.AnalyzeHeader.from_header(hdr)
-    arrb = hdr.raw_data_from_fileobj(nif)
-    img = nb.AnalyzeImage(
-        dataobj=arrb, affine=nifti.get_affine(), header=arr_hdr)
-    _, name, _ = split_filename(nii)
-    nb.analyze.save(img, op.abspath(name + '.img'))
-    return op.abspath(name + '.img'), op.abspath(name + '.hdr')
+    if out_name is None:
+        _, out_name, _ = split_filename(nii)
+    return array_to_analyze(arrb, nifti.get_affine(), out_name, arr_hdr)
 
 
-def analyze_to_nifti(img, ext='.nii.gz', affine=None):
+def save_nifti(image, out_file, compresslevel=None):
+    '''
+    Saves a NIfTI image, with the given gzip level for .nii.gz files
+    '''
+    if compresslevel is None or not out_file.endswith('.gz'):
+        nb.save(image, out_file)
+        return out_file
+    file_map = image.make_file_map()
+    fileobj = gzip.GzipFile(out_file, 'wb', compresslevel=compresslevel)
+    try:
+        file_map['image'].fileobj = fileobj
+        image.to_file_map(file_map)
+    finally:
+        fileobj.close()
+    return out_file
+
+
+def analyze_to_nifti(img, ext='.nii.gz', affine=None, compresslevel=None):
     image = nb.load(img)
     _, name, _ = split_filename(img)
     if affine is None:
@@ -34,8 +90,7 @@ def analyze_to_nifti(img, ext='.nii.gz', affine=None):
         nii = nb.Nifti1Image(dataobj=image.get_data(),
                              header=image.get_header(), affine=affine)
 
-    nb.save(nii, op.abspath(name + ext))
-    return op.abspath(name + ext)
+    return save_nifti(nii, op.abspath(name + ext), compresslevel)
 
 
 def switch_datatype(in_file, dt=np.uint8):
@@ -53,6 +108,123 @@ def switch_datatype(in_file, dt=np.uint8):
     return fixed_image
 
 
+def _temporary_name(path):
+    '''
+    Returns a hidden name, unique to this call, in the directory of path
+    and ending like it, so a file can be written there and then renamed
+    over path in one step
+    '''
+    directory, name = op.split(path)
+    return op.join(directory, '.tmp_%s_%s' % (uuid.uuid4().hex, name))
+
+
+def _make_dirs(path):
+    # Several processes may create the same staging directory at once
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _same_file(src, dst):
+    return op.exists(dst) and op.samefile(src, dst)
+
+
+def link_or_copy(src, dst, use_symlinks=False):
+    '''
+    Makes src available as dst without duplicating the data. A hard link
+    is used by default (or a symbolic link if requested) and the file is
+    only copied if linking fails, e.g. when crossing filesystems.
+
+    The link is made under a temporary name and renamed over dst, so
+    several processes can stage the same file into a shared directory at
+    once and none of them ever sees a missing or partial dst.
+    '''
+    if _same_file(src, dst):
+        return dst
+    tmp_file = _temporary_name(dst)
+    try:
+        if use_symlinks:
+            os.symlink(op.abspath(src), tmp_file)
+        else:
+            try:
+                os.link(src, tmp_file)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                shutil.copyfile(src, tmp_file)
+        os.rename(tmp_file, dst)
+    except OSError as e:
+        if not (e.errno == errno.EEXIST and _same_file(src, dst)):
+            raise
+    finally:
+        # rename() leaves both names in place when they are already links
+        # to the same file, e.g. when another process staged it meanwhile
+        if op.lexists(tmp_file):
+            os.remove(tmp_file)
+    return dst
+
+
+def stage_image(in_file, out_dir, use_symlinks=False):
+    '''
+    Links an image (and its .hdr/.img partner for Analyze files) into
+    out_dir. Returns the staged path.
+    '''
+    _make_dirs(out_dir)
+    path, name, ext = split_filename(in_file)
+    staged = op.join(out_dir, name) + ext
+    link_or_copy(in_file, staged, use_symlinks)
+    if ext == '.img':
+        link_or_copy(op.join(path, name) + '.hdr',
+                     op.join(out_dir, name) + '.hdr', use_symlinks)
+    elif ext == '.hdr':
+        link_or_copy(op.join(path, name) + '.img',
+                     op.join(out_dir, name) + '.img', use_symlinks)
+    return staged
+
+
+def subject_staging_dir(staging_dir, subject_id):
+    import os.path as op
+    return op.join(op.abspath(staging_dir), subject_id)
+
+
+def split_4d_cached(in_file4d, out_dir):
+    '''
+    Splits a 4D image into 3D volumes in out_dir. Volumes already split
+    from the same (unchanged) image are reused, so several interfaces can
+    share the split data of one subject. Each volume is written under a
+    temporary name and renamed into place, so a volume that exists is
+    complete even while another process is still splitting the image.
+    '''
+    _make_dirs(out_dir)
+    _, name, ext = split_filename(in_file4d)
+    if ext == '.nii.gz':
+        ext = '.nii'
+    image = nb.load(in_file4d)
+    n_volumes = image.shape[3]
+    out_files = [op.join(out_dir, '%s_%04d%s' % (name, idx, ext))
+                 for idx in range(n_volumes)]
+    source_mtime = os.stat(in_file4d).st_mtime
+    if all(op.exists(f) and os.stat(f).st_mtime >= source_mtime for f in out_files):
+        return out_files
+    partner = {'.img': '.hdr', '.hdr': '.img'}.get(ext)
+    for idx, out_file in enumerate(out_files):
+        volume = np.asarray(image.dataobj[..., idx])
+        tmp_file = _temporary_name(out_file)
+        try:
+            nb.save(image.__class__(volume, image.get_affine(), image.get_header()), tmp_file)
+            # The file that is checked for above is renamed last
+            if partner is not None:
+                os.rename(tmp_file[:-len(ext)] + partner, out_file[:-len(ext)] + partner)
+            os.rename(tmp_file, out_file)
+        finally:
+            for leftover in (tmp_file, tmp_file[:-len(ext)] + (partner or ext)):
+                if op.lexists(leftover):
+                    os.remove(leftover)
+    return out_files
+
+
 def get_names(lookup_table):
     LUT_dict = {}
     with open(lookup_table) as LUT:
@@ -64,27 +236,21 @@ def get_names(lookup_table):
 
 
 def prepare_for_uint8(in_array, ignore=[0]):
+    '''
+    Renumbers the labels in in_array (except those in ignore) to
+    51, 52, ... in ascending order with a single lookup-table pass.
+    Returns the new array and a dict mapping new to original labels.
+    '''
     import numpy as np
-    assert(in_array.all > 0)
-    assert(in_array.any > 255)
-    uniquevals = np.unique(in_array)
-    uniquevals = uniquevals.tolist()
-    uniquevals.sort()
-
-    for ig in ignore:
-        if ig in uniquevals:
-            uniquevals.remove(ig)
-    assert(len(uniquevals) < 204)
+    uniquevals, inverse = np.unique(in_array, return_inverse=True)
+    remapped = ~np.in1d(uniquevals, ignore)
+    n_labels = int(remapped.sum())
+    assert(n_labels < 204)
     # We start at 51 because PVElab doesn't work otherwise. No idea why
-    # We first remap to negative values so we don't accidentally
-    # overwrite previously changed values
-    out_data = in_array.copy()
-    remap_dict = {}
-    for idx, v in enumerate(xrange(51, len(uniquevals) + 51)):
-        old = uniquevals[idx]
-        remap_dict[v] = old
-        out_data[np.where(in_array == old)] = -v
-    out_data = np.abs(out_data)
+    lut = uniquevals.copy()
+    lut[remapped] = np.arange(51, n_labels + 51)
+    out_data = lut[inverse].reshape(in_array.shape)
+    remap_dict = dict(zip(range(51, n_labels + 51), uniquevals[remapped].tolist()))
     return out_data, remap_dict
 
 
@@ -379,8 +545,38 @@ def select_ribbon(list_of_files):
     return list_of_files[idx]
 
 
+# Freesurfer aseg labels: left and right cerebral WM, WM hypointensities,
+# cerebellar WM and the corpus callosum posterior to anterior
+WM_LABELS = [2, 41, 81, 82, 7, 46, 251, 252, 253, 254, 255]
+# Left and right thalami
+THALAMUS_LABELS = [49, 10]
+# Lateral, inferior lateral, 3rd, 4th and 5th ventricles, choroid plexus and CSF
+CSF_LABELS = [4, 43, 5, 44, 31, 63, 14, 15, 72, 24]
+
+
+def label_mask(in_data, label_values):
+    '''
+    Boolean mask of the voxels whose label is one of label_values
+    '''
+    import numpy as np
+    in_data = np.asarray(in_data)
+    return np.in1d(in_data.ravel(), label_values).reshape(in_data.shape)
+
+
+def wm_label_mask(in_data, include_thalamus=False):
+    labels = list(WM_LABELS)
+    if include_thalamus:
+        labels.extend(THALAMUS_LABELS)
+    return label_mask(in_data, labels)
+
+
+def csf_label_mask(in_data):
+    return label_mask(in_data, CSF_LABELS)
+
+
 def wm_labels_only(in_file, out_filename=None, include_thalamus=False):
     from nipype.utils.filemanip import split_filename
+    from coma.helpers import wm_label_mask
     import nibabel as nb
     import numpy as np
     import os.path as op
@@ -388,30 +584,7 @@ def wm_labels_only(in_file, out_filename=None, include_thalamus=False):
     in_header = in_image.get_header()
     in_data = in_image.get_data()
 
-    # Left and right cerebral WM
-    out_data = np.zeros(np.shape(in_data))
-    out_data[np.where(in_data == 2)] = 1
-    out_data[np.where(in_data == 41)] = 1
-
-    # Left and right WM hypointensities
-    out_data[np.where(in_data == 81)] = 1
-    out_data[np.where(in_data == 82)] = 1
-
-    # Left and right cerebellar WM
-    out_data[np.where(in_data == 7)] = 1
-    out_data[np.where(in_data == 46)] = 1
-
-    # Corpus callosum posterior to anterior
-    out_data[np.where(in_data == 251)] = 1
-    out_data[np.where(in_data == 252)] = 1
-    out_data[np.where(in_data == 253)] = 1
-    out_data[np.where(in_data == 254)] = 1
-    out_data[np.where(in_data == 255)] = 1
-
-    if include_thalamus:
-        # Left and right thalami
-        out_data[np.where(in_data == 49)] = 1
-        out_data[np.where(in_data == 10)] = 1
+    out_data = wm_label_mask(in_data, include_thalamus).astype(np.float64)
 
     if out_filename is None:
         _, name, _ = split_filename(in_file)
@@ -429,6 +602,7 @@ def wm_labels_only(in_file, out_filename=None, include_thalamus=False):
 
 def csf_labels_only(in_file, out_filename=None):
     from nipype.utils.filemanip import split_filename
+    from coma.helpers import csf_label_mask
     import nibabel as nb
     import numpy as np
     import os.path as op
@@ -436,29 +610,7 @@ def csf_labels_only(in_file, out_filename=None):
     in_header = in_image.get_header()
     in_data = in_image.get_data()
 
-    out_data = np.zeros(np.shape(in_data))
-
-    # Left and right lateral ventricles
-    out_data[np.where(in_data == 4)] = 1
-    out_data[np.where(in_data == 43)] = 1
-
-    # Left and right inferior lateral ventricles
-    out_data[np.where(in_data == 5)] = 1
-    out_data[np.where(in_data == 44)] = 1
-
-    # Left and right choroid plexus
-    out_data[np.where(in_data == 31)] = 1
-    out_data[np.where(in_data == 63)] = 1
-
-    # 3rd and 4th ventricles
-    out_data[np.where(in_data == 14)] = 1
-    out_data[np.where(in_data == 15)] = 1
-
-    # 5th ventricle
-    out_data[np.where(in_data == 72)] = 1
-
-    # CSF
-    out_data[np.where(in_data == 24)] = 1
+    out_data = csf_label_mask(in_data).astype(np.float64)
 
     if out_filename is None:
         _, name, _ = split_filename(in_file)
@@ -587,4 +739,399 @@ def combine_rois(rois_to_combine, prefix=None, binarize=True):
         out_file = op.abspath("%s_MergedRegions_%s.nii.gz" % (prefix, "_".join(ids)))
     nb.save(new_image, out_file)
     print("Written to %s" % out_file)
-    return out_file
\ No newline at end of file
+    return out_file
+
+def iter_slabs(shape, slices_per_slab=8):
+    """
+    Yields slice objects that split a volume of the given shape into
+    slabs along the third (slice) axis, so that large 4D images can be
+    read and processed a few slices at a time through the image proxy.
+    """
+    n_slices = shape[2]
+    for start in range(0, n_slices, slices_per_slab):
+        yield slice(start, min(start + slices_per_slab, n_slices))
+
+
+def read_slab(images, slab):
+    """
+    Reads a slab of slices from a 4D image, or from a list of 3D images
+    (one per time point), as an (x, y, slices, time) float array. Open
+    gzipped images through uncompressed_images before reading them slab
+    by slab.
+    """
+    if len(images) == 1 and len(images[0].shape) == 4:
+        return np.asarray(images[0].dataobj[:, :, slab], dtype=np.float64)
+    return np.concatenate([np.asarray(image.dataobj[:, :, slab], dtype=np.float64)[..., np.newaxis]
+                           for image in images], axis=3)
+
+
+def _stream_header(shape, affine, header=None, dtype=np.float32):
+    if header is None:
+        out_header = nb.Nifti1Header()
+    else:
+        out_header = nb.Nifti1Header.from_header(header)
+    out_header.set_data_shape(shape)
+    out_header.set_data_dtype(dtype)
+    out_header.set_qform(affine, 1)
+    out_header.set_sform(affine, 1)
+    out_header.set_slope_inter(1, 0)
+    # Let write_to place the data right after the header and any extensions
+    out_header['vox_offset'] = 0
+    return out_header
+
+
+def _write_stream_header(fobj, out_header):
+    out_header.write_to(fobj)
+    offset = int(out_header['vox_offset'])
+    fobj.write(b'\x00' * (offset - fobj.tell()))
+    return offset
+
+
+def _open_for_writing(out_file, compresslevel=None):
+    if out_file.endswith('.gz') and compresslevel is not None:
+        return gzip.GzipFile(out_file, 'wb', compresslevel=compresslevel)
+    return nb.openers.Opener(out_file, 'wb')
+
+
+def nifti_memmap(out_file, shape, affine, header=None, dtype=np.float32):
+    """
+    Creates an uncompressed NIfTI file of the given shape and returns a
+    writable memory map of its data, so that large outputs can be
+    written slab by slab without holding them in memory.
+    """
+    out_header = _stream_header(shape, affine, header, dtype)
+    n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(out_file, 'wb') as fobj:
+        offset = _write_stream_header(fobj, out_header)
+        fobj.seek(offset + n_bytes - 1)
+        fobj.write(b'\x00')
+    return np.memmap(out_file, dtype=out_header.get_data_dtype(), mode='r+',
+                     offset=offset, shape=tuple(shape), order='F')
+
+
+def _decompress(in_file, out_file):
+    with gzip.open(in_file, 'rb') as src:
+        with open(out_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    return out_file
+
+
+def open_memmap(in_file, out_dir=None):
+    """
+    Returns a NIfTI image and a read-only memory map of its stored (not
+    yet scaled) data. A gzipped image is first decompressed, as a stream,
+    to an uncompressed copy in out_dir (default: the working directory).
+    """
+    _, name, ext = split_filename(in_file)
+    if ext.endswith('.gz'):
+        if out_dir is None:
+            out_dir = os.getcwd()
+        uncompressed = op.join(out_dir, name + ext[:-3])
+        if not (op.exists(uncompressed) and
+                os.stat(uncompressed).st_mtime >= os.stat(in_file).st_mtime):
+            _decompress(in_file, uncompressed)
+        in_file = uncompressed
+    image = nb.load(in_file)
+    data = np.memmap(in_file, dtype=image.get_data_dtype(), mode='r',
+                     offset=image.dataobj.offset, shape=image.shape, order='F')
+    return image, data
+
+
+@contextmanager
+def uncompressed_images(images, out_dir=None):
+    """
+    Replaces gzipped NIfTI images by uncompressed copies for the duration
+    of a with block. nibabel reads part of a .nii.gz by decompressing the
+    file from its start, so reading one slab at a time would decompress the
+    whole file again for every slab; the copies are decompressed once, as
+    a stream, into a temporary directory in out_dir (default: the working
+    directory) that is removed on exit.
+
+    Example
+    -------
+
+    >>> with uncompressed_images([nb.load('fmri.nii.gz')]) as images:   # doctest: +SKIP
+    ...     for slab in iter_slabs(images[0].shape):
+    ...         data = read_slab(images, slab)
+    """
+    tmp_dir = None
+    out_images = []
+    try:
+        for image in images:
+            in_file = image.get_filename()
+            if in_file is not None and in_file.endswith('.nii.gz'):
+                if tmp_dir is None:
+                    tmp_dir = tempfile.mkdtemp(prefix='uncompressed_',
+                                               dir=out_dir or os.getcwd())
+                _, name, _ = split_filename(in_file)
+                out_file = op.join(tmp_dir, '%d_%s.nii' % (len(out_images), name))
+                image = nb.load(_decompress(in_file, out_file), mmap=False)
+            out_images.append(image)
+        yield out_images
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def iter_image_chunks(image, slices_per_slab=8, scaled=True):
+    """
+    Yields the (scaled) data of a 3D or 4D image a slab of slices at a
+    time, volume after volume, i.e. in the order the voxels are stored.
+    Images on disk are read from one open stream, front to back, so a
+    gzipped file is decompressed only once. With scaled=False the stored
+    values are yielded as they are, without the slope and intercept.
+    """
+    shape = image.shape
+    if len(shape) not in (3, 4):
+        raise ValueError('Only 3D and 4D images can be read in chunks')
+    n_volumes = 1 if len(shape) == 3 else shape[3]
+    proxy = image.dataobj
+    if not (isinstance(proxy, nb.arrayproxy.ArrayProxy) and
+            getattr(proxy, 'order', 'F') == 'F'):
+        if not scaled and hasattr(proxy, 'get_unscaled'):
+            proxy = proxy.get_unscaled()
+        for volume in range(n_volumes):
+            for slab in iter_slabs(shape, slices_per_slab):
+                if len(shape) == 3:
+                    yield np.asarray(proxy[:, :, slab])
+                else:
+                    yield np.asarray(proxy[:, :, slab, volume])
+        return
+
+    dtype = np.dtype(proxy.dtype)
+    slope, inter = 1, 0
+    if scaled:
+        slope = getattr(proxy, 'slope', 1)
+        inter = getattr(proxy, 'inter', 0)
+    source = nb.openers.Opener(proxy.file_like, 'rb')
+    try:
+        source.seek(int(proxy.offset))
+        for volume in range(n_volumes):
+            for slab in iter_slabs(shape, slices_per_slab):
+                slab_shape = (shape[0], shape[1], slab.stop - slab.start)
+                n_bytes = int(np.prod(slab_shape)) * dtype.itemsize
+                block = source.read(n_bytes)
+                if len(block) != n_bytes:
+                    raise IOError('%s is truncated' % image.get_filename())
+                chunk = np.frombuffer(block, dtype=dtype).reshape(slab_shape, order='F')
+                if (slope, inter) != (1, 0):
+                    chunk = nb.volumeutils.apply_read_scaling(chunk, slope, inter)
+                yield chunk
+    finally:
+        source.close()
+
+
+def stream_nifti(out_file, shape, affine, chunks, header=None, dtype=np.float32,
+                 compresslevel=None):
+    """
+    Writes a NIfTI file (gzipped if out_file ends in .gz) from an iterable
+    of arrays that follow each other in the file's voxel order, so the
+    full volume is never held in memory.
+    """
+    out_header = _stream_header(shape, affine, header, dtype)
+    out_dtype = out_header.get_data_dtype()
+    fobj = _open_for_writing(out_file, compresslevel)
+    try:
+        _write_stream_header(fobj, out_header)
+        for chunk in chunks:
+            fobj.write(np.asarray(chunk, dtype=out_dtype).tobytes(order='F'))
+    finally:
+        fobj.close()
+    return out_file
+
+
+def _as_frames(volume):
+    """
+    Returns a 3D/4D volume (an image, a path to one, or an array) with its
+    number of frames
+    """
+    if not hasattr(volume, 'shape'):
+        volume = nb.load(volume)
+    if not hasattr(volume, 'dataobj'):
+        volume = np.asarray(volume)
+    shape = volume.shape
+    if len(shape) not in (3, 4):
+        raise ValueError('Only 3D and 4D volumes can be assembled, got shape %s' % (shape,))
+    n_frames = 1 if len(shape) == 3 else shape[3]
+    return volume, n_frames
+
+
+def _frame_chunks(volume, slices_per_slab, scaled=True):
+    if hasattr(volume, 'dataobj'):
+        return iter_image_chunks(volume, slices_per_slab, scaled)
+    if volume.ndim == 3:
+        return [volume]
+    return (volume[..., frame] for frame in range(volume.shape[3]))
+
+
+def write_4d_nifti(out_file, volumes, affine=None, header=None, dtype=None,
+                   compresslevel=None, n_volumes=None, slices_per_slab=8, scaling=None):
+    """
+    Assembles a 4D NIfTI image (gzipped if out_file ends in .gz) from 3D
+    (or 4D) volumes given as images, image paths (.nii, .nii.gz, .img) or
+    arrays, appending them to the data block one slab at a time, so the
+    memory use does not grow with the number of volumes.
+
+    The geometry, header and data type default to those of the first
+    volume (float32 if its stored values are scaled). For an iterator of
+    volumes, give n_volumes (total number of frames) so the header can be
+    written first; otherwise the data are assembled uncompressed and the
+    header is completed at the end.
+
+    Arrays that hold stored (unscaled) values, e.g. taken from a memory
+    map, can be written as they are with their (slope, inter) scaling;
+    images are then copied as stored values too.
+    """
+    if isinstance(volumes, (list, tuple)):
+        volumes = [_as_frames(volume) for volume in volumes]
+        if n_volumes is None:
+            n_volumes = sum(n_frames for _, n_frames in volumes)
+        volumes = iter(volumes)
+    else:
+        volumes = (_as_frames(volume) for volume in volumes)
+
+    try:
+        first, n_frames = next(volumes)
+    except StopIteration:
+        raise ValueError('No volumes to assemble into %s' % out_file)
+    spatial_shape = first.shape[0:3]
+    if hasattr(first, 'dataobj'):
+        if affine is None:
+            affine = first.get_affine()
+        if header is None:
+            header = first.get_header()
+        if dtype is None:
+            dtype = first.get_data_dtype()
+            # Scaled values are written as they are read, so with no scaling
+            if (getattr(first.dataobj, 'slope', 1), getattr(first.dataobj, 'inter', 0)) != (1, 0):
+                dtype = np.float32
+    elif dtype is None:
+        dtype = first.dtype
+    if affine is None:
+        raise ValueError('An affine is required to assemble arrays')
+
+    compressed = out_file.endswith('.gz')
+    known_length = n_volumes is not None
+    data_file = out_file
+    if not known_length:
+        n_volumes = 1
+        if compressed:
+            data_file = out_file[:-3]
+
+    out_header = _stream_header(spatial_shape + (n_volumes,), affine, header, dtype)
+    if scaling is not None:
+        out_header.set_slope_inter(*scaling)
+    out_dtype = out_header.get_data_dtype()
+    fobj = _open_for_writing(data_file, compresslevel if known_length else None)
+    n_written = 0
+    try:
+        _write_stream_header(fobj, out_header)
+        volume = first
+        while True:
+            if volume.shape[0:3] != spatial_shape:
+                raise ValueError('Volume %d has shape %s, expected %s' %
+                                 (n_written, volume.shape[0:3], spatial_shape))
+            for chunk in _frame_chunks(volume, slices_per_slab, scaling is None):
+                fobj.write(np.asarray(chunk, dtype=out_dtype).tobytes(order='F'))
+            n_written += n_frames
+            try:
+                volume, n_frames = next(volumes)
+            except StopIteration:
+                break
+    finally:
+        fobj.close()
+
+    if known_length:
+        if n_written != n_volumes:
+            raise ValueError('%d volumes were written to %s but %d were expected' %
+                             (n_written, out_file, n_volumes))
+        return out_file
+
+    # Complete the header now that the number of volumes is known
+    out_header.set_data_shape(spatial_shape + (n_written,))
+    with open(data_file, 'r+b') as fobj:
+        out_header.write_to(fobj)
+    if compressed:
+        with open(data_file, 'rb') as src:
+            dst = _open_for_writing(out_file, compresslevel)
+            try:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            finally:
+                dst.close()
+        os.remove(data_file)
+    return out_file
+
+
+def rescale_image(in_file, out_file, slope, inter=0, header_only=False,
+                  slices_per_slab=8, compresslevel=None):
+    """
+    Writes slope * data + inter for an image without loading it whole.
+    By default the result is computed a slab at a time and streamed out
+    as float32. With header_only, a NIfTI input keeps its stored values
+    and only scl_slope/scl_inter are updated, which costs a byte copy.
+    """
+    image = nb.load(in_file)
+    if header_only and isinstance(image, nb.Nifti1Image):
+        header = image.get_header()
+        # nibabel moves the stored scaling from the header to the proxy
+        old_slope = float(image.dataobj.slope)
+        old_inter = float(image.dataobj.inter)
+        out_header = header.copy()
+        out_header['vox_offset'] = 0
+        out_header.set_slope_inter(old_slope * slope, old_inter * slope + inter)
+        n_bytes = int(np.prod(image.shape)) * header.get_data_dtype().itemsize
+        source = nb.openers.Opener(in_file, 'rb')
+        fobj = _open_for_writing(out_file, compresslevel)
+        try:
+            _write_stream_header(fobj, out_header)
+            source.seek(int(image.dataobj.offset))
+            while n_bytes > 0:
+                block = source.read(min(n_bytes, 2 ** 24))
+                if not block:
+                    raise IOError('%s is truncated' % in_file)
+                fobj.write(block)
+                n_bytes -= len(block)
+        finally:
+            source.close()
+            fobj.close()
+        return out_file
+
+    chunks = (chunk * slope + inter for chunk in iter_image_chunks(image, slices_per_slab))
+    return stream_nifti(out_file, image.shape, image.get_affine(), chunks,
+                        image.get_header(), np.float32, compresslevel)
+
+
+def rescale_images(in_files, out_files, slope, inter=0, header_only=False,
+                   slices_per_slab=8, compresslevel=None):
+    """
+    Applies the same rescaling to several images, one after the other
+    """
+    if len(in_files) != len(out_files):
+        raise ValueError('One output file is required per input image')
+    return [rescale_image(in_file, out_file, slope, inter, header_only,
+                          slices_per_slab, compresslevel)
+            for in_file, out_file in zip(in_files, out_files)]
+
+
+def read_frame_timing(timing_file):
+    '''
+    Reads the frame start times and durations, returned in minutes.
+    Accepts a BIDS PET sidecar (.json with FrameTimesStart and
+    FrameDuration) or a text file with one row per frame holding the
+    start time and duration, both in seconds.
+    '''
+    import json
+    if timing_file.endswith('.json'):
+        f = open(timing_file, 'r')
+        sidecar = json.load(f)
+        f.close()
+        start = np.asarray(sidecar['FrameTimesStart'], dtype=np.float64)
+        duration = np.asarray(sidecar['FrameDuration'], dtype=np.float64)
+    else:
+        timing = np.atleast_2d(np.loadtxt(timing_file))
+        if timing.shape[1] != 2:
+            raise ValueError('The frame timing file must have two columns (start, duration)')
+        start, duration = timing[:, 0], timing[:, 1]
+    if len(start) != len(duration):
+        raise ValueError('There must be one duration per frame start time')
+    return start / 60.0, duration / 60.0
@@ -1,8 +1,12 @@
 from .base import CreateDenoisedImage, MatchingClassification, ComputeFingerprint
 from .dti import nonlinfit_fn
-from .functional import RegionalValues, SimpleTimeCourseCorrelationGraph
+from .functional import RegionalValues, SimpleTimeCourseCorrelationGraph, NuisanceRegression, TemporalFilter
 from .gift import SingleSubjectICA
 from .graphs import CreateConnectivityThreshold, ConnectivityGraph
 from .glucose import CMR_glucose, calculate_SUV
-from .pve import PartialVolumeCorrection
-from .mrtrix3 import inclusion_filtering_mrtrix3
\ No newline at end of file
+from .pve import PartialVolumeCorrection, NativePartialVolumeCorrection, VoxelwisePartialVolumeCorrection, BatchPartialVolumeCorrection
+from .mrtrix3 import inclusion_filtering_mrtrix3
+from .dualregression import DualRegression
+from .kinetics import PatlakAnalysis
+from .cohort import CohortStore
+from .streamlines import load_tractogram, StreamlineWriter, convert_tractogram, merge_tractograms, extract_pair_tracks, load_streamline_index, filter_tracks, tract_profile
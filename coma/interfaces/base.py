@@ -3,11 +3,10 @@ from nipype.interfaces.base import (
     BaseInterface, BaseInterfaceInputSpec, traits, InputMultiPath,
     File, TraitedSpec, Directory, isdefined)
 from nipype.utils.filemanip import split_filename
+from coma.helpers import stage_image, split_4d_cached
 import os
 import os.path as op
 from string import Template
-import nibabel as nb
-import shutil
 import logging
 
 logging.basicConfig()
@@ -19,6 +18,28 @@ except KeyError:
     iflogger.error('COMA_REST_LIB_ROOT environment variable not set.')
 
 
+def get_staging_dir(inputs):
+    if isdefined(inputs.staging_dir):
+        return op.abspath(inputs.staging_dir)
+    return os.getcwd()
+
+
+def stage_components(inputs, data_dir):
+    """
+    Stages the ICA component maps into data_dir by linking them. A 4D
+    component image is first split into the shared 'split' directory
+    of the staging area, so it is only split once per subject.
+    """
+    if isdefined(inputs.in_file4d):
+        iflogger.info('Single four-dimensional image selected. Splitting and staging in {d}'.format(d=data_dir))
+        split_dir = op.join(get_staging_dir(inputs), 'split')
+        in_files = split_4d_cached(inputs.in_file4d, split_dir)
+    else:
+        iflogger.info('Staging {n} input images in {d}'.format(n=len(inputs.in_files), d=data_dir))
+        in_files = inputs.in_files
+    return [stage_image(in_file, data_dir, inputs.use_symlinks) for in_file in in_files]
+
+
 class CreateDenoisedImageInputSpec(BaseInterfaceInputSpec):
     in_files = InputMultiPath(File(exists=True), mandatory=True,
                               desc='The input ICA maps as separate images')
@@ -36,6 +57,10 @@ class CreateDenoisedImageInputSpec(BaseInterfaceInputSpec):
                               desc='Reconstructed "denoised" image from neuronal components')
     out_non_neuronal_image = File('non_neuronal.nii', usedefault=True,
                                   desc='Reconstructed "noise" image from non-neuronal components')
+    staging_dir = Directory(desc='Directory in which the inputs are staged for MATLAB. Defaults to the '
+                            'working directory; set it to share staged (and split) data between interfaces.')
+    use_symlinks = traits.Bool(False, usedefault=True,
+                               desc='Stage inputs with symbolic links instead of hard links')
 
 
 class CreateDenoisedImageOutputSpec(TraitedSpec):
@@ -56,59 +81,17 @@ class CreateDenoisedImage(BaseInterface):
     output_spec = CreateDenoisedImageOutputSpec
 
     def _run_interface(self, runtime):
-        data_dir = op.abspath('./denoise/components')
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-
-        in_files = self.inputs.in_files
-        if len(self.inputs.in_files) > 1:
-            print 'Multiple ({n}) input images detected! Copying to {d}...'.format(n=len(self.inputs.in_files), d=data_dir)
-            for in_file in self.inputs.in_files:
-                path, name, ext = split_filename(in_file)
-                shutil.copyfile(in_file, op.join(data_dir, name) + ext)
-                if ext == '.img':
-                    shutil.copyfile(op.join(path, name) + '.hdr',
-                                    op.join(data_dir, name) + '.hdr')
-                elif ext == '.hdr':
-                    shutil.copyfile(op.join(path, name) + '.img',
-                                    op.join(data_dir, name) + '.img')
-            print 'Copied!'
-            in_files = self.inputs.in_files
-
-        elif isdefined(self.inputs.in_file4d):
-            print 'Single four-dimensional image selected. Splitting and copying to {d}'.format(d=data_dir)
-            in_files = nb.four_to_three(self.inputs.in_file4d)
-            for in_file in in_files:
-                path, name, ext = split_filename(in_file)
-                shutil.copyfile(in_file, op.join(data_dir, name) + ext)
-            print 'Copied!'
-
-        else:
-            print 'Single functional image provided. Ending...'
-            in_files = self.inputs.in_files
+        staging_dir = get_staging_dir(self.inputs)
+        use_symlinks = self.inputs.use_symlinks
+        data_dir = op.join(staging_dir, 'denoise', 'components')
 
+        in_files = stage_components(self.inputs, data_dir)
         nComponents = len(in_files)
-        path, name, ext = split_filename(self.inputs.time_course_image)
-        shutil.copyfile(self.inputs.time_course_image,
-                        op.join(data_dir, name) + ext)
-
-        if ext == '.img':
-            shutil.copyfile(op.join(path, name) + '.hdr',
-                            op.join(data_dir, name) + '.hdr')
-        elif ext == '.hdr':
-            shutil.copyfile(op.join(path, name) + '.img',
-                            op.join(data_dir, name) + '.img')
-
-        data_dir = op.abspath('./denoise')
-        path, name, ext = split_filename(self.inputs.ica_mask_image)
-        shutil.copyfile(self.inputs.ica_mask_image,
-                        op.join(data_dir, name) + ext)
-        if ext == '.img':
-            shutil.copyfile(op.join(path, name) + '.hdr',
-                            op.join(data_dir, name) + '.hdr')
-        elif ext == '.hdr':
-            shutil.copyfile(op.join(path, name) + '.img',
-                            op.join(data_dir, name) + '.img')
+        stage_image(self.inputs.time_course_image, data_dir, use_symlinks)
+
+        data_dir = op.join(staging_dir, 'denoise')
+        staged_mask = stage_image(self.inputs.ica_mask_image, data_dir, use_symlinks)
+        path, name, ext = split_filename(staged_mask)
         mask_file = op.join(data_dir, name)
         repetition_time = self.inputs.repetition_time
         neuronal_image = op.abspath(self.inputs.out_neuronal_image)
@@ -159,6 +142,10 @@ class MatchingClassificationInputSpec(BaseInterfaceInputSpec):
         mandatory=True, desc='The repetition time (TR) in seconds')
     out_stats_file = File('stats.mat', usedefault=True,
                           desc='Reconstructed "denoised" image from neuronal components')
+    staging_dir = Directory(desc='Directory in which the inputs are staged for MATLAB. Defaults to the '
+                            'working directory; set it to share staged (and split) data between interfaces.')
+    use_symlinks = traits.Bool(False, usedefault=True,
+                               desc='Stage inputs with symbolic links instead of hard links')
 
 
 class MatchingClassificationOutputSpec(TraitedSpec):
@@ -175,64 +162,20 @@ class MatchingClassification(BaseInterface):
     output_spec = MatchingClassificationOutputSpec
 
     def _run_interface(self, runtime):
-        path, name, ext = split_filename(self.inputs.time_course_image)
-        data_dir = op.abspath('./matching')
-        copy_to = op.join(data_dir, 'components')
-        if not op.exists(copy_to):
-            os.makedirs(copy_to)
-        copy_to = op.join(copy_to, name)
-        shutil.copyfile(self.inputs.time_course_image, copy_to + ext)
-        if ext == '.img':
-            shutil.copyfile(op.join(path, name) + '.hdr', copy_to + '.hdr')
-        elif ext == '.hdr':
-            shutil.copyfile(op.join(path, name) + '.img', copy_to + '.img')
-
-        data_dir = op.abspath('./matching/components')
-        in_files = self.inputs.in_files
-        if len(self.inputs.in_files) > 1:
-            print 'Multiple ({n}) input images detected! Copying to {d}...'.format(n=len(self.inputs.in_files), d=data_dir)
-            for in_file in self.inputs.in_files:
-                path, name, ext = split_filename(in_file)
-                shutil.copyfile(in_file, op.join(data_dir, name) + ext)
-                if ext == '.img':
-                    shutil.copyfile(op.join(path, name) + '.hdr',
-                                    op.join(data_dir, name) + '.hdr')
-                elif ext == '.hdr':
-                    shutil.copyfile(op.join(path, name) + '.img',
-                                    op.join(data_dir, name) + '.img')
-            print 'Copied!'
-
-        elif isdefined(self.inputs.in_file4d):
-            print 'Single four-dimensional image selected. Splitting and copying to {d}'.format(d=data_dir)
-            in_files = nb.four_to_three(self.inputs.in_file4d)
-            for in_file in in_files:
-                path, name, ext = split_filename(in_file)
-                shutil.copyfile(in_file, op.join(data_dir, name) + ext)
-            print 'Copied!'
+        staging_dir = get_staging_dir(self.inputs)
+        use_symlinks = self.inputs.use_symlinks
+        data_dir = op.join(staging_dir, 'matching')
+        components_dir = op.join(data_dir, 'components')
+        stage_image(self.inputs.time_course_image, components_dir, use_symlinks)
 
-        else:
+        if not isdefined(self.inputs.in_file4d) and len(self.inputs.in_files) == 1:
             raise Exception('Single functional image provided. Ending...')
-            in_files = self.inputs.in_files
+        in_files = stage_components(self.inputs, components_dir)
 
         nComponents = len(in_files)
         repetition_time = self.inputs.repetition_time
         coma_rest_lib_path = op.abspath(self.inputs.coma_rest_lib_path)
-
-        data_dir = op.abspath('./matching')
-        if not op.exists(data_dir):
-            os.makedirs(data_dir)
-
-        path, name, ext = split_filename(self.inputs.ica_mask_image)
-        copy_to = op.join(data_dir, 'components')
-        if not op.exists(copy_to):
-            os.makedirs(copy_to)
-        copy_to = op.join(copy_to, name)
-        shutil.copyfile(self.inputs.ica_mask_image, copy_to + ext)
-        
-        if ext == '.img':
-            shutil.copyfile(op.join(path, name) + '.hdr', copy_to + '.hdr')
-        elif ext == '.hdr':
-            shutil.copyfile(op.join(path, name) + '.img', copy_to + '.img')
+        stage_image(self.inputs.ica_mask_image, components_dir, use_symlinks)
 
         mask_file = op.abspath(self.inputs.ica_mask_image)
         out_stats_file = op.abspath(self.inputs.out_stats_file)
@@ -297,6 +240,10 @@ class ComputeFingerprintInputSpec(BaseInterfaceInputSpec):
         desc='Index of the independent component to use from the t-value threshold file.')
     out_stats_file = File(
         desc='Reconstructed "denoised" image from neuronal components')
+    staging_dir = Directory(desc='Directory in which the inputs are staged for MATLAB. Defaults to the '
+                            'working directory; set it to share staged (and split) data between interfaces.')
+    use_symlinks = traits.Bool(False, usedefault=True,
+                               desc='Stage inputs with symbolic links instead of hard links')
 
 
 class ComputeFingerprintOutputSpec(TraitedSpec):
@@ -313,28 +260,15 @@ class ComputeFingerprint(BaseInterface):
     output_spec = ComputeFingerprintOutputSpec
 
     def _run_interface(self, runtime):
-        path, name, ext = split_filename(self.inputs.time_course_image)
-        data_dir = op.abspath('./matching')
-        copy_to = op.join(data_dir, 'components')
-        if not op.exists(copy_to):
-            os.makedirs(copy_to)
-        copy_to = op.join(copy_to, name)
-        shutil.copyfile(self.inputs.time_course_image, copy_to + ext)
-        if ext == '.img':
-            shutil.copyfile(op.join(path, name) + '.hdr', copy_to + '.hdr')
-        elif ext == '.hdr':
-            shutil.copyfile(op.join(path, name) + '.img', copy_to + '.img')
-        time_course_file = copy_to + '.img'
-
-        path, name, ext = split_filename(self.inputs.ica_mask_image)
-        shutil.copyfile(self.inputs.ica_mask_image,
-                        op.join(data_dir, name) + ext)
-        if ext == '.img':
-            shutil.copyfile(op.join(path, name) + '.hdr',
-                            op.join(data_dir, name) + '.hdr')
-        elif ext == '.hdr':
-            shutil.copyfile(op.join(path, name) + '.img',
-                            op.join(data_dir, name) + '.img')
+        staging_dir = get_staging_dir(self.inputs)
+        use_symlinks = self.inputs.use_symlinks
+        data_dir = op.join(staging_dir, 'matching')
+        staged = stage_image(self.inputs.time_course_image,
+                             op.join(data_dir, 'components'), use_symlinks)
+        path, name, ext = split_filename(staged)
+        time_course_file = op.join(path, name) + '.img'
+        stage_image(self.inputs.ica_mask_image, data_dir, use_symlinks)
+
         mask_file = op.abspath(self.inputs.ica_mask_image)
         repetition_time = self.inputs.repetition_time
         component_file = op.abspath(self.inputs.in_file)
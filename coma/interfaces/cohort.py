@@ -0,0 +1,307 @@
+import os
+import os.path as op
+import errno
+import numpy as np
+
+# One row per subject x region x method. Text columns are stored as int32
+# codes into a vocabulary file, numeric columns as raw little-endian arrays.
+KEY_COLUMNS = ["subject_id", "region", "method"]
+VALUE_COLUMNS = ["volume_cc", "orig", "AIF", "SUV"]
+CODE_DTYPE = np.dtype('<i4')
+VALUE_DTYPE = np.dtype('<f8')
+
+NON_METHOD_KEYS = ["subject_id", "scale_SUV_by_glycemia", "isotope", "half_life",
+    "weight", "assumed_AIF", "delay", "dose_mCi", "dose_MBq", "glycemia", "height",
+    "body_surface_area", "gm_file", "wm_slice_used", "pet_file", "region_names",
+    "VOLUMES_(cc)"]
+
+
+def _as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return u'%s' % value
+
+
+class CohortStore(object):
+    '''
+    Columnar table of regional PET values for a cohort, filled one subject
+    at a time.
+
+    Each column lives in its own file inside the store directory so that
+    subjects can be appended as they finish, and a filter on region or method
+    only has to read the int32 code columns before gathering the values.
+    Appends are serialised with a lock file, so several pipeline nodes may
+    write to the same store. A subject is stored once: appending it again
+    raises an error unless replace is set, in which case its previous rows
+    are dropped.
+
+    Example
+    -------
+
+    >>> from coma.interfaces.cohort import CohortStore
+    >>> store = CohortStore('cohort_pet')   # doctest: +SKIP
+    >>> store.append_results('Bend1_PET_AIF_SUV_data.npz')   # doctest: +SKIP
+    >>> store.to_csv('cohort_SUV.csv', method='MGRousset')   # doctest: +SKIP
+    '''
+
+    def __init__(self, path):
+        self.path = op.abspath(path)
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _column_file(self, column):
+        return op.join(self.path, column + '.bin')
+
+    def _vocabulary_file(self, column):
+        return op.join(self.path, column + '.txt')
+
+    def _lock(self):
+        import fcntl
+        lock = open(op.join(self.path, '.lock'), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def vocabulary(self, column):
+        vocab_file = self._vocabulary_file(column)
+        if not op.exists(vocab_file):
+            return []
+        with open(vocab_file, 'rb') as f:
+            return [line.decode('utf-8') for line in f.read().splitlines()]
+
+    def _codes(self, column, values, vocab):
+        lookup = dict((name, idx) for idx, name in enumerate(vocab))
+        new = []
+        codes = np.empty(len(values), dtype=CODE_DTYPE)
+        for i, value in enumerate(values):
+            value = _as_text(value)
+            if value not in lookup:
+                lookup[value] = len(vocab) + len(new)
+                new.append(value)
+            codes[i] = lookup[value]
+        return codes, new
+
+    def __len__(self):
+        # A crash between column writes leaves ragged files; only complete
+        # rows are considered part of the table
+        sizes = []
+        for column in KEY_COLUMNS + VALUE_COLUMNS:
+            column_file = self._column_file(column)
+            dtype = CODE_DTYPE if column in KEY_COLUMNS else VALUE_DTYPE
+            if not op.exists(column_file):
+                return 0
+            sizes.append(op.getsize(column_file) // dtype.itemsize)
+        return min(sizes)
+
+    def _drop_subject(self, subject_id, n_rows, replace):
+        '''
+        Removes the rows of a subject that is already in the store (or raises
+        a ValueError unless replace is set). Must be called with the lock
+        held. Returns the number of rows left.
+        '''
+        vocab = self.vocabulary("subject_id")
+        subject_id = _as_text(subject_id)
+        if n_rows == 0 or subject_id not in vocab:
+            return n_rows
+        codes = np.fromfile(self._column_file("subject_id"), dtype=CODE_DTYPE, count=n_rows)
+        keep = codes != vocab.index(subject_id)
+        if keep.all():
+            return n_rows
+        if not replace:
+            raise ValueError('Subject %s is already in the cohort store %s; use replace=True '
+                             'to overwrite its rows' % (subject_id, self.path))
+        # Every column is rewritten before any is swapped in, so an error
+        # leaves the store as it was
+        columns = KEY_COLUMNS + VALUE_COLUMNS
+        for column in columns:
+            dtype = CODE_DTYPE if column in KEY_COLUMNS else VALUE_DTYPE
+            data = np.fromfile(self._column_file(column), dtype=dtype, count=n_rows)
+            with open(self._column_file(column) + '.tmp', 'wb') as f:
+                f.write(data[keep].tobytes())
+        for column in columns:
+            os.rename(self._column_file(column) + '.tmp', self._column_file(column))
+        return int(keep.sum())
+
+    def append(self, subject_id, regions, methods, replace=False, **values):
+        '''
+        Appends the rows of one subject. Each value column is an array of
+        shape (methods, regions), or (regions,) for per-region columns such as
+        volume_cc. Columns that are not given are stored as NaN.
+
+        A subject that is already in the store raises a ValueError, unless
+        replace is set, in which case its previous rows are dropped first.
+        '''
+        regions = [_as_text(r) for r in regions]
+        methods = [_as_text(m) for m in methods]
+        n_methods, n_regions = len(methods), len(regions)
+        n_rows = n_methods * n_regions
+
+        columns = {}
+        for column in VALUE_COLUMNS:
+            data = values.pop(column, None)
+            if data is None:
+                data = np.nan
+            data = np.asarray(data, dtype=VALUE_DTYPE)
+            if data.ndim == 1:
+                data = data[np.newaxis, :]
+            columns[column] = np.broadcast_to(
+                data, (n_methods, n_regions)).ravel()
+        if values:
+            raise ValueError('Unknown cohort columns: %s' % ', '.join(sorted(values)))
+
+        keys = {"subject_id": [subject_id] * n_rows,
+                "region": regions * n_methods,
+                "method": np.repeat(methods, n_regions).tolist()}
+
+        lock = self._lock()
+        try:
+            n_existing = len(self)
+            for column in KEY_COLUMNS + VALUE_COLUMNS:
+                itemsize = (CODE_DTYPE if column in KEY_COLUMNS else VALUE_DTYPE).itemsize
+                column_file = self._column_file(column)
+                if op.exists(column_file) and op.getsize(column_file) != n_existing * itemsize:
+                    with open(column_file, 'r+b') as f:
+                        f.truncate(n_existing * itemsize)
+            self._drop_subject(subject_id, n_existing, replace)
+
+            for column in KEY_COLUMNS:
+                codes, new = self._codes(column, keys[column], self.vocabulary(column))
+                if new:
+                    with open(self._vocabulary_file(column), 'ab') as f:
+                        f.write(b''.join(n.encode('utf-8') + b'\n' for n in new))
+                with open(self._column_file(column), 'ab') as f:
+                    f.write(codes.tobytes())
+            for column in VALUE_COLUMNS:
+                with open(self._column_file(column), 'ab') as f:
+                    f.write(columns[column].tobytes())
+        finally:
+            lock.close()
+        return n_rows
+
+    def append_results(self, in_file, subject_id=None, replace=False):
+        '''
+        Appends a scaled results file written by scale_PVC_matrix_fn
+        (<subject>_PET_AIF_SUV_data.npz)
+        '''
+        results = np.load(in_file)
+        keys = list(results.keys())
+        if subject_id is None:
+            subject_id = _as_text(results["subject_id"])
+        regions = list(results["region_names"])
+        methods = sorted(k[5:] for k in keys if k.startswith("orig_"))
+        if not methods:
+            raise ValueError('%s does not contain any orig_<method> results' % in_file)
+
+        volumes = None
+        if "VOLUMES_(cc)" in keys:
+            volumes = results["VOLUMES_(cc)"]
+        return self.append(subject_id, regions, methods, replace, volume_cc=volumes,
+            orig=[results["orig_" + m] for m in methods],
+            AIF=[results["AIF_" + m] for m in methods],
+            SUV=[results["SUV_" + m] for m in methods])
+
+    def append_pve_results(self, subject_id, results_file, replace=False):
+        '''
+        Appends the unscaled values of a PVELab r_volume_pve.txt, or of the
+        npz saved from parse_pve_results
+        '''
+        if results_file.endswith('.npz'):
+            results = dict(np.load(results_file))
+        else:
+            from coma.interfaces.pve import parse_pve_results
+            results = parse_pve_results(results_file)
+        regions = list(results["region_names"])
+        methods = sorted(k for k in results.keys() if k not in NON_METHOD_KEYS)
+        return self.append(subject_id, regions, methods, replace,
+            volume_cc=results.get("VOLUMES_(cc)"),
+            orig=[results[m] for m in methods])
+
+    def _mask(self, n_rows, **filters):
+        mask = np.ones(n_rows, dtype=bool)
+        for column in KEY_COLUMNS:
+            wanted = filters.pop(column, None)
+            if wanted is None:
+                continue
+            if np.ndim(wanted) == 0:
+                wanted = [wanted]
+            vocab = self.vocabulary(column)
+            wanted = [vocab.index(_as_text(w)) for w in wanted if _as_text(w) in vocab]
+            codes = np.memmap(self._column_file(column), dtype=CODE_DTYPE,
+                mode='r', shape=(n_rows,))
+            mask &= np.in1d(codes, wanted)
+        if filters:
+            raise ValueError('Cannot filter on: %s' % ', '.join(sorted(filters)))
+        return mask
+
+    def select(self, subject_id=None, region=None, method=None, columns=None):
+        '''
+        Returns a dict of column arrays for the rows matching every filter.
+        Filters are a single name or a list of names. Key columns are decoded
+        back to strings.
+        '''
+        if columns is None:
+            columns = KEY_COLUMNS + VALUE_COLUMNS
+        n_rows = len(self)
+        if n_rows == 0:
+            return dict((c, np.array([], dtype=VALUE_DTYPE if c in VALUE_COLUMNS
+                else object)) for c in columns)
+        rows = np.flatnonzero(self._mask(n_rows, subject_id=subject_id,
+            region=region, method=method))
+
+        out = {}
+        for column in columns:
+            if column in KEY_COLUMNS:
+                codes = np.memmap(self._column_file(column), dtype=CODE_DTYPE,
+                    mode='r', shape=(n_rows,))
+                vocab = np.array(self.vocabulary(column), dtype=object)
+                out[column] = vocab[codes[rows]]
+            elif column in VALUE_COLUMNS:
+                data = np.memmap(self._column_file(column), dtype=VALUE_DTYPE,
+                    mode='r', shape=(n_rows,))
+                out[column] = np.array(data[rows])
+            else:
+                raise ValueError('Unknown cohort column: %s' % column)
+        return out
+
+    def to_csv(self, out_file, **filters):
+        import csv
+        table = self.select(**filters)
+        columns = KEY_COLUMNS + VALUE_COLUMNS
+        with open(out_file, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in zip(*[table[c] for c in columns]):
+                writer.writerow(row[:len(KEY_COLUMNS)] +
+                    tuple('%.10g' % v for v in row[len(KEY_COLUMNS):]))
+        return op.abspath(out_file)
+
+    def to_mat(self, out_file, **filters):
+        '''
+        Saves the selected rows as one MATLAB variable per column. Key columns
+        are saved as cell arrays of strings.
+        '''
+        import scipy.io as sio
+        table = self.select(**filters)
+        out = {}
+        for column, data in table.items():
+            if column in KEY_COLUMNS:
+                cells = np.empty((len(data), 1), dtype=object)
+                cells[:, 0] = [str(d) for d in data]
+                data = cells
+            else:
+                data = data[:, np.newaxis]
+            out[column] = data
+        sio.savemat(out_file, out)
+        return op.abspath(out_file)
+
+
+def append_to_cohort(cohort_dir, in_file, subject_id=None, replace=False):
+    '''
+    Appends the scaled PET results of one subject to a cohort store
+    '''
+    from coma.interfaces.cohort import CohortStore
+    store = CohortStore(cohort_dir)
+    store.append_results(in_file, subject_id, replace)
+    return store.path
@@ -1,28 +1,235 @@
 import random
-
-def nonlinfit_fn(dwi, bvecs, bvals, base_name):
+import os
+import os.path as op
+import multiprocessing
+import numpy as np
+
+
+def _fit_tensor_chunk(args):
+    '''
+    Fits the tensors of one chunk of masked voxels, read from the memory
+    mapped (voxels, volumes) array, and returns their eigenvalues and
+    eigenvectors.
+    '''
+    import dipy.reconst.dti as dti
+    from dipy.core.gradients import GradientTable
+    voxels_file, start, stop, bvals, gradients, fit_method = args
+    voxels = np.load(voxels_file, mmap_mode='r')
+    gtab = GradientTable(gradients)
+    gtab.bvals = bvals
+    tenfit = dti.TensorModel(gtab, fit_method=fit_method).fit(
+        np.asarray(voxels[start:stop], dtype=np.float64))
+    return tenfit.evals.astype(np.float32), tenfit.evecs.astype(np.float32)
+
+
+def fit_tensor_chunked(dwi_img, mask, bvals, gradients, chunk_size=20000,
+                       n_procs=None, fit_method="NLLS", slices_per_slab=8):
+    '''
+    Fits tensors to the masked voxels of a DWI image in chunks of
+    chunk_size voxels spread over a process pool. The masked voxels are
+    copied slab by slab into a memory mapped array shared by the workers,
+    so the full 4D volume is never loaded. Returns the eigenvalue (x, y, z, 3)
+    and eigenvector (x, y, z, 3, 3) maps, zero outside the mask.
+    '''
+    from coma.helpers import iter_slabs, uncompressed_images
+    shape = dwi_img.shape
+    mask = np.asarray(mask, dtype=bool)
+    n_voxels = int(mask.sum())
+
+    voxels_file = op.abspath('tensor_fit_voxels.npy')
+    voxels = np.lib.format.open_memmap(voxels_file, mode='w+', dtype=np.float32,
+                                       shape=(n_voxels, shape[3]))
+    row = 0
+    with uncompressed_images([dwi_img]) as (dwi_frames,):
+        for slab in iter_slabs(shape, slices_per_slab):
+            slab_mask = mask[:, :, slab]
+            n_slab = int(slab_mask.sum())
+            if n_slab:
+                voxels[row:row + n_slab] = np.asarray(dwi_frames.dataobj[:, :, slab])[slab_mask]
+                row += n_slab
+    voxels.flush()
+    del voxels
+
+    jobs = [(voxels_file, start, min(start + chunk_size, n_voxels), bvals,
+             gradients, fit_method) for start in range(0, n_voxels, chunk_size)]
+    if n_procs == 1:
+        fits = [_fit_tensor_chunk(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(n_procs)
+        try:
+            fits = pool.map(_fit_tensor_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    os.remove(voxels_file)
+
+    evals = np.zeros(shape[0:3] + (3,), dtype=np.float32)
+    evecs = np.zeros(shape[0:3] + (3, 3), dtype=np.float32)
+    if fits:
+        evals[mask] = np.concatenate([fit[0] for fit in fits])
+        evecs[mask] = np.concatenate([fit[1] for fit in fits])
+    return evals, evecs
+
+
+def mean_b0(dwi_img, bvals, b0_threshold=50):
+    '''
+    Averages the b=0 volumes of a DWI image, reading one volume at a time
+    '''
+    b0_indices = np.where(bvals <= b0_threshold)[0]
+    if len(b0_indices) == 0:
+        b0_indices = [0]
+    b0 = np.zeros(dwi_img.shape[0:3], dtype=np.float64)
+    for index in b0_indices:
+        b0 += np.asarray(dwi_img.dataobj[..., int(index)])
+    return b0 / len(b0_indices)
+
+
+# Maps derived from the tensor, in the order nonlinfit_fn returns them,
+# with the suffix of their file name
+TENSOR_METRICS = [("FA", "_fa"), ("MD", "_md"), ("evecs", "_evecs"),
+                  ("evals", "_evals"), ("rgb_fa", "_rgb_fa"), ("norm", "_norm"),
+                  ("mode", "_mode")]
+TENSOR_METRIC_NAMES = [name for name, _ in TENSOR_METRICS]
+
+
+def tensor_metric_images(evals, evecs, quadratic_form, affine, metrics=None):
+    '''
+    Computes the requested tensor metrics (default: all of TENSOR_METRICS)
+    from the eigen decomposition and quadratic form of the tensors, and
+    returns them as a dict of NIfTI images. Only what the requested maps
+    need is computed.
+    '''
+    import nibabel as nb
+    import dipy.reconst.dti as dti
+    from dipy.reconst.dti import fractional_anisotropy, color_fa
+    if metrics is None:
+        metrics = TENSOR_METRIC_NAMES
+    unknown = set(metrics) - set(TENSOR_METRIC_NAMES)
+    if unknown:
+        raise ValueError('Unknown tensor metrics: %s' % ', '.join(sorted(unknown)))
+
+    evals = evals.astype(np.float32)
+    FA = None
+    if "FA" in metrics or "rgb_fa" in metrics:
+        FA = fractional_anisotropy(np.abs(evals))
+        FA = np.clip(FA, 0, 1)
+
+    maps = {}
+    if "FA" in metrics:
+        maps["FA"] = FA.astype(np.float32)
+    if "MD" in metrics:
+        maps["MD"] = dti.mean_diffusivity(np.abs(evals)).astype(np.float32)
+    if "evecs" in metrics:
+        maps["evecs"] = evecs.astype(np.float32)
+    if "evals" in metrics:
+        maps["evals"] = evals
+    if "rgb_fa" in metrics:
+        maps["rgb_fa"] = np.array(255 * color_fa(FA, evecs), 'uint8')
+    if "norm" in metrics:
+        maps["norm"] = dti.norm(quadratic_form).astype(np.float32)
+    if "mode" in metrics:
+        maps["mode"] = np.nan_to_num(dti.mode(quadratic_form).astype(np.float32))
+    return dict((name, nb.Nifti1Image(data, affine)) for name, data in maps.items())
+
+
+def save_images_concurrently(images, compresslevel=None, n_threads=None):
+    '''
+    Saves (image, out_file) pairs in a thread pool, since the gzip
+    compression releases the GIL
+    '''
+    from multiprocessing.pool import ThreadPool
+    from coma.helpers import save_nifti
+    if not images:
+        return []
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(lambda job: save_nifti(job[0], job[1], compresslevel), images)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def tensor_derived_metrics(tensor_file, metrics=None, base_name=None, compresslevel=None,
+                           n_threads=None):
+    '''
+    Derives tensor metrics (default: all of TENSOR_METRICS) from a tensor
+    image saved by nonlinfit_fn, without refitting, and returns the output
+    files in the order of metrics. Voxels with an all-zero tensor (outside
+    the fitting mask) are left at zero.
+
+    Example
+    -------
+
+    >>> from coma.interfaces.dti import tensor_derived_metrics
+    >>> rgb_fa, mode = tensor_derived_metrics('Bend1_tensor.nii.gz', ['rgb_fa', 'mode'])   # doctest: +SKIP
+    '''
+    import nibabel as nb
+    import dipy.reconst.dti as dti
+    from nipype.utils.filemanip import split_filename
+    if metrics is None:
+        metrics = TENSOR_METRIC_NAMES
+    if base_name is None:
+        _, base_name, _ = split_filename(tensor_file)
+        if base_name.endswith("_tensor"):
+            base_name = base_name[:-len("_tensor")]
+
+    tensor_img = nb.load(tensor_file)
+    tensor_data = np.asarray(tensor_img.dataobj).astype(np.float64)
+    quadratic_form = dti.from_lower_triangular(tensor_data)
+
+    # Eigenvalues in decreasing order, clipped at zero as dipy does when fitting
+    fitted = np.any(tensor_data != 0, axis=-1)
+    evals = np.zeros(tensor_data.shape[0:3] + (3,))
+    evecs = np.zeros(tensor_data.shape[0:3] + (3, 3))
+    values, vectors = np.linalg.eigh(quadratic_form[fitted])
+    evals[fitted] = values[:, ::-1].clip(min=0)
+    evecs[fitted] = vectors[:, :, ::-1]
+
+    images = tensor_metric_images(evals, evecs, quadratic_form,
+                                  tensor_img.get_affine(), metrics)
+    suffixes = dict(TENSOR_METRICS)
+    out_files = [op.abspath(base_name + suffixes[name] + ".nii.gz") for name in metrics]
+    save_images_concurrently([(images[name], out_file) for name, out_file
+                              in zip(metrics, out_files)], compresslevel, n_threads)
+    return out_files
+
+
+def nonlinfit_fn(dwi, bvecs, bvals, base_name, n_procs=1, chunk_size=None,
+                 outputs=None, compresslevel=None, n_threads=None):
+    '''
+    Fits diffusion tensors with dipy's non-linear least squares and writes
+    the tensor, its scalar maps, the brain mask and the masked b0.
+
+    If chunk_size is given, or n_procs is not 1, the masked voxels are fit
+    chunk_size at a time in a pool of n_procs processes (all cores if None),
+    without loading the whole 4D image. In that mode the brain mask is
+    computed on the mean b0 volume rather than on the full 4D image.
+
+    outputs selects the derived maps to write (default: all of
+    TENSOR_METRICS); the others are returned as None and can be made later
+    from the tensor with tensor_derived_metrics. The tensor, mask and b0
+    are always written. Images are saved concurrently by n_threads threads
+    (all cores if None) with the given gzip compresslevel.
+    '''
     import nibabel as nb
     import numpy as np
     import os.path as op
     import dipy.reconst.dti as dti
     from dipy.core.gradients import GradientTable
+    from dipy.segment.mask import median_otsu
+    from coma.interfaces.dti import (TENSOR_METRICS, TENSOR_METRIC_NAMES,
+        tensor_metric_images, save_images_concurrently)
+
+    if outputs is None:
+        outputs = TENSOR_METRIC_NAMES
+    outputs = [name for name in TENSOR_METRIC_NAMES if name in outputs]
+
+    chunked = chunk_size is not None or n_procs != 1
+    if chunked and chunk_size is None:
+        chunk_size = 20000
 
     dwi_img = nb.load(dwi)
-    dwi_data = dwi_img.get_data()
     dwi_affine = dwi_img.get_affine()
-    
-    from dipy.segment.mask import median_otsu
-    b0_mask, mask = median_otsu(dwi_data, 2, 4)
-    # Mask the data so that tensors are not fit for
-    # unnecessary voxels
-    mask_img = nb.Nifti1Image(mask.astype(np.float32), dwi_affine)
-    b0_imgs = nb.Nifti1Image(b0_mask.astype(np.float32), dwi_affine)
-    b0_img = nb.four_to_three(b0_imgs)[0]
-
-    out_mask_name = op.abspath(base_name + '_binary_mask.nii.gz')
-    out_b0_name = op.abspath(base_name + '_b0_mask.nii.gz')
-    nb.save(mask_img, out_mask_name)
-    nb.save(b0_img, out_b0_name)
 
     # Load the gradient strengths and directions
     bvals = np.loadtxt(bvals)
@@ -33,93 +240,207 @@ def nonlinfit_fn(dwi, bvecs, bvals, base_name):
         gradients = gradients.T
         assert(gradients.shape[1] == 3)
 
-    # Place in Dipy's preferred format
-    gtab = GradientTable(gradients)
-    gtab.bvals = bvals
+    if chunked:
+        from coma.interfaces.dti import mean_b0
+        b0_img_data, mask = median_otsu(mean_b0(dwi_img, bvals), 2, 4)
+        b0_img = nb.Nifti1Image(b0_img_data.astype(np.float32), dwi_affine)
+    else:
+        dwi_data = dwi_img.get_data()
+        b0_mask, mask = median_otsu(dwi_data, 2, 4)
+        b0_imgs = nb.Nifti1Image(b0_mask.astype(np.float32), dwi_affine)
+        b0_img = nb.four_to_three(b0_imgs)[0]
+    # Mask the data so that tensors are not fit for
+    # unnecessary voxels
+    mask_img = nb.Nifti1Image(mask.astype(np.float32), dwi_affine)
 
-    # Fit the tensors to the data
-    tenmodel = dti.TensorModel(gtab, fit_method="NLLS")
-    tenfit = tenmodel.fit(dwi_data, mask)
+    if chunked:
+        from coma.interfaces.dti import fit_tensor_chunked
+        evals, evecs = fit_tensor_chunked(dwi_img, mask, bvals, gradients,
+                                          chunk_size, n_procs)
+        quadratic_form = np.einsum('...ij,...j,...kj->...ik', evecs, evals, evecs)
+        tensor_data = dti.lower_triangular(quadratic_form)
+    else:
+        # Place in Dipy's preferred format
+        gtab = GradientTable(gradients)
+        gtab.bvals = bvals
+
+        # Fit the tensors to the data
+        tenmodel = dti.TensorModel(gtab, fit_method="NLLS")
+        tenfit = tenmodel.fit(dwi_data, mask)
+        tensor_data = tenfit.lower_triangular()
+        quadratic_form = tenfit.quadratic_form
+        evecs = tenfit.evecs
+        evals = tenfit.evals
 
     # Calculate the fit, fa, and md of each voxel's tensor
-    tensor_data = tenfit.lower_triangular()
-    print('Computing anisotropy measures (FA, MD, RGB)')
-    from dipy.reconst.dti import fractional_anisotropy, color_fa
-
-    evals = tenfit.evals.astype(np.float32)
-    FA = fractional_anisotropy(np.abs(evals))
-    FA = np.clip(FA, 0, 1)
-
-    MD = dti.mean_diffusivity(np.abs(evals))
-    norm = dti.norm(tenfit.quadratic_form)
-
-    RGB = color_fa(FA, tenfit.evecs)
-
-    evecs = tenfit.evecs.astype(np.float32)
-    mode = tenfit.mode.astype(np.float32)
-    mode = np.nan_to_num(mode)
-
+    print('Computing anisotropy measures (%s)' % ', '.join(outputs))
+    images = tensor_metric_images(evals, evecs, quadratic_form, dwi_affine, outputs)
 
     # Write tensor as a 4D Nifti image with the original affine
-    tensor_fit_img = nb.Nifti1Image(tensor_data.astype(np.float32), dwi_affine)
-    mode_img = nb.Nifti1Image(mode.astype(np.float32), dwi_affine)
-    norm_img = nb.Nifti1Image(norm.astype(np.float32), dwi_affine)
-    FA_img = nb.Nifti1Image(FA.astype(np.float32), dwi_affine)
-    evecs_img = nb.Nifti1Image(evecs, dwi_affine)
-    evals_img = nb.Nifti1Image(evals, dwi_affine)
-    rgb_img = nb.Nifti1Image(np.array(255 * RGB, 'uint8'), dwi_affine)
-    MD_img = nb.Nifti1Image(MD.astype(np.float32), dwi_affine)
-
     out_tensor_file = op.abspath(base_name + "_tensor.nii.gz")
-    out_mode_file = op.abspath(base_name + "_mode.nii.gz")
-    out_fa_file = op.abspath(base_name + "_fa.nii.gz")
-    out_norm_file = op.abspath(base_name + "_norm.nii.gz")
-    out_evals_file = op.abspath(base_name + "_evals.nii.gz")
-    out_evecs_file = op.abspath(base_name + "_evecs.nii.gz")
-    out_rgb_fa_file = op.abspath(base_name + "_rgb_fa.nii.gz")
-    out_md_file = op.abspath(base_name + "_md.nii.gz")
-
-    nb.save(rgb_img, out_rgb_fa_file)
-    nb.save(norm_img, out_norm_file)
-    nb.save(mode_img, out_mode_file)
-    nb.save(tensor_fit_img, out_tensor_file)
-    nb.save(evecs_img, out_evecs_file)
-    nb.save(evals_img, out_evals_file)
-    nb.save(FA_img, out_fa_file)
-    nb.save(MD_img, out_md_file)
+    out_mask_name = op.abspath(base_name + '_binary_mask.nii.gz')
+    out_b0_name = op.abspath(base_name + '_b0_mask.nii.gz')
+    to_save = [(nb.Nifti1Image(tensor_data.astype(np.float32), dwi_affine), out_tensor_file),
+               (mask_img, out_mask_name), (b0_img, out_b0_name)]
+
+    out_files = {}
+    for name, suffix in TENSOR_METRICS:
+        out_files[name] = None
+        if name in images:
+            out_files[name] = op.abspath(base_name + suffix + ".nii.gz")
+            to_save.append((images[name], out_files[name]))
+    save_images_concurrently(to_save, compresslevel, n_threads)
+
     print('Tensor fit image saved as {i}'.format(i=out_tensor_file))
-    print('FA image saved as {i}'.format(i=out_fa_file))
-    print('MD image saved as {i}'.format(i=out_md_file))
-    return out_tensor_file, out_fa_file, out_md_file, \
-        out_evecs_file, out_evals_file, out_rgb_fa_file, out_norm_file, \
-        out_mode_file, out_mask_name, out_b0_name
+    for name in ["FA", "MD"]:
+        if out_files[name] is not None:
+            print('{n} image saved as {i}'.format(n=name, i=out_files[name]))
+    return out_tensor_file, out_files["FA"], out_files["MD"], \
+        out_files["evecs"], out_files["evals"], out_files["rgb_fa"], out_files["norm"], \
+        out_files["mode"], out_mask_name, out_b0_name
+
+def shell_indices(bvals, shell_tolerance=100):
+    '''
+    Groups b-values into shells by rounding them to shell_tolerance.
+    Returns the shell index of each volume.
+    '''
+    rounded = np.round(np.asarray(bvals, dtype=np.float64) / shell_tolerance)
+    _, shells = np.unique(rounded, return_inverse=True)
+    return shells
+
+
+def dwi_volume_qc(data, bvals, bvecs, vibration_thresh=0.8, dropout_ratio=0.7,
+                  outlier_z=3.5, shell_tolerance=100, b0_threshold=50,
+                  slope=1., inter=0., slices_per_slab=8):
+    '''
+    Computes per-volume quality metrics of a 4D DWI array (e.g. a memory
+    map) in a single pass over slabs of slices:
+
+        worst_slice_ratio: lowest ratio, over the brain slices, of the
+            slice's mean signal to the median of the same slice in the
+            volumes of the same shell, relative to the volume's median
+            ratio (slice-wise signal dropout)
+        shell_z: robust z-score of the volume's mean brain signal against
+            the other volumes of its shell (intensity outliers)
+        bvec_x: |x component| of the gradient direction (vibration artefact)
+
+    and flags the volumes that fail each test. The brain mask is taken
+    from the mean b0 volume.
+    '''
+    from coma.helpers import iter_slabs
+    bvals = np.asarray(bvals, dtype=np.float64)
+    bvecs = np.asarray(bvecs, dtype=np.float64)
+    n_volumes = data.shape[3]
+    shells = shell_indices(bvals, shell_tolerance)
+
+    b0_indices = np.where(bvals <= b0_threshold)[0]
+    if len(b0_indices) == 0:
+        b0_indices = np.array([0])
+    b0 = np.zeros(data.shape[0:3])
+    for index in b0_indices:
+        b0 += data[..., int(index)]
+    b0 /= len(b0_indices)
+    foreground = b0[b0 > 0]
+    mask = b0 > 0.2 * np.percentile(foreground, 98) if foreground.size else b0 > 0
+
+    # Sum of the brain signal of every (slice, volume)
+    slice_sums = np.zeros((data.shape[2], n_volumes))
+    slice_counts = mask.sum(axis=(0, 1)).astype(np.float64)
+    for slab in iter_slabs(data.shape, slices_per_slab):
+        values = np.asarray(data[:, :, slab, :], dtype=np.float64) * slope + inter
+        slab_mask = mask[:, :, slab].astype(np.float64)
+        slice_sums[slab] = np.einsum('xys,xysv->sv', slab_mask, values)
+
+    brain_slices = slice_counts >= 0.1 * slice_counts.max()
+    slice_means = slice_sums[brain_slices] / slice_counts[brain_slices, np.newaxis]
+    volume_means = slice_sums.sum(axis=0) / max(slice_counts.sum(), 1)
+
+    worst_slice_ratio = np.ones(n_volumes)
+    shell_z = np.zeros(n_volumes)
+    for shell in np.unique(shells):
+        members = np.where(shells == shell)[0]
+        if len(members) < 3:
+            continue
+        reference = np.median(slice_means[:, members], axis=1)
+        valid = reference > 0
+        ratios = slice_means[valid][:, members] / reference[valid, np.newaxis]
+        if ratios.size:
+            # Relative to the volume's typical slice, so that a global
+            # intensity change is left to the outlier test
+            ratios /= np.median(ratios, axis=0)
+            worst_slice_ratio[members] = ratios.min(axis=0)
+
+        median = np.median(volume_means[members])
+        mad = 1.4826 * np.median(np.abs(volume_means[members] - median))
+        if mad > 0:
+            shell_z[members] = (volume_means[members] - median) / mad
+
+    bvec_x = np.abs(bvecs[:, 0])
+    vibration = bvec_x >= vibration_thresh
+    dropout = worst_slice_ratio < dropout_ratio
+    outlier = np.abs(shell_z) > outlier_z
+    return dict(bval=bvals, shell=shells, worst_slice_ratio=worst_slice_ratio,
+                shell_z=shell_z, bvec_x=bvec_x, vibration=vibration,
+                dropout=dropout, outlier=outlier, bad=vibration | dropout | outlier)
+
+
+def write_qc_report(qc, out_file):
+    columns = ["bval", "shell", "bvec_x", "worst_slice_ratio", "shell_z",
+               "vibration", "dropout", "outlier", "bad"]
+    with open(out_file, 'w') as f:
+        f.write(",".join(["volume"] + columns) + "\n")
+        for volume in range(len(qc["bad"])):
+            f.write(",".join(["%d" % volume] +
+                             ["%g" % qc[column][volume] for column in columns]) + "\n")
+    return out_file
+
 
-def remove_bad_volumes(dwi, bvec_file, bval_file, thresh=0.8):
+def remove_bad_volumes(dwi, bvec_file, bval_file, thresh=0.8, auto_qc=False,
+                       dropout_ratio=0.7, outlier_z=3.5, keep_uncompressed=False):
+    '''
+    Removes the volumes affected by the vibration artefact, i.e. those with
+    |bvec x| >= thresh. With auto_qc, volumes with slice-wise signal
+    dropout or an outlying mean intensity within their shell are removed
+    too (see dwi_volume_qc), and the metrics are written to
+    <dwi name>_vib_qc.csv.
+
+    The kept volumes are streamed from a memory map of the DWI data to the
+    output, so neither image is held in memory. A gzipped DWI is memory
+    mapped from an uncompressed copy in the working directory; a copy made
+    here is deleted at the end unless keep_uncompressed is set.
+    '''
+    import os
     import numpy as np
-    import nibabel as nb
     import os.path as op
     from nipype.utils.filemanip import split_filename
+    from coma.helpers import open_memmap, write_4d_nifti
+    from coma.interfaces.dti import dwi_volume_qc, write_qc_report
 
-    dwi_4D = nb.load(dwi)
-    dwi_files = nb.four_to_three(dwi_4D)
+    _, name, ext = split_filename(dwi)
+    uncompressed = None
+    if ext.endswith('.gz') and not op.exists(op.abspath(name + ext[:-3])):
+        uncompressed = op.abspath(name + ext[:-3])
+    dwi_4D, dwi_data = open_memmap(dwi)
 
     bvecs = np.transpose(np.loadtxt(bvec_file))
     bvals = np.transpose(np.loadtxt(bval_file))
 
-    bad_indices = np.where(np.abs(bvecs[:,0]) >= thresh)[0]
-    n_removed = len(bad_indices)
-
-    dwi_files = [i for j, i in enumerate(dwi_files) if j not in bad_indices]
-    bvecs = [i for j, i in enumerate(bvecs) if j not in bad_indices]
-    bvals = [i for j, i in enumerate(bvals) if j not in bad_indices]
-
-    corr_dwi = nb.concat_images(dwi_files)
-    corr_bvecs = np.transpose(bvecs)
-    corr_bvals = np.transpose(bvals)
+    slope, inter = dwi_4D.dataobj.slope, dwi_4D.dataobj.inter
+    if auto_qc:
+        qc = dwi_volume_qc(dwi_data, bvals, bvecs, thresh, dropout_ratio, outlier_z,
+                           slope=slope, inter=inter)
+        bad = qc["bad"]
+        report = write_qc_report(qc, op.abspath(name + "_vib_qc.csv"))
+        print("%d volumes failed the dropout check and %d the shell intensity check, see %s" %
+              (qc["dropout"].sum(), qc["outlier"].sum(), report))
+    else:
+        bad = np.abs(bvecs[:,0]) >= thresh
+    keep = np.where(~bad)[0]
+    n_removed = int(bad.sum())
+
+    corr_bvecs = np.transpose(bvecs[keep])
+    corr_bvals = np.transpose(bvals[keep])
 
-    assert(len(dwi_files) == len(bvecs) == len(bvals))
-
-    _, name, _ = split_filename(dwi)
     out_dwi = op.abspath(name + "_vib.nii.gz")
 
     _, bvec_name, _ = split_filename(bvec_file)
@@ -128,7 +449,12 @@ def remove_bad_volumes(dwi, bvec_file, bval_file, thresh=0.8):
     _, bval_name, _ = split_filename(bval_file)
     out_bvals = op.abspath(bval_name + "_vib.bval")
 
-    nb.save(corr_dwi, out_dwi)
+    # The stored values of the kept volumes are copied with their scaling
+    write_4d_nifti(out_dwi, (dwi_data[..., index] for index in keep), dwi_4D.get_affine(),
+                   dwi_4D.get_header(), dwi_data.dtype, n_volumes=len(keep),
+                   scaling=(slope, inter))
+    if uncompressed is not None and not keep_uncompressed:
+        os.remove(uncompressed)
     np.savetxt(out_bvecs, corr_bvecs)
     np.savetxt(out_bvals, corr_bvals)
     print("%d volumes were removed at threshold %f" % (n_removed, thresh))
@@ -204,8 +530,8 @@ def write_trackvis_scene(track_file, n_clusters=1, skip=80, names=None, out_file
     f.write('</Comment>\n')
 
     # Define the scene dimensions
-    import nibabel.trackvis as trk
-    _, hdr = trk.read(track_file)
+    from coma.interfaces.streamlines import read_trk_header
+    hdr = read_trk_header(track_file)
     x, y, z = hdr['dim']
     vx, vy, vz = hdr['voxel_size']
 
@@ -291,12 +617,13 @@ def write_trackvis_scene(track_file, n_clusters=1, skip=80, names=None, out_file
     return out_file
 
 def bundle_tracks(in_file, dist_thr=40., pts = 16, skip=80.):
-    import subprocess
     import os.path as op
-    from nibabel import trackvis as tv
     from dipy.segment.quickbundles import QuickBundles
-    streams, hdr = tv.read(in_file)
-    streamlines = [i[0] for i in streams]
+    from coma.interfaces.streamlines import (load_tractogram, StreamlineWriter,
+        merge_tractograms)
+    tractogram = load_tractogram(in_file)
+    hdr = tractogram.header
+    streamlines = list(tractogram.streamlines(space='native'))
     qb = QuickBundles(streamlines, float(dist_thr), int(pts))
     clusters = qb.clustering
     #scalars = [i[0] for i in streams]
@@ -306,23 +633,17 @@ def bundle_tracks(in_file, dist_thr=40., pts = 16, skip=80.):
     n_clusters = clusters.keys()
     print("%d clusters found" % len(n_clusters))
 
-    new_hdr = tv.empty_header()
-    new_hdr['n_scalars'] = 1
-
     for cluster in clusters:
         cluster_trk = op.abspath(name + str(cluster) + ".trk")
         print("Writing cluster %d to %s" % (cluster, cluster_trk))
         out_files.append(cluster_trk)
         clust_idxs = clusters[cluster]['indices']
         new_streams =  [ streamlines[i] for i in clust_idxs ]
-        for_save = [(sl, None, None) for sl in new_streams]
-        tv.write(cluster_trk, for_save, hdr)
+        with StreamlineWriter(cluster_trk, hdr, space='native') as writer:
+            writer.append_streamlines(new_streams)
     
     out_merged_file = "MergedBundles.trk"
-    command_list = ["track_merge"]
-    command_list.extend(out_files)
-    command_list.append(out_merged_file)
-    subprocess.call(command_list)
+    merge_tractograms(out_files, out_merged_file)
     out_scene_file = write_trackvis_scene(out_merged_file, n_clusters=len(clusters), skip=skip, names=None, out_file = "NewScene.scene")
     print("Merged track file written to %s" % out_merged_file)
     print("Scene file written to %s" % out_scene_file)
@@ -0,0 +1,193 @@
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, traits,
+                                    File, TraitedSpec, InputMultiPath,
+                                    OutputMultiPath, isdefined)
+from nipype.utils.filemanip import split_filename
+import os.path as op
+import multiprocessing
+import numpy as np
+import nibabel as nb
+from nipype import logging
+iflogger = logging.getLogger('interface')
+
+
+def dual_regression(in_file, group_maps_file, mask_file=None,
+                    variance_normalize=True, slices_per_slab=8):
+    """
+    Back-projects a set of group spatial maps onto a single subject's 4D
+    fMRI data.
+
+    Stage 1 regresses the (spatially demeaned) group maps against the data
+    to get one timecourse per component. Stage 2 regresses these
+    timecourses against the (temporally demeaned) data to get subject
+    specific spatial maps. Both least-squares solves are done over all
+    voxels at once, but the data are only ever read a slab of slices at a
+    time: stage 1 accumulates the normal equations across slabs and stage
+    2 applies the pseudo-inverse of the timecourses to each slab.
+
+    Returns the timecourses (time x components) and the subject maps as
+    a 4D array (x, y, z, components).
+    """
+    from coma.helpers import iter_slabs, uncompressed_images
+    group_maps = nb.load(group_maps_file).get_data()
+    if group_maps.ndim == 3:
+        group_maps = group_maps[..., np.newaxis]
+    n_components = group_maps.shape[3]
+
+    image = nb.load(in_file)
+    if image.shape[:3] != group_maps.shape[:3]:
+        raise ValueError('The group maps ({g}) and the functional image ({f}) '
+                         'must be in the same space'.format(g=group_maps.shape[:3], f=image.shape[:3]))
+    n_timepoints = image.shape[3]
+
+    if mask_file is not None:
+        mask = nb.load(mask_file).get_data() > 0
+    else:
+        # Refined below to the voxels that vary over time
+        mask = np.ones(image.shape[:3], dtype=bool)
+
+    # A gzipped image is decompressed once up front rather than once per slab read
+    with uncompressed_images([image]) as (image,):
+        # Stage 1: accumulate G'G and G'X (and the sums needed to demean
+        # the maps and the data over space) one slab at a time
+        GtG = np.zeros((n_components, n_components))
+        GtX = np.zeros((n_components, n_timepoints))
+        G_sum = np.zeros(n_components)
+        X_sum = np.zeros(n_timepoints)
+        n_voxels = 0
+        for slab in iter_slabs(image.shape, slices_per_slab):
+            slab_mask = mask[:, :, slab]
+            if not slab_mask.any():
+                continue
+            X = np.asarray(image.dataobj[:, :, slab], dtype=np.float64)
+            if mask_file is None:
+                slab_mask &= X.std(axis=3) > 0
+            X = X[slab_mask]
+            G = group_maps[:, :, slab][slab_mask].astype(np.float64)
+            GtG += np.dot(G.T, G)
+            GtX += np.dot(G.T, X)
+            G_sum += G.sum(axis=0)
+            X_sum += X.sum(axis=0)
+            n_voxels += len(G)
+
+        if n_voxels == 0:
+            raise ValueError('No voxels left in the mask for {f}'.format(f=in_file))
+        GtG -= np.outer(G_sum, G_sum) / n_voxels
+        GtX -= np.outer(G_sum, X_sum) / n_voxels
+        timecourses = np.linalg.lstsq(GtG, GtX, rcond=-1)[0].T
+
+        # Stage 2: regress the timecourses against each slab
+        design = timecourses - timecourses.mean(axis=0)
+        if variance_normalize:
+            std = design.std(axis=0)
+            std[std == 0] = 1
+            design = design / std
+        design_pinv = np.linalg.pinv(design)
+
+        subject_maps = np.zeros(image.shape[:3] + (n_components,), dtype=np.float32)
+        for slab in iter_slabs(image.shape, slices_per_slab):
+            slab_mask = mask[:, :, slab]
+            if not slab_mask.any():
+                continue
+            X = np.asarray(image.dataobj[:, :, slab], dtype=np.float64)[slab_mask]
+            X -= X.mean(axis=1)[:, np.newaxis]
+            out_slab = subject_maps[:, :, slab]
+            out_slab[slab_mask] = np.dot(X, design_pinv.T)
+    return timecourses, subject_maps
+
+
+def _dual_regression_outputs(index, in_file):
+    '''
+    Output files of the index-th subject. The position in the input list
+    keeps subjects whose images share a file name (e.g. sub01/rest.nii.gz
+    and sub02/rest.nii.gz) apart.
+    '''
+    _, name, _ = split_filename(in_file)
+    timecourse_file = op.abspath('%03d_%s_dr_stage1.txt' % (index, name))
+    map_file = op.abspath('%03d_%s_dr_stage2.nii.gz' % (index, name))
+    return timecourse_file, map_file
+
+
+def _dual_regression_subject(args):
+    (in_file, group_maps_file, mask_file, variance_normalize, slices_per_slab,
+     timecourse_file, map_file) = args
+    timecourses, subject_maps = dual_regression(in_file, group_maps_file, mask_file,
+                                                variance_normalize, slices_per_slab)
+    np.savetxt(timecourse_file, timecourses)
+    affine = nb.load(in_file).get_affine()
+    nb.save(nb.Nifti1Image(subject_maps, affine), map_file)
+    return timecourse_file, map_file
+
+
+class DualRegressionInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='4D functional images, one per subject')
+    group_maps = File(exists=True, mandatory=True,
+                      desc='Group spatial maps (e.g. RestLib templates or group ICA components) as a 4D image')
+    mask_file = File(exists=True, desc='Mask restricting the regressions. Defaults to the voxels '
+                     'whose signal varies over time.')
+    variance_normalize = traits.Bool(True, usedefault=True,
+                                     desc='Variance-normalise the timecourses before the second stage')
+    slices_per_slab = traits.Int(8, usedefault=True,
+                                 desc='Number of slices read from each image at a time')
+    n_procs = traits.Int(desc='Number of subjects processed in parallel (defaults to all cores)')
+
+
+class DualRegressionOutputSpec(TraitedSpec):
+    timecourse_files = OutputMultiPath(File(exists=True),
+                                       desc='Stage 1 subject timecourses (time x components) as text files')
+    subject_map_files = OutputMultiPath(File(exists=True),
+                                        desc='Stage 2 subject-specific spatial maps as 4D images')
+
+
+class DualRegression(BaseInterface):
+    """
+    Dual-regression of group spatial maps onto each subject's fMRI data.
+    Subjects are processed in a process pool.
+
+    Example
+    -------
+
+    >>> import coma.interfaces as ci
+    >>> dualreg = ci.DualRegression()
+    >>> dualreg.inputs.in_files = ['subj1_fmri.nii.gz', 'subj2_fmri.nii.gz']
+    >>> dualreg.inputs.group_maps = 'templates.nii'
+    >>> dualreg.run()                                       # doctest: +SKIP
+    """
+    input_spec = DualRegressionInputSpec
+    output_spec = DualRegressionOutputSpec
+
+    def _run_interface(self, runtime):
+        mask_file = None
+        if isdefined(self.inputs.mask_file):
+            mask_file = self.inputs.mask_file
+        n_procs = None
+        if isdefined(self.inputs.n_procs):
+            n_procs = self.inputs.n_procs
+        jobs = [(in_file, self.inputs.group_maps, mask_file,
+                 self.inputs.variance_normalize, self.inputs.slices_per_slab) +
+                _dual_regression_outputs(index, in_file)
+                for index, in_file in enumerate(self.inputs.in_files)]
+        iflogger.info('Running dual regression on {n} subjects'.format(n=len(jobs)))
+        if n_procs == 1 or len(jobs) == 1:
+            for job in jobs:
+                _dual_regression_subject(job)
+        else:
+            pool = multiprocessing.Pool(n_procs)
+            try:
+                pool.map(_dual_regression_subject, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        timecourse_files = []
+        subject_map_files = []
+        for index, in_file in enumerate(self.inputs.in_files):
+            timecourse_file, map_file = _dual_regression_outputs(index, in_file)
+            timecourse_files.append(timecourse_file)
+            subject_map_files.append(map_file)
+        outputs['timecourse_files'] = timecourse_files
+        outputs['subject_map_files'] = subject_map_files
+        return outputs
@@ -9,7 +9,9 @@ import networkx as nx
 import scipy.io as sio
 from nipype.interfaces.cmtk.nx import (remove_all_edges, add_node_data, add_edge_data)
 from scipy.stats.stats import pearsonr
-from ..helpers import get_names
+from ..helpers import (get_names, iter_slabs, read_slab, uncompressed_images,
+                       nifti_memmap, wm_label_mask, csf_label_mask, read_frame_timing)
+from .glucose import HALF_LIVES
 
 from nipype import logging
 iflogger = logging.getLogger('interface')
@@ -40,11 +42,25 @@ class RegionalValuesInputSpec(TraitedSpec):
         True, usedefault=True, desc='Skips calculation for regions with ID = 0 (default=True)')
     out_stats_file = File('stats.mat', usedefault=True,
                           desc='Some simple image statistics for regions saved as a Matlab .mat')
+    frame_timing_file = File(exists=True, xor=['frame_start_times'],
+                             desc='Frame start times and durations of a dynamic PET image (a BIDS .json '
+                             'sidecar or a two-column text file in seconds). Enables the time-activity curve mode.')
+    frame_start_times = traits.List(traits.Float, xor=['frame_timing_file'], requires=['frame_durations'],
+                                    desc='Frame start times in seconds. Enables the time-activity curve mode.')
+    frame_durations = traits.List(traits.Float, desc='Frame durations in seconds')
+    decay_correct = traits.Bool(True, usedefault=True,
+                                desc='Decay-correct the time-activity curves to the injection time, unless '
+                                'the sidecar reports the images as already decay-corrected')
+    isotope = traits.Enum('F18', 'C11', 'O15', 'N13', usedefault=True, desc='Radiotracer isotope')
+    slices_per_slab = traits.Int(8, usedefault=True, desc='Number of slices processed at a time')
+    out_tac_file = File('tacs.csv', usedefault=True,
+                        desc='Frames x regions time-activity curve table (time-activity curve mode)')
 
 
 class RegionalValuesOutputSpec(TraitedSpec):
     stats_file = File(
         desc='Some simple image statistics for the original and normalized images saved as a Matlab .mat')
+    tac_file = File(desc='Frames x regions time-activity curve table as CSV')
     networks = OutputMultiPath(
         File(desc='Output gpickled network files for all statistical measures'))
 
@@ -55,6 +71,10 @@ class RegionalValues(BaseInterface):
     Extracts the regional mean, max, min, and standard deviation for a single functional image, 4D functional image, or list of functional images given a segmentated image.
     Output is saved in a MATLAB file, and if a network resolution file is provided (e.g. resolution1015.graphml), the regions are output as nodes in a NetworkX graph.
 
+    If frame timings are given, the frames are treated as a dynamic PET series instead: the decay-corrected
+    regional mean of every frame is extracted in one labeled reduction and saved as a frames x regions CSV
+    table, with the frame times and duration weights for kinetic modelling.
+
     Example
     -------
 
@@ -67,7 +87,92 @@ class RegionalValues(BaseInterface):
     input_spec = RegionalValuesInputSpec
     output_spec = RegionalValuesOutputSpec
 
+    def _tac_mode(self):
+        return isdefined(self.inputs.frame_timing_file) or isdefined(self.inputs.frame_start_times)
+
+    def _frame_timing(self):
+        '''
+        Frame start times and durations in minutes, and whether the frames
+        still need to be decay-corrected
+        '''
+        decay_correct = self.inputs.decay_correct
+        if isdefined(self.inputs.frame_timing_file):
+            start, duration = read_frame_timing(self.inputs.frame_timing_file)
+            if self.inputs.frame_timing_file.endswith('.json'):
+                import json
+                f = open(self.inputs.frame_timing_file, 'r')
+                if json.load(f).get('ImageDecayCorrected', False):
+                    iflogger.info('The images are already decay-corrected')
+                    decay_correct = False
+                f.close()
+        else:
+            if len(self.inputs.frame_start_times) != len(self.inputs.frame_durations):
+                raise ValueError('There must be one duration per frame start time')
+            start = np.asarray(self.inputs.frame_start_times, dtype=np.float64) / 60.0
+            duration = np.asarray(self.inputs.frame_durations, dtype=np.float64) / 60.0
+        return start, duration, decay_correct
+
+    def _run_tac(self, runtime):
+        images = get_functional_images(self.inputs)
+        n_frames = len(images) if len(images) > 1 else images[0].shape[3]
+        start, duration, decay_correct = self._frame_timing()
+        if len(start) != n_frames:
+            raise ValueError('The frame timing describes {t} frames but the image has {n}'.format(
+                t=len(start), n=n_frames))
+
+        # Mean decay over each frame, so the corrected value refers to the injection time
+        decay_factors = np.ones(n_frames)
+        if decay_correct:
+            decay_constant = np.log(2) / (HALF_LIVES[self.inputs.isotope] / 60.0)
+            decay_factors = decay_constant * duration / (
+                np.exp(-decay_constant * start) * -np.expm1(-decay_constant * duration))
+
+        rois = get_roi_list(self.inputs.segmentation_file)
+        segmentationdata = nb.load(self.inputs.segmentation_file).get_data()
+        segmentationdata = segmentationdata.reshape(segmentationdata.shape[:3])
+        if segmentationdata.shape != images[0].shape[:3]:
+            raise ValueError('The segmentation and the PET frames must have the same dimensions')
+        tacs, voxels = regional_means(images, segmentationdata, rois, self.inputs.slices_per_slab)
+        tacs = tacs * decay_factors
+        weights = duration / duration.sum()
+
+        roi_names = ['roi_%d' % x for x in rois]
+        if isdefined(self.inputs.lookup_table):
+            LUT_dict = get_names(self.inputs.lookup_table)
+            roi_names = [LUT_dict.get(x, "Unknown_ROI_" + str(x)) for x in rois]
+
+        stats = {}
+        stats['func_mean'] = tacs
+        stats['time_weighted_mean'] = np.dot(tacs, weights)
+        stats['number_of_voxels'] = voxels
+        stats['rois'] = rois
+        stats['roi_names'] = roi_names
+        stats['frame_start'] = start
+        stats['frame_duration'] = duration
+        stats['frame_mid_time'] = start + duration / 2.0
+        stats['frame_weight'] = weights
+        stats['decay_factor'] = decay_factors
+        if isdefined(self.inputs.subject_id):
+            stats['subject_id'] = self.inputs.subject_id
+        sio.savemat(op.abspath(self.inputs.out_stats_file), stats)
+
+        import csv
+        f = open(op.abspath(self.inputs.out_tac_file), 'w')
+        writer = csv.writer(f)
+        writer.writerow(['frame', 'start_min', 'duration_min', 'mid_time_min', 'weight',
+                         'decay_factor'] + roi_names)
+        for frame in range(n_frames):
+            writer.writerow([frame, start[frame], duration[frame], start[frame] + duration[frame] / 2.0,
+                             weights[frame], decay_factors[frame]] + tacs[:, frame].tolist())
+        f.close()
+        iflogger.info('Saved time-activity curves of {r} regions as {f}'.format(
+            r=len(rois), f=op.abspath(self.inputs.out_tac_file)))
+        return runtime
+
     def _run_interface(self, runtime):
+        if self._tac_mode():
+            return self._run_tac(runtime)
+
         if isdefined(self.inputs.lookup_table):
             LUT_dict = get_names(self.inputs.lookup_table)
                     
@@ -77,7 +182,7 @@ class RegionalValues(BaseInterface):
             in_files = self.inputs.in_files
         elif isdefined(self.inputs.in_file4d):
             iflogger.info('Single four-dimensional image selected')
-            in_files = nb.four_to_three(self.inputs.in_file4d)
+            in_files = nb.four_to_three(nb.load(self.inputs.in_file4d))
         else:
             iflogger.info('Single functional image provided')
             in_files = self.inputs.in_files
@@ -191,7 +296,9 @@ class RegionalValues(BaseInterface):
         outputs = self.output_spec().get()
         out_stats_file = op.abspath(self.inputs.out_stats_file)
         outputs["stats_file"] = out_stats_file
-        if isdefined(self.inputs.resolution_network_file):
+        if self._tac_mode():
+            outputs["tac_file"] = op.abspath(self.inputs.out_tac_file)
+        elif isdefined(self.inputs.resolution_network_file):
             outputs["networks"] = all_ntwks
         else:
             outputs["networks"] = ''
@@ -251,6 +358,33 @@ def get_roi_values(roi, segmentationdata, in_files):
     return roi_means, roi_maxs, roi_mins, roi_stds, voxels
 
 
+def regional_means(images, segmentationdata, rois, slices_per_slab=8):
+    '''
+    Mean of every region in every frame, reduced with np.bincount a slab
+    of slices at a time instead of one masked pass per region. Returns
+    a (regions x frames) array and the number of voxels per region.
+    '''
+    rois = np.asarray(rois, dtype=np.int64)
+    lookup = np.zeros(int(max(rois.max(), segmentationdata.max())) + 1, dtype=np.int64)
+    lookup[rois] = np.arange(1, len(rois) + 1)
+    n_bins = len(rois) + 1
+    sums = None
+    counts = np.zeros(n_bins)
+    with uncompressed_images(images) as frames:
+        for slab in iter_slabs(segmentationdata.shape, slices_per_slab):
+            labels = lookup[segmentationdata[:, :, slab].astype(np.int64)].ravel()
+            data = read_slab(frames, slab)
+            data = data.reshape(-1, data.shape[-1])
+            if sums is None:
+                sums = np.zeros((n_bins, data.shape[1]))
+            counts += np.bincount(labels, minlength=n_bins)
+            for frame in range(data.shape[1]):
+                sums[:, frame] += np.bincount(labels, weights=data[:, frame], minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums[1:] / counts[1:, np.newaxis]
+    return means, counts[1:].astype(np.int64)
+
+
 def get_timecourse_by_region(in_files, segmentation_file, rois):
     roi_mean_tc = []
     roi_min_tc = []
@@ -309,14 +443,14 @@ class SimpleTimeCourseCorrelationGraph(BaseInterface):
     output_spec = SimpleTimeCourseCorrelationGraphOutputSpec
 
     def _run_interface(self, runtime):
-        if len(self.inputs.in_files) > 1:
-            iflogger.info('Multiple input images detected')
-            iflogger.info(len(self.inputs.in_files))
-            in_files = self.inputs.in_files
-        elif isdefined(self.inputs.in_file4d):
+        if isdefined(self.inputs.in_file4d):
             iflogger.info('Single four-dimensional image selected')
             in_file4d = nb.load(self.inputs.in_file4d)
             in_files = nb.four_to_three(in_file4d)
+        elif len(self.inputs.in_files) > 1:
+            iflogger.info('Multiple input images detected')
+            iflogger.info(len(self.inputs.in_files))
+            in_files = self.inputs.in_files
         else:
             iflogger.info('Single functional image provided')
             in_files = self.inputs.in_files
@@ -328,7 +462,7 @@ class SimpleTimeCourseCorrelationGraph(BaseInterface):
         else:
             rois = get_roi_list(self.inputs.segmentation_file)
             fMRI_timecourse = get_timecourse_by_region(
-                in_files, self.inputs.segmentation_file, rois)
+                in_files, self.inputs.segmentation_file, rois)[0]
 
         timecourse_at_each_node = fMRI_timecourse.T
         iflogger.info(np.shape(timecourse_at_each_node))
@@ -394,3 +528,306 @@ class SimpleTimeCourseCorrelationGraph(BaseInterface):
 
     def _gen_outfilename(self, name, ext):
         return name + '.' + ext
+
+
+
+def polynomial_regressors(n_timepoints, order):
+    """
+    Legendre polynomials up to the given order over the time points,
+    including the constant term, as a (time x order+1) array.
+    """
+    x = np.linspace(-1, 1, n_timepoints)
+    return np.polynomial.legendre.legvander(x, max(order, 0))
+
+
+def regress_out(data, confounds, keep_mean=True):
+    """
+    Removes the confounds (time x regressors) from data (samples x time)
+    with a single least-squares solve. The pseudo-inverse of the
+    confounds is shared by every sample.
+    """
+    mean = data.mean(axis=1)[:, np.newaxis]
+    residuals = data - np.dot(np.dot(data, np.linalg.pinv(confounds).T), confounds.T)
+    if keep_mean:
+        residuals += mean
+    return residuals
+
+
+def get_functional_images(inputs):
+    if isdefined(inputs.in_file4d):
+        return [nb.load(inputs.in_file4d)]
+    return [nb.load(in_file) for in_file in inputs.in_files]
+
+
+class NuisanceRegressionInputSpec(TraitedSpec):
+    in_files = InputMultiPath(File(exists=True), xor=['in_file4d'],
+                              desc='Functional magnetic resonance image (fMRI) as a set of 3-dimensional images')
+    in_file4d = File(exists=True, xor=['in_files'],
+                     desc='Functional magnetic resonance image (fMRI) as a 4-dimensional image')
+    roi_stats_file = File(exists=True, desc='Regional timecourses (e.g. from RegionalValues) saved as a Matlab .mat. '
+                          'If given, the confounds are regressed from the func_mean timecourses instead of the voxels.')
+    segmentation_file = File(exists=True, desc='FreeSurfer-labelled segmentation (e.g. aparc+aseg.nii) in the '
+                             'space of the functional images, used to extract the WM and CSF signals')
+    mask_file = File(exists=True, desc='Voxels to denoise. Defaults to the voxels whose signal varies over time.')
+    wm_signal = traits.Bool(True, usedefault=True, desc='Regress out the mean white-matter signal')
+    csf_signal = traits.Bool(True, usedefault=True, desc='Regress out the mean CSF signal')
+    global_signal = traits.Bool(False, usedefault=True, desc='Regress out the global (in-mask) signal')
+    regressors_file = File(exists=True, desc='Additional regressors (e.g. motion parameters) as a '
+                           'text file with one row per time point')
+    polynomial_order = traits.Int(1, usedefault=True,
+                                  desc='Order of the Legendre polynomials used for detrending (0 removes only the mean)')
+    keep_mean = traits.Bool(True, usedefault=True, desc='Add the temporal mean back to the residuals')
+    slices_per_slab = traits.Int(8, usedefault=True, desc='Number of slices processed at a time')
+    out_file = File('denoised.nii', usedefault=True, desc='Denoised 4D image (always written uncompressed)')
+    out_stats_file = File('denoised_stats.mat', usedefault=True,
+                          desc='Denoised regional timecourses, when roi_stats_file is given')
+    out_confounds_file = File('confounds.txt', usedefault=True, desc='The confound timecourses that were regressed out')
+
+
+class NuisanceRegressionOutputSpec(TraitedSpec):
+    out_file = File(desc='Denoised 4D image')
+    stats_file = File(desc='Denoised regional timecourses saved as a Matlab .mat')
+    confounds_file = File(desc='The confound timecourses that were regressed out')
+
+
+class NuisanceRegression(BaseInterface):
+
+    """
+    Regresses confound timecourses (mean WM and CSF signals, the global signal, user-supplied
+    regressors and polynomial trends) from every in-mask voxel of a functional image, or from
+    regional timecourses. The image is processed in slabs of slices and the output is written
+    through a memory map, so only a few slices are ever held in memory.
+
+    Example
+    -------
+
+    >>> import coma.interfaces as ci
+    >>> nuisance = ci.NuisanceRegression()
+    >>> nuisance.inputs.in_file4d = 'fmri.nii'
+    >>> nuisance.inputs.segmentation_file = 'aparc+aseg.nii'
+    >>> nuisance.run() # doctest: +SKIP
+    """
+    input_spec = NuisanceRegressionInputSpec
+    output_spec = NuisanceRegressionOutputSpec
+
+    def _run_interface(self, runtime):
+        have_images = isdefined(self.inputs.in_file4d) or isdefined(self.inputs.in_files)
+        if not have_images and not isdefined(self.inputs.roi_stats_file):
+            raise ValueError('Either functional images or a regional statistics file must be provided')
+        if (self.inputs.wm_signal or self.inputs.csf_signal) and not have_images:
+            iflogger.info('No functional images given. WM and CSF signals will not be regressed out.')
+
+        roi_data = None
+        if isdefined(self.inputs.roi_stats_file):
+            stats = sio.loadmat(self.inputs.roi_stats_file)
+            roi_data = np.atleast_2d(stats['func_mean']).astype(np.float64)
+
+        images = get_functional_images(self.inputs) if have_images else []
+        with uncompressed_images(images) as frames:
+            signals = []
+            if have_images:
+                signals, mask = self._extract_signals(frames)
+                n_timepoints = len(frames) if len(frames) > 1 else frames[0].shape[3]
+            else:
+                n_timepoints = roi_data.shape[1]
+                if self.inputs.global_signal:
+                    signals.append(roi_data.mean(axis=0))
+
+            confounds = [polynomial_regressors(n_timepoints, self.inputs.polynomial_order)]
+            confounds.extend([signal[:, np.newaxis] for signal in signals])
+            if isdefined(self.inputs.regressors_file):
+                regressors = np.loadtxt(self.inputs.regressors_file, ndmin=2)
+                if len(regressors) != n_timepoints:
+                    raise ValueError('The regressors file has {r} rows but there are {t} time points'.format(
+                        r=len(regressors), t=n_timepoints))
+                confounds.append(regressors)
+            confounds = np.hstack(confounds)
+            iflogger.info('Regressing out {n} confounds'.format(n=confounds.shape[1]))
+            np.savetxt(op.abspath(self.inputs.out_confounds_file), confounds)
+
+            if roi_data is not None:
+                stats['func_mean'] = regress_out(roi_data, confounds, self.inputs.keep_mean)
+                sio.savemat(op.abspath(self.inputs.out_stats_file), stats)
+            else:
+                self._write_denoised(frames, mask, confounds)
+        return runtime
+
+    def _extract_signals(self, images):
+        shape = images[0].shape[:3]
+        if isdefined(self.inputs.mask_file):
+            mask = nb.load(self.inputs.mask_file).get_data() > 0
+        else:
+            mask = np.ones(shape, dtype=bool)
+        masks = []
+        if isdefined(self.inputs.segmentation_file):
+            segmentation = nb.load(self.inputs.segmentation_file).get_data()
+            if self.inputs.wm_signal:
+                masks.append(wm_label_mask(segmentation))
+            if self.inputs.csf_signal:
+                masks.append(csf_label_mask(segmentation))
+        elif self.inputs.wm_signal or self.inputs.csf_signal:
+            raise ValueError('A segmentation file is required to extract the WM and CSF signals')
+
+        # One pass over the data accumulates the sums for every signal
+        sums = None
+        counts = np.zeros(len(masks) + 1)
+        for slab in iter_slabs(shape, self.inputs.slices_per_slab):
+            data = read_slab(images, slab)
+            if sums is None:
+                sums = np.zeros((len(masks) + 1, data.shape[3]))
+            slab_mask = mask[:, :, slab]
+            if not isdefined(self.inputs.mask_file):
+                slab_mask &= data.std(axis=3) > 0
+            for idx, roi_mask in enumerate([slab_mask] + [m[:, :, slab] for m in masks]):
+                sums[idx] += data[roi_mask].sum(axis=0)
+                counts[idx] += roi_mask.sum()
+        if np.any(counts == 0):
+            raise ValueError('Empty mask while extracting the confound signals')
+        means = sums / counts[:, np.newaxis]
+
+        signals = list(means[1:])
+        if self.inputs.global_signal:
+            signals.append(means[0])
+        return signals, mask
+
+    def _write_denoised(self, images, mask, confounds):
+        shape = images[0].shape[:3]
+        n_timepoints = confounds.shape[0]
+        out_file = op.abspath(self.inputs.out_file)
+        if out_file.endswith('.gz'):
+            out_file = out_file[:-3]
+        out_data = nifti_memmap(out_file, shape + (n_timepoints,), images[0].get_affine(),
+                                images[0].get_header())
+        for slab in iter_slabs(shape, self.inputs.slices_per_slab):
+            data = read_slab(images, slab)
+            slab_mask = mask[:, :, slab]
+            out_slab = data.astype(np.float32)
+            out_slab[slab_mask] = regress_out(data[slab_mask], confounds, self.inputs.keep_mean)
+            out_data[:, :, slab] = out_slab
+        out_data.flush()
+        del out_data
+        iflogger.info('Saved denoised image as {f}'.format(f=out_file))
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.roi_stats_file):
+            outputs['stats_file'] = op.abspath(self.inputs.out_stats_file)
+        else:
+            out_file = op.abspath(self.inputs.out_file)
+            if out_file.endswith('.gz'):
+                out_file = out_file[:-3]
+            outputs['out_file'] = out_file
+        outputs['confounds_file'] = op.abspath(self.inputs.out_confounds_file)
+        return outputs
+
+
+def bandpass_filter(data, repetition_time, highpass=None, lowpass=None, keep_mean=True):
+    """
+    Band-pass filters every row of data (samples x time) at once by zeroing
+    the Fourier coefficients outside [highpass, lowpass] (in Hz). Either
+    cut-off can be None for a purely low- or high-pass filter.
+    """
+    n_timepoints = data.shape[1]
+    frequencies = np.fft.rfftfreq(n_timepoints, d=repetition_time)
+    keep = np.ones(len(frequencies), dtype=bool)
+    if highpass is not None:
+        keep &= frequencies >= highpass
+    if lowpass is not None:
+        keep &= frequencies <= lowpass
+    keep[0] = keep_mean
+    spectrum = np.fft.rfft(data, axis=1)
+    spectrum[:, ~keep] = 0
+    return np.fft.irfft(spectrum, n=n_timepoints, axis=1)
+
+
+class TemporalFilterInputSpec(TraitedSpec):
+    in_files = InputMultiPath(File(exists=True), xor=['in_file4d'],
+                              desc='Functional magnetic resonance image (fMRI) as a set of 3-dimensional images')
+    in_file4d = File(exists=True, xor=['in_files'],
+                     desc='Functional magnetic resonance image (fMRI) as a 4-dimensional image')
+    roi_stats_file = File(exists=True, desc='Regional timecourses (e.g. from RegionalValues) saved as a Matlab .mat. '
+                          'If given, the func_mean timecourses are filtered instead of the voxels.')
+    repetition_time = traits.Float(mandatory=True, desc='The repetition time (TR) in seconds')
+    highpass = traits.Float(0.01, usedefault=True, desc='High-pass cut-off in Hz (0 to disable)')
+    lowpass = traits.Float(desc='Low-pass cut-off in Hz (e.g. 0.1). High-pass only if not set.')
+    keep_mean = traits.Bool(True, usedefault=True, desc='Keep the temporal mean of each timecourse')
+    slices_per_slab = traits.Int(8, usedefault=True, desc='Number of slices processed at a time')
+    out_file = File('filtered.nii', usedefault=True, desc='Filtered 4D image (always written uncompressed)')
+    out_stats_file = File('filtered_stats.mat', usedefault=True,
+                          desc='Filtered regional timecourses, when roi_stats_file is given')
+
+
+class TemporalFilterOutputSpec(TraitedSpec):
+    out_file = File(desc='Filtered 4D image')
+    stats_file = File(desc='Filtered regional timecourses saved as a Matlab .mat')
+
+
+class TemporalFilter(BaseInterface):
+
+    """
+    FFT-based temporal band-pass (or high-pass) filter for functional images or regional timecourses.
+    Voxels are filtered a slab of slices at a time, all timecourses of a slab in one call, and the
+    output is written through a memory map.
+
+    Example
+    -------
+
+    >>> import coma.interfaces as ci
+    >>> bandpass = ci.TemporalFilter()
+    >>> bandpass.inputs.in_file4d = 'fmri.nii'
+    >>> bandpass.inputs.repetition_time = 2.0
+    >>> bandpass.inputs.lowpass = 0.1
+    >>> bandpass.run() # doctest: +SKIP
+    """
+    input_spec = TemporalFilterInputSpec
+    output_spec = TemporalFilterOutputSpec
+
+    def _filter(self, data):
+        highpass = None
+        if self.inputs.highpass > 0:
+            highpass = self.inputs.highpass
+        lowpass = None
+        if isdefined(self.inputs.lowpass):
+            lowpass = self.inputs.lowpass
+        return bandpass_filter(data, self.inputs.repetition_time, highpass, lowpass,
+                               self.inputs.keep_mean)
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.roi_stats_file):
+            stats = sio.loadmat(self.inputs.roi_stats_file)
+            stats['func_mean'] = self._filter(np.atleast_2d(stats['func_mean']).astype(np.float64))
+            sio.savemat(op.abspath(self.inputs.out_stats_file), stats)
+            return runtime
+
+        if not (isdefined(self.inputs.in_file4d) or isdefined(self.inputs.in_files)):
+            raise ValueError('Either functional images or a regional statistics file must be provided')
+        images = get_functional_images(self.inputs)
+        shape = images[0].shape[:3]
+        n_timepoints = len(images) if len(images) > 1 else images[0].shape[3]
+        out_file = self._out_file()
+        out_data = nifti_memmap(out_file, shape + (n_timepoints,), images[0].get_affine(),
+                                images[0].get_header())
+        with uncompressed_images(images) as frames:
+            for slab in iter_slabs(shape, self.inputs.slices_per_slab):
+                data = read_slab(frames, slab)
+                slab_shape = data.shape
+                filtered = self._filter(data.reshape(-1, n_timepoints))
+                out_data[:, :, slab] = filtered.reshape(slab_shape)
+        out_data.flush()
+        del out_data
+        iflogger.info('Saved filtered image as {f}'.format(f=out_file))
+        return runtime
+
+    def _out_file(self):
+        out_file = op.abspath(self.inputs.out_file)
+        if out_file.endswith('.gz'):
+            out_file = out_file[:-3]
+        return out_file
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.roi_stats_file):
+            outputs['stats_file'] = op.abspath(self.inputs.out_stats_file)
+        else:
+            outputs['out_file'] = self._out_file()
+        return outputs
@@ -1,20 +1,202 @@
 from nipype.interfaces.matlab import MatlabCommand
 from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, traits, InputMultiPath,
-                                    File, TraitedSpec, OutputMultiPath)
+                                    File, TraitedSpec, OutputMultiPath, Directory, isdefined)
 from nipype.utils.filemanip import split_filename
+from coma.helpers import stage_image
 import os, os.path as op
 from string import Template
-import shutil
 import logging
+import multiprocessing
+import numpy as np
+import nibabel as nb
+import scipy.io as sio
 
 logging.basicConfig()
 iflogger = logging.getLogger('interface')
 
+
+def load_masked_timeseries(in_files):
+    """
+    Loads the fMRI data (a list of 3D images or 4D images) as a
+    time x voxel array restricted to an intensity-based brain mask.
+    The mask keeps voxels whose mean is above the mean of the whole
+    volume, as GIFT does by default.
+    """
+    frames = []
+    for in_file in in_files:
+        image = nb.load(in_file)
+        data = image.get_data()
+        if data.ndim == 3:
+            data = data[..., np.newaxis]
+        for idx in range(data.shape[3]):
+            frames.append(np.asarray(data[..., idx], dtype=np.float32))
+    affine = nb.load(in_files[0]).get_affine()
+    mean_image = np.mean(frames, axis=0)
+    mask = mean_image > mean_image.mean()
+    timeseries = np.vstack([frame[mask] for frame in frames])
+    return timeseries, mask, affine
+
+
+def _sym_decorrelation(W):
+    s, u = np.linalg.eigh(np.dot(W, W.T))
+    return np.dot(np.dot(u * (1. / np.sqrt(s)), u.T), W)
+
+
+def fastica(whitened, random_state=None, max_iter=200, tol=1e-4):
+    """
+    Symmetric FastICA (logcosh contrast) on whitened data of shape
+    components x voxels. Returns the unmixed sources (spatial maps).
+    """
+    rng = np.random.RandomState(random_state)
+    n_components, n_samples = whitened.shape
+    W = _sym_decorrelation(rng.randn(n_components, n_components))
+    for _ in range(max_iter):
+        gwtx = np.tanh(np.dot(W, whitened))
+        g_wtx = (1 - gwtx ** 2).mean(axis=1)
+        W1 = _sym_decorrelation(
+            np.dot(gwtx, whitened.T) / n_samples - g_wtx[:, np.newaxis] * W)
+        lim = np.max(np.abs(np.abs(np.diag(np.dot(W1, W.T))) - 1))
+        W = W1
+        if lim < tol:
+            break
+    return np.dot(W, whitened)
+
+
+def pca_whiten(timeseries, n_components):
+    """
+    Reduces a centered time x voxel array to its first n_components
+    principal components, whitened so that each row has unit variance.
+    """
+    n_voxels = timeseries.shape[1]
+    cov = np.dot(timeseries, timeseries.T) / n_voxels
+    evals, evecs = np.linalg.eigh(cov)
+    order = np.argsort(evals)[::-1][:n_components]
+    evals, evecs = evals[order], evecs[:, order]
+    return np.dot(evecs.T / np.sqrt(evals)[:, np.newaxis], timeseries)
+
+
+def _icasso_run(args):
+    data_file, n_components, seed, bootstrap = args
+    timeseries = np.load(data_file, mmap_mode='r')
+    rng = np.random.RandomState(seed)
+    if bootstrap:
+        samples = rng.randint(0, timeseries.shape[0], timeseries.shape[0])
+        timeseries = timeseries[np.sort(samples)]
+    timeseries = np.asarray(timeseries, dtype=np.float64)
+    whitened = pca_whiten(timeseries, n_components)
+    sources = fastica(whitened, random_state=rng.randint(2 ** 31 - 1))
+    return sources.astype(np.float32)
+
+
+def cluster_components(sources, n_clusters):
+    """
+    Clusters the estimates from all ICA runs (runs*components x voxels)
+    by average linkage on their absolute spatial correlation. The whole
+    similarity matrix is computed with a single matrix product.
+
+    Returns the cluster labels (0-based), the stability index Iq of each
+    cluster and the index of the centrotype estimate of each cluster.
+    """
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+    standardized = sources - sources.mean(axis=1)[:, np.newaxis]
+    standardized /= standardized.std(axis=1)[:, np.newaxis]
+    similarity = np.abs(np.dot(standardized, standardized.T)) / sources.shape[1]
+    np.fill_diagonal(similarity, 1)
+    distance = np.clip(1 - similarity, 0, None)
+    tree = linkage(squareform(distance, checks=False), method='average')
+    labels = fcluster(tree, n_clusters, criterion='maxclust') - 1
+
+    stability = []
+    centrotypes = []
+    for cluster in np.unique(labels):
+        members = np.where(labels == cluster)[0]
+        others = np.where(labels != cluster)[0]
+        within = similarity[np.ix_(members, members)]
+        intra = within.mean()
+        extra = similarity[np.ix_(members, others)].mean() if len(others) else 0
+        stability.append(intra - extra)
+        centrotypes.append(members[np.argmax(within.sum(axis=1))])
+    return labels, np.array(stability), np.array(centrotypes)
+
+
+def icasso(timeseries, n_components, n_runs, bootstrap=True, seed=0,
+           n_procs=None, work_dir=None):
+    """
+    ICASSO-style stability analysis. Spatial ICA is repeated n_runs times
+    (with different initializations and, optionally, bootstrap resampling
+    of the time points) in a process pool and the resulting components are
+    clustered.
+
+    Returns the centrotype maps (components x voxels) sorted by decreasing
+    stability, their least-squares timecourses (time x components) and a
+    dictionary of stability statistics.
+    """
+    if n_runs < 1:
+        raise ValueError('At least one ICA run is required for ICASSO, got %d' % n_runs)
+    if work_dir is None:
+        work_dir = os.getcwd()
+    # Intensity normalization per voxel, then removal of the mean
+    # of each time point, as in the GIFT batch used by SingleSubjectICA
+    voxel_means = timeseries.mean(axis=0)
+    voxel_means[voxel_means == 0] = 1
+    timeseries = timeseries / voxel_means * 100
+    timeseries = timeseries - timeseries.mean(axis=1)[:, np.newaxis]
+
+    data_file = op.join(work_dir, 'icasso_data.npy')
+    try:
+        np.save(data_file, timeseries.astype(np.float32))
+        jobs = [(data_file, n_components, seed + run, bootstrap and run > 0)
+                for run in range(n_runs)]
+        if n_procs == 1:
+            estimates = [_icasso_run(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(n_procs)
+            try:
+                estimates = pool.map(_icasso_run, jobs)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if op.exists(data_file):
+            os.remove(data_file)
+
+    sources = np.vstack(estimates)
+    labels, stability, centrotypes = cluster_components(sources, n_components)
+    order = np.argsort(stability)[::-1]
+    stability, centrotypes = stability[order], centrotypes[order]
+
+    maps = sources[centrotypes].astype(np.float64)
+    # Flip the sign so that the heavier tail of each map is positive
+    skew = np.mean((maps - maps.mean(axis=1)[:, np.newaxis]) ** 3, axis=1)
+    maps *= np.where(skew < 0, -1, 1)[:, np.newaxis]
+    timecourses = np.linalg.lstsq(maps.T, timeseries.T, rcond=-1)[0].T
+
+    stats = {}
+    stats['stability_index'] = stability
+    stats['cluster_sizes'] = np.array(
+        [np.sum(labels == labels[c]) for c in centrotypes])
+    stats['centrotype_run'] = centrotypes // n_components + 1
+    stats['centrotype_component'] = centrotypes % n_components + 1
+    stats['number_of_runs'] = n_runs
+    stats['bootstrap'] = bootstrap
+    return maps, timecourses, stats
+
+
 class SingleSubjectICAInputSpec(BaseInterfaceInputSpec):
     in_files = InputMultiPath(File(exists=True), mandatory=True,
     desc='The input fMRI data as separate images')
     desired_number_of_components = traits.Int(30, usedefault=True, desc='The desired number of independent components to split the data into.')
     prefix = traits.Str(desc='A prefix for the output files')
+    icasso_runs = traits.Int(desc='If set, ICA is run natively this many times and the components are clustered '
+                             'ICASSO-style. The centrotypes are output instead of a single GIFT run.')
+    icasso_bootstrap = traits.Bool(True, usedefault=True,
+                                   desc='Resample the time points with replacement for every ICASSO run but the first')
+    random_seed = traits.Int(0, usedefault=True, desc='Seed for the first ICASSO run')
+    n_procs = traits.Int(desc='Number of processes used for the ICASSO runs (defaults to all cores)')
+    staging_dir = Directory(desc='Directory in which the input images are staged for GIFT. Defaults to the working directory.')
+    use_symlinks = traits.Bool(False, usedefault=True,
+                               desc='Stage inputs with symbolic links instead of hard links')
 
 class SingleSubjectICAOutputSpec(TraitedSpec):
     mask_image = File(exists=True, desc='ICA mask image')
@@ -24,6 +206,7 @@ class SingleSubjectICAOutputSpec(TraitedSpec):
     results_log_file = File(exists=True, desc='Results log file')
     independent_component_images = File(exists=True, desc='4D set of independent component images')
     independent_component_timecourse = File(exists=True, desc='IC timecourse image')
+    stability_file = File(exists=True, desc='ICASSO stability indices and cluster statistics as a MATLAB .mat file')
 
 class SingleSubjectICA(BaseInterface):
     """
@@ -34,21 +217,21 @@ class SingleSubjectICA(BaseInterface):
     output_spec = SingleSubjectICAOutputSpec
 
     def _run_interface(self, runtime):
+        if isdefined(self.inputs.icasso_runs):
+            return self._run_icasso(runtime)
+
         in_files = self.inputs.in_files
-        data_dir = op.join(os.getcwd(),'origdata')
-        if not op.exists(data_dir):
-            os.makedirs(data_dir)
+        if isdefined(self.inputs.staging_dir):
+            data_dir = op.join(op.abspath(self.inputs.staging_dir), 'origdata')
+        else:
+            data_dir = op.join(os.getcwd(), 'origdata')
         all_names = []
-        print 'Multiple ({n}) input images detected! Copying to {d}...'.format(n=len(self.inputs.in_files), d=data_dir)
+        print 'Multiple ({n}) input images detected! Staging in {d}...'.format(n=len(self.inputs.in_files), d=data_dir)
         for in_file in self.inputs.in_files:
-            path, name, ext = split_filename(in_file)
-            shutil.copyfile(in_file, op.join(data_dir, name) + ext)
-            if ext == '.img':
-                shutil.copyfile(op.join(path, name) + '.hdr', op.join(data_dir, name) + '.hdr')
-            elif ext == '.hdr':
-                shutil.copyfile(op.join(path, name) + '.img', op.join(data_dir, name) + '.img')
+            staged = stage_image(in_file, data_dir, self.inputs.use_symlinks)
+            path, name, ext = split_filename(staged)
             all_names.append(name)
-        print 'Copied!'
+        print 'Staged!'
 
         input_files_as_str = op.join(data_dir, os.path.commonprefix(all_names) + '*' + ext)
         number_of_components = self.inputs.desired_number_of_components
@@ -125,9 +308,41 @@ class SingleSubjectICA(BaseInterface):
         r = result.run()
         return runtime
 
+    def _run_icasso(self, runtime):
+        prefix = self.inputs.prefix
+        n_procs = None
+        if isdefined(self.inputs.n_procs):
+            n_procs = self.inputs.n_procs
+        timeseries, mask, affine = load_masked_timeseries(self.inputs.in_files)
+        iflogger.info('Running ICA {n} times on {v} voxels'.format(
+            n=self.inputs.icasso_runs, v=timeseries.shape[1]))
+        maps, timecourses, stats = icasso(
+            timeseries, self.inputs.desired_number_of_components,
+            self.inputs.icasso_runs, self.inputs.icasso_bootstrap,
+            self.inputs.random_seed, n_procs)
+        iflogger.info('Stability indices: {iq}'.format(iq=stats['stability_index']))
+
+        mask_image = nb.AnalyzeImage(mask.astype(np.uint8), affine)
+        nb.save(mask_image, op.abspath(prefix + 'Mask.img'))
+
+        component_data = np.zeros(mask.shape + (len(maps),), dtype=np.float32)
+        component_data[mask] = maps.T
+        nb.save(nb.Nifti1Image(component_data, affine),
+                op.abspath(prefix + "_sub01_component_ica_s1_.nii"))
+        nb.save(nb.Nifti1Image(timecourses.astype(np.float32), np.eye(4)),
+                op.abspath(prefix + "_sub01_timecourses_ica_s1_.nii"))
+        sio.savemat(op.abspath(prefix + '_icasso.mat'), stats)
+        return runtime
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         prefix = self.inputs.prefix
+        if isdefined(self.inputs.icasso_runs):
+            outputs['mask_image'] = op.abspath(prefix + 'Mask.img')
+            outputs['independent_component_images'] = op.abspath(prefix + "_sub01_component_ica_s1_.nii")
+            outputs['independent_component_timecourse'] = op.abspath(prefix + "_sub01_timecourses_ica_s1_.nii")
+            outputs['stability_file'] = op.abspath(prefix + '_icasso.mat')
+            return outputs
 
         out_mask_image = op.abspath(prefix + 'Mask.img')
         parameter_mat_file = op.abspath(prefix + '_ica_parameter_info.mat')
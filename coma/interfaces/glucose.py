@@ -1,7 +1,199 @@
-def scale_PVC_matrix_fn(subject_id, in_file, dose, weight, delay, scan_time=15, isotope="F18", height=None, glycemie=None, scale_SUV_by_glycemia=True):
+import os
+import os.path as op
+import hashlib
+import numpy as np
+
+# Rate constants (1/min) and lumped constant of the FDG model
+K1 = 0.087
+K2 = 0.203
+K3 = 0.127
+LUMPED = 0.8
+
+# Half-life is in seconds
+HALF_LIVES = {"F18": 109.8 * 60, "C11": 20.334 * 60, "O15": 122.24, "N13": 9.97 * 60}
+
+_input_functions = {}
+_models = {}
+
+
+def standard_curve_file():
+    return op.join(os.environ["COMA_DIR"], 'etc', 'standard_cmrglc.txt')
+
+
+def cumulative_trapz(y, x):
+    '''
+    Running trapezoidal integral; element n equals np.trapz(y[:n+1], x[:n+1])
+    '''
+    out = np.zeros(len(y))
+    out[1:] = np.cumsum((x[1:] - x[:-1]) * (y[1:] + y[:-1]) / 2.0)
+    return out
+
+
+class StandardInputFunction(object):
+
+    """
+    Standard arterial input curve resampled every 0.1 min up to 90 min,
+    with running integrals so the model terms for any scan end time are
+    a lookup rather than a new integration.
+
+    """
+    def __init__(self, standard):
+        from scipy.interpolate import InterpolatedUnivariateSpline
+        self.standard = standard
+        t1 = standard[:, 0] / 60.0
+        self.ti = np.arange(t1[0], 90, 0.1)
+        spline = InterpolatedUnivariateSpline(t1, standard[:, 1])
+        self.ca_y = spline(self.ti)
+        self.auc = cumulative_trapz(self.ca_y, self.ti)
+        # exp(-(k2 + k3) * (T - t)) = exp(-(k2 + k3) * T) * exp((k2 + k3) * t)
+        self.weighted_auc = cumulative_trapz(
+            self.ca_y * np.exp((K2 + K3) * self.ti), self.ti)
+
+    def integrals(self, T):
+        '''
+        Integrals of the unscaled input curve and of the curve weighted by
+        exp(-(k2 + k3) * (T - t)) over the samples before T (T may be an array)
+        '''
+        T = np.asarray(T, dtype=np.float64)
+        last = np.searchsorted(self.ti, T, side='left') - 1
+        valid = last >= 0
+        last = np.clip(last, 0, len(self.ti) - 1)
+        auc = np.where(valid, self.auc[last], 0)
+        weighted = np.where(valid, np.exp(-(K2 + K3) * T) * self.weighted_auc[last], 0)
+        return auc, weighted
+
+
+def load_input_function(standard_file=None):
+    '''
+    Returns the StandardInputFunction of the curve in standard_file
+    (default: $COMA_DIR/etc/standard_cmrglc.txt), memoized on the hash
+    of the file contents
+    '''
+    if standard_file is None:
+        standard_file = standard_curve_file()
+    contents = open(standard_file, 'rb').read()
+    key = hashlib.sha1(contents).hexdigest()
+    if key not in _input_functions:
+        _input_functions[key] = StandardInputFunction(np.loadtxt(standard_file))
+    return key, _input_functions[key]
+
+
+def suv_factor(T, dose, weight, isotope="F18", height=None, glycemie=None):
+    '''
+    Factor converting activity to standardized uptake value. Works
+    elementwise on arrays.
+    '''
+    if isotope not in HALF_LIVES:
+        raise ValueError('Isotope must be one of %s' % ', '.join(sorted(HALF_LIVES)))
+    half_life = HALF_LIVES[isotope]
+    dose_mbq = np.asarray(dose, dtype=np.float64) * 37.0
+    weight = np.asarray(weight, dtype=np.float64)
+    if height is not None:
+        body_surface_area = 0.007184 * \
+            (weight ** 0.425 * np.asarray(height, dtype=np.float64) ** 0.725)  # DuBois formula
+        factor = np.power(2, (T / half_life)) / (dose_mbq / body_surface_area)
+    else:
+        factor = np.power(2, (T / half_life)) / (dose_mbq / (weight / 1000.))
+    if glycemie is not None:
+        factor = factor / glycemie
+    return factor
+
+
+def kinetic_parameters(input_function, T, dose, weight, glycemie):
+    '''
+    Slope and intercept scaling PET activity to the cerebral metabolic
+    rate of glucose, with the intermediate terms. Works elementwise on
+    arrays so a whole cohort is computed in one call.
+    '''
+    auc, weighted = input_function.integrals(T)
+    # Convert dose to megabecquerels (MBq)
+    dose_mbq = np.asarray(dose, dtype=np.float64) * 37.0
+    scale = 1000 * dose_mbq / np.asarray(weight, dtype=np.float64)
+
+    mecalc = K1 * weighted * scale
+    denom = auc * scale - mecalc / K1
+    cax2 = np.asarray(glycemie, dtype=np.float64) / 18.0 / LUMPED
+
+    slope = cax2 / denom
+    inter = -cax2 * mecalc / denom
+    return dict(slope=slope, intercept=inter, cax2=cax2, mecalc=mecalc, denom=denom)
+
+
+class GlucoseModel(object):
+
+    """
+    FDG kinetic model of one scan (end time T in minutes, dose in mCi,
+    weight in kg, glycemia in mg/dL). Use glucose_model() to get a
+    memoized instance.
+
+    """
+    def __init__(self, T, dose, weight, glycemie=None, standard_file=None):
+        self.T = T
+        self.dose = dose
+        self.dose_mbq = dose * 37.0
+        self.weight = weight
+        self.glycemie = glycemie
+        self.standard_hash, self.input_function = load_input_function(standard_file)
+        self.standard = self.input_function.standard
+        if glycemie is not None:
+            parameters = kinetic_parameters(self.input_function, T, dose, weight, glycemie)
+            for name, value in parameters.items():
+                setattr(self, name, float(value))
+
+    def cmr_glucose(self, data):
+        return data * self.slope + self.intercept
+
+    def suv_factor(self, isotope="F18", height=None, scale_by_glycemia=False):
+        glycemie = None
+        if scale_by_glycemia:
+            glycemie = self.glycemie
+        return suv_factor(self.T, self.dose, self.weight, isotope, height, glycemie)
+
+
+def glucose_model(delay, dose, weight, glycemie=None, scan_time=15, standard_file=None):
+    '''
+    Returns the GlucoseModel for these parameters, built once per process
+    for each standard curve
+    '''
+    T = delay + scan_time
+    standard_hash, _ = load_input_function(standard_file)
+    key = (standard_hash, T, dose, weight, glycemie)
+    if key not in _models:
+        _models[key] = GlucoseModel(T, dose, weight, glycemie, standard_file)
+    return _models[key]
+
+
+def cohort_glucose_parameters(data_file, isotope="F18", standard_file=None):
+    '''
+    Computes the glucose model parameters and SUV factors for every
+    subject of a cohort table in one vectorized call. The table has the
+    same columns as for return_subject_data: subject_id, dose, weight,
+    delay, glycemie, scan_time.
+    '''
+    import csv
+    f = open(data_file, 'r')
+    rows = [line for line in csv.reader(f) if line]
+    f.close()
+    subject_ids = [line[0] for line in rows]
+    values = np.array([[float(x) for x in line[1:6]] for line in rows])
+    dose, weight, delay, glycemie, scan_time = values.T
+    T = delay + scan_time
+    _, input_function = load_input_function(standard_file)
+    parameters = kinetic_parameters(input_function, T, dose, weight, glycemie)
+    parameters["subject_id"] = subject_ids
+    parameters["suv_factor"] = suv_factor(T, dose, weight, isotope)
+    parameters["suv_factor_glycemia"] = parameters["suv_factor"] / glycemie
+    return parameters
+
+
+def scale_PVC_matrix_fn(subject_id, in_file, dose, weight, delay, scan_time=15, isotope="F18", height=None, glycemie=None, scale_SUV_by_glycemia=True, cohort_store=None):
     '''
     Scales the NumPy results to calculate SUV and 
 
+    If cohort_store is a directory, the scaled values are also appended
+    to that cohort table (see coma.interfaces.cohort.CohortStore),
+    replacing the subject's rows from any previous run
+
         in_file: Nifti image (.nii, .nii.gz, or .img/.hdr)
         dose: milliCurie (mCi)
         weight: kilograms (kg)
@@ -14,74 +206,33 @@ def scale_PVC_matrix_fn(subject_id, in_file, dose, weight, delay, scan_time=15,
     import numpy as np
     import scipy.io as sio
 
+    from coma.interfaces.glucose import glucose_model, HALF_LIVES
+
     # Load matrix
     pvc = np.load(in_file)
 
-    T = delay + scan_time
-    k1 = 0.087
-    k2 = 0.203
-    k3 = 0.127
-    lumped = 0.8
-
-    # Convert dose to megabecquerels (MBq)
-    dose_mbq = dose * 37.0
-
-    std_txt_path = op.join(
-        os.environ["COMA_DIR"], 'etc', 'standard_cmrglc.txt')
-    standard = np.loadtxt(std_txt_path)
-    t1 = standard[:, 0] / 60.0
-    ti = np.arange(t1[0], 90, 0.1)
-
-    from scipy.interpolate import InterpolatedUnivariateSpline
-    spline = InterpolatedUnivariateSpline(t1, standard[:, 1])
-    ca_y = spline(ti)
-
-    t = ti[ti < T]
-
-    ca = ca_y[ti < T] * 1000 * dose_mbq / weight
-
-    cax = ca * np.exp(-(k2 + k3) * (T - t))
-
-    integral = np.trapz(cax, t)
-    mecalc = k1 * integral
-
-    auc = np.trapz(ca, t)
-
-    denom = auc - mecalc / k1
-    Ca = glycemie / 18.0
-    CAdivlumped = Ca / lumped
-    cax2 = CAdivlumped
-
-    slope = cax2 / denom
-    inter = -cax2 * mecalc / denom
-
+    model = glucose_model(delay, dose, weight, glycemie, scan_time)
+    slope = model.slope
+    inter = model.intercept
+    half_life = HALF_LIVES[isotope]
+    suv = model.suv_factor(isotope, height, scale_SUV_by_glycemia)
 
-    # Half-life is in seconds
-    if isotope == "F18":
-        half_life = 109.8 * 60
-    elif isotope == 'C11':
-        half_life = 20.334 * 60
-    elif isotope == 'O15':
-        half_life = 122.24
-    elif isotope == 'N13':
-        half_life = 9.97 * 60
-
-    methods = pvc.keys()
+    methods = list(pvc.keys())
     new_dict = {}
     new_dict["subject_id"] = subject_id
     new_dict["scale_SUV_by_glycemia"] = scale_SUV_by_glycemia
     new_dict["isotope"] = isotope
     new_dict["half_life"] = half_life
     new_dict["weight"] = weight
-    new_dict["assumed_AIF"] = standard
+    new_dict["assumed_AIF"] = model.standard
     new_dict["delay"] = delay
     new_dict["dose_mCi"] = dose
-    new_dict["dose_MBq"] = dose_mbq
+    new_dict["dose_MBq"] = model.dose_mbq
     new_dict["glycemia"] = glycemie
 
     if height is not None:
         body_surface_area = 0.007184 * \
-            (weight ^ 0.425 * height ^ 0.725)  # DuBois formula
+            (weight ** 0.425 * height ** 0.725)  # DuBois formula
         new_dict["height"] = height
         new_dict["body_surface_area"] = body_surface_area
 
@@ -101,140 +252,83 @@ def scale_PVC_matrix_fn(subject_id, in_file, dose, weight, delay, scan_time=15,
         
         AIF = data * slope + inter
         new_dict["AIF_"+ method] = AIF
-
-        if height is not None:
-            SUV = data * np.power(2, (T / half_life)) / \
-                (dose_mbq / body_surface_area)
-        else:
-            SUV = data * np.power(2, (T / half_life)) / \
-                (dose_mbq / (weight / 1000.))
-        if scale_SUV_by_glycemia:
-            SUV = SUV / glycemie
-        
-        new_dict["SUV_"+ method] = SUV
+        new_dict["SUV_"+ method] = data * suv
 
     out_matlab_mat = op.abspath(subject_id + "_PET_AIF_SUV_data.mat")
     out_npz = op.abspath(subject_id + "_PET_AIF_SUV_data.npz")
 
     sio.savemat(out_matlab_mat, new_dict)
     np.savez(out_npz, **new_dict)
+
+    if cohort_store is not None:
+        from coma.interfaces.cohort import CohortStore
+        CohortStore(cohort_store).append_results(out_npz, subject_id, replace=True)
     return out_npz, out_matlab_mat
 
 
 
-def CMR_glucose(subject_id, in_file, dose, weight, delay, glycemie, scan_time=15):
+def CMR_glucose(subject_id, in_file, dose, weight, delay, glycemie, scan_time=15, header_rescale=False):
     '''
     Scales an image to the calculated cerebral metabolic rate of glucose
     using a standard arterial input curve
 
-        in_file: Nifti image (.nii, .nii.gz, or .img/.hdr)
+        in_file: Nifti image (.nii, .nii.gz, or .img/.hdr), or a list of images
         dose: milliCurie (mCi)
         weight: kilograms (kg)
         delay: minutes (min)
         glycemie: milligrams / deciliter (mg/dL)
         scan_time: minutes (min)
+        header_rescale: only update scl_slope/scl_inter of NIfTI inputs
     '''
-    import os
     import os.path as op
-    import numpy as np
-    import nibabel as nb
-
-    T = delay + scan_time
-    k1 = 0.087
-    k2 = 0.203
-    k3 = 0.127
-    lumped = 0.8
+    from nipype.utils.filemanip import split_filename
+    from coma.interfaces.glucose import glucose_model
+    from coma.helpers import rescale_images
 
-    # Convert dose to megabecquerels (MBq)
-    dose_mbq = dose * 37.0
-
-    std_txt_path = op.join(
-        os.environ["COMA_DIR"], 'etc', 'standard_cmrglc.txt')
-    standard = np.loadtxt(std_txt_path)
-    t1 = standard[:, 0] / 60.0
-    ti = np.arange(t1[0], 90, 0.1)
-
-    from scipy.interpolate import InterpolatedUnivariateSpline
-    spline = InterpolatedUnivariateSpline(t1, standard[:, 1])
-    ca_y = spline(ti)
-
-    t = ti[ti < T]
-
-    ca = ca_y[ti < T] * 1000 * dose_mbq / weight
-
-    cax = ca * np.exp(-(k2 + k3) * (T - t))
+    model = glucose_model(delay, dose, weight, glycemie, scan_time)
 
-    integral = np.trapz(cax, t)
-    mecalc = k1 * integral
-
-    auc = np.trapz(ca, t)
-
-    denom = auc - mecalc / k1
-    Ca = glycemie / 18.0
-    CAdivlumped = Ca / lumped
-    cax2 = CAdivlumped
-
-    image = nb.load(in_file)
-    data = image.get_data()
-
-    slope = cax2 / denom
-    inter = -cax2 * mecalc / denom
+    if isinstance(in_file, list):
+        in_files = in_file
+        out_files = [op.abspath(subject_id + '_' + split_filename(f)[1] + '_CMRGLC2.nii.gz')
+                     for f in in_files]
+    else:
+        in_files = [in_file]
+        out_files = [op.abspath(subject_id + '_CMRGLC2.nii.gz')]
+    rescale_images(in_files, out_files, model.slope, model.intercept, header_rescale)
 
-    rescaled = data * slope + inter
-    rescaled_image = nb.Nifti1Image(
-        dataobj=rescaled, affine=image.get_affine())
-    out_file = op.abspath(subject_id + '_CMRGLC2.nii.gz')
-    nb.save(rescaled_image, out_file)
-    return out_file, cax2, mecalc, denom
+    out_file = out_files if isinstance(in_file, list) else out_files[0]
+    return out_file, model.cax2, model.mecalc, model.denom
 
 
-def calculate_SUV(subject_id, in_file, dose, weight, delay, scan_time=15, isotope="F18", height=None, glycemie=None):
+def calculate_SUV(subject_id, in_file, dose, weight, delay, scan_time=15, isotope="F18", height=None, glycemie=None, header_rescale=False):
     '''
     Calculates standardized uptake value
 
-        in_file: Nifti image (.nii, .nii.gz, or .img/.hdr)
+        in_file: Nifti image (.nii, .nii.gz, or .img/.hdr), or a list of images
         dose: milliCurie (mCi)
         weight: kilograms (kg)
         delay: minutes (min)
         scan_time: minutes (min)
         isotope: the radiotracer isotope. Must be one of "F18", "C11", "O15", or "N13".
         height: metres (optional, returns body body surface area SUV if provided)
+        header_rescale: only update scl_slope/scl_inter of NIfTI inputs
     '''
     import os.path as op
-    import numpy as np
-    import nibabel as nb
-
-    image = nb.load(in_file)
-    data = image.get_data()
-
-    # Half-life is in seconds
-    if isotope == "F18":
-        half_life = 109.8 * 60
-    elif isotope == 'C11':
-        half_life = 20.334 * 60
-    elif isotope == 'O15':
-        half_life = 122.24
-    elif isotope == 'N13':
-        half_life = 9.97 * 60
-
-    # Convert dose to megabecquerels (MBq)
-    dose_mbq = dose * 37.0
+    from nipype.utils.filemanip import split_filename
+    from coma.interfaces.glucose import suv_factor
+    from coma.helpers import rescale_images
 
-    T = delay + scan_time
+    factor = suv_factor(delay + scan_time, dose, weight, isotope, height, glycemie)
 
-    if height is not None:
-        body_surface_area = 0.007184 * \
-            (weight ^ 0.425 * height ^ 0.725)  # DuBois formula
-        SUV = data * np.power(2, (T / half_life)) / \
-            (dose_mbq / body_surface_area)
+    if isinstance(in_file, list):
+        in_files = in_file
+        out_files = [op.abspath(subject_id + '_' + split_filename(f)[1] + '_SUV.nii.gz')
+                     for f in in_files]
     else:
-        SUV = data * np.power(2, (T / half_life)) / \
-            (dose_mbq / (weight / 1000.))
+        in_files = [in_file]
+        out_files = [op.abspath(subject_id + '_SUV.nii.gz')]
+    rescale_images(in_files, out_files, float(factor), 0, header_rescale)
 
-    if glycemie is not None:
-        SUV = SUV / glycemie
-    
-    SUV_image = nb.Nifti1Image(dataobj=SUV, affine=image.get_affine())
-    out_file = op.abspath(subject_id + '_SUV.nii.gz')
-    nb.save(SUV_image, out_file)
-    return out_file
+    if isinstance(in_file, list):
+        return out_files
+    return out_files[0]
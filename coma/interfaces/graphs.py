@@ -9,6 +9,7 @@ import networkx as nx
 import scipy.io as sio
 from nipype.workflows.misc.utils import get_data_dims
 from nipype.interfaces.cmtk.nx import (remove_all_edges, add_node_data, add_edge_data)
+from .functional import get_roi_list, get_timecourse_by_region
 from nipype import logging
 iflogger = logging.getLogger('interface')
 
@@ -43,7 +44,11 @@ class CreateConnectivityThreshold(BaseInterface):
         number_of_nodes = len(rois)
         iflogger.info('Found {roi} unique region values'.format(roi=len(rois)))
 
-        if len(self.inputs.in_files) > 1:
+        if isdefined(self.inputs.in_file4d):
+            iflogger.info('Single four-dimensional image selected')
+            in_file4d = nb.load(self.inputs.in_file4d)
+            in_files = nb.four_to_three(in_file4d)
+        elif len(self.inputs.in_files) > 1:
             iflogger.info('Multiple input images detected')
             iflogger.info(len(self.inputs.in_files))
             in_files = self.inputs.in_files
@@ -57,10 +62,6 @@ class CreateConnectivityThreshold(BaseInterface):
                 # RELIES ON xyz_out.nii from recent resampling.
                 in_files = sorted(in_files, key=lambda x:
                                   int(x.split("_")[-2]))
-        elif isdefined(self.inputs.in_file4d):
-            iflogger.info('Single four-dimensional image selected')
-            in_file4d = nb.load(self.inputs.in_file4d)
-            in_files = nb.four_to_three(in_file4d)
         else:
             iflogger.info('Single functional image provided')
             in_files = self.inputs.in_files
@@ -73,9 +74,8 @@ class CreateConnectivityThreshold(BaseInterface):
 
         iflogger.info(np.shape(timecourse_at_each_node))
 
-        number_of_components = 30
-        number_of_images = 198
         time_course_data = time_course_image.get_data()
+        number_of_images, number_of_components = np.shape(time_course_data)[0:2]
         onerow = np.ones(number_of_images)
         time_course_per_IC = np.vstack((onerow.T, time_course_data.T)).T
         iflogger.info(np.shape(time_course_per_IC))
@@ -0,0 +1,196 @@
+from nipype.interfaces.base import (BaseInterface, traits,
+                                    File, TraitedSpec, InputMultiPath,
+                                    isdefined)
+import os.path as op
+import numpy as np
+import nibabel as nb
+import scipy.io as sio
+
+from ..helpers import iter_slabs, read_slab, uncompressed_images, read_frame_timing
+from .functional import get_functional_images, get_roi_list, regional_means
+from .glucose import load_input_function, cumulative_trapz, LUMPED
+
+from nipype import logging
+iflogger = logging.getLogger('interface')
+
+
+def read_input_function(input_file):
+    '''
+    Reads a measured plasma input curve: one row per sample with the
+    time in seconds and the activity. Returned with times in minutes,
+    starting from zero activity at time zero if the samples do not.
+    '''
+    samples = np.atleast_2d(np.loadtxt(input_file))
+    times = samples[:, 0] / 60.0
+    activity = samples[:, 1]
+    if times[0] > 0:
+        times = np.concatenate([[0], times])
+        activity = np.concatenate([[0], activity])
+    return times, activity
+
+
+def patlak_design(times, activity, mid_times):
+    '''
+    Patlak coordinates of each frame: the normalised time
+    int_0^t Cp / Cp(t) and the plasma activity Cp(t) at the frame mid time
+    '''
+    cumulative = cumulative_trapz(activity, times)
+    plasma = np.interp(mid_times, times, activity)
+    if np.any(plasma <= 0):
+        raise ValueError('The plasma input is not positive at every frame used in the fit')
+    normalised_time = np.interp(mid_times, times, cumulative) / plasma
+    return normalised_time, plasma
+
+
+def patlak_fit(tissue, normalised_time, plasma):
+    '''
+    Least-squares Patlak fit of many time-activity curves at once.
+    tissue is (curves x frames); the regression
+    C(t) / Cp(t) = Ki * normalised_time + V is solved for all curves
+    with one pseudo-inverse. Returns Ki and the intercept V.
+    '''
+    design = np.column_stack([normalised_time, np.ones(len(normalised_time))])
+    solution = np.dot(tissue / plasma, np.linalg.pinv(design).T)
+    return solution[:, 0], solution[:, 1]
+
+
+class PatlakAnalysisInputSpec(TraitedSpec):
+    in_files = InputMultiPath(File(exists=True), xor=['in_file4d'],
+                              desc='Dynamic PET frames as a set of 3-dimensional images')
+    in_file4d = File(exists=True, xor=['in_files'],
+                     desc='Dynamic PET frames as a 4-dimensional image')
+    frame_timing_file = File(exists=True, mandatory=True,
+                             desc='Frame start times and durations: a BIDS .json sidecar or a two-column '
+                             'text file in seconds')
+    input_function_file = File(exists=True, desc='Measured plasma input (time in seconds, activity). '
+                               'Defaults to the population curve in standard_cmrglc.txt')
+    standard_file = File(exists=True, desc='Population input curve (default: $COMA_DIR/etc/standard_cmrglc.txt)')
+    dose = traits.Float(desc='Injected dose (mCi), required to scale the population input curve')
+    weight = traits.Float(desc='Body weight (kg), required to scale the population input curve')
+    glycemie = traits.Float(desc='Plasma glucose (mg/dL). If given, a CMRglc image is also written.')
+    start_time = traits.Float(10, usedefault=True,
+                              desc='Start of the linear phase (min); frames whose mid time is later are fitted')
+    mask_file = File(exists=True, desc='Voxels to fit. Defaults to every voxel.')
+    segmentation_file = File(exists=True, desc='Regions for which the mean time-activity curves are fitted')
+    slices_per_slab = traits.Int(8, usedefault=True, desc='Number of slices processed at a time')
+    out_prefix = traits.Str('patlak', usedefault=True, desc='Prefix of the output files')
+
+
+class PatlakAnalysisOutputSpec(TraitedSpec):
+    ki_file = File(desc='Voxelwise net influx rate Ki (1/min)')
+    intercept_file = File(desc='Voxelwise Patlak intercept')
+    cmr_glucose_file = File(desc='Voxelwise metabolic rate of glucose, when glycemie is given')
+    stats_file = File(desc='Regional time-activity curves and Patlak fits saved as a Matlab .mat')
+
+
+class PatlakAnalysis(BaseInterface):
+
+    """
+    Voxelwise Patlak graphical analysis of dynamic FDG-PET. The
+    regressions of all voxels over the linear-phase frames are solved
+    together with one pseudo-inverse, a slab of slices at a time. If a
+    segmentation is given, the regional mean curves are fitted as well.
+
+    Example
+    -------
+
+    >>> import coma.interfaces as ci
+    >>> patlak = ci.PatlakAnalysis()
+    >>> patlak.inputs.in_file4d = 'dynamic_pet.nii'
+    >>> patlak.inputs.frame_timing_file = 'dynamic_pet.json'
+    >>> patlak.inputs.input_function_file = 'plasma.txt'
+    >>> patlak.run() # doctest: +SKIP
+    """
+    input_spec = PatlakAnalysisInputSpec
+    output_spec = PatlakAnalysisOutputSpec
+
+    def _plasma_input(self):
+        if isdefined(self.inputs.input_function_file):
+            return read_input_function(self.inputs.input_function_file)
+        if not (isdefined(self.inputs.dose) and isdefined(self.inputs.weight)):
+            raise ValueError('The dose and weight are required to scale the population input curve')
+        standard_file = None
+        if isdefined(self.inputs.standard_file):
+            standard_file = self.inputs.standard_file
+        _, input_function = load_input_function(standard_file)
+        # Convert dose to megabecquerels (MBq)
+        scale = 1000 * self.inputs.dose * 37.0 / self.inputs.weight
+        return input_function.ti, input_function.ca_y * scale
+
+    def _run_interface(self, runtime):
+        if not (isdefined(self.inputs.in_file4d) or isdefined(self.inputs.in_files)):
+            raise ValueError('Dynamic PET frames must be provided')
+        images = get_functional_images(self.inputs)
+        shape = images[0].shape[:3]
+        n_frames = len(images) if len(images) > 1 else images[0].shape[3]
+
+        start, duration = read_frame_timing(self.inputs.frame_timing_file)
+        if len(start) != n_frames:
+            raise ValueError('The timing file describes {t} frames but the image has {n}'.format(
+                t=len(start), n=n_frames))
+        mid_times = start + duration / 2.0
+        linear = mid_times >= self.inputs.start_time
+        if linear.sum() < 2:
+            raise ValueError('At least two frames must start after {s} min'.format(s=self.inputs.start_time))
+        iflogger.info('Fitting {n} frames from {t:.1f} min'.format(n=linear.sum(), t=mid_times[linear][0]))
+
+        times, activity = self._plasma_input()
+        normalised_time, plasma = patlak_design(times, activity, mid_times[linear])
+
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = nb.load(self.inputs.mask_file).get_data().reshape(shape) > 0
+        ki = np.zeros(shape, dtype=np.float32)
+        intercept = np.zeros(shape, dtype=np.float32)
+        tacs = None
+        with uncompressed_images(images) as frames:
+            for slab in iter_slabs(shape, self.inputs.slices_per_slab):
+                data = read_slab(frames, slab)[..., linear]
+                slab_ki, slab_intercept = patlak_fit(data.reshape(-1, data.shape[-1]),
+                                                     normalised_time, plasma)
+                ki[:, :, slab] = slab_ki.reshape(data.shape[:3])
+                intercept[:, :, slab] = slab_intercept.reshape(data.shape[:3])
+            # The regional curves are read while the uncompressed frames exist
+            if isdefined(self.inputs.segmentation_file):
+                rois = get_roi_list(self.inputs.segmentation_file)
+                segmentationdata = nb.load(self.inputs.segmentation_file).get_data().reshape(shape)
+                tacs, voxels = regional_means(frames, segmentationdata, rois,
+                                              self.inputs.slices_per_slab)
+        if mask is not None:
+            ki[~mask] = 0
+            intercept[~mask] = 0
+
+        affine = images[0].get_affine()
+        nb.save(nb.Nifti1Image(ki, affine), self._out_file('Ki'))
+        nb.save(nb.Nifti1Image(intercept, affine), self._out_file('intercept'))
+        if isdefined(self.inputs.glycemie):
+            cmr = ki * (self.inputs.glycemie / 18.0 / LUMPED)
+            nb.save(nb.Nifti1Image(cmr.astype(np.float32), affine), self._out_file('CMRGLC'))
+
+        if tacs is not None:
+            roi_ki, roi_intercept = patlak_fit(tacs[:, linear], normalised_time, plasma)
+            stats = {}
+            stats['rois'] = rois
+            stats['number_of_voxels'] = voxels
+            stats['func_mean'] = tacs
+            stats['frame_mid_times'] = mid_times
+            stats['patlak_time'] = normalised_time
+            stats['Ki'] = roi_ki
+            stats['intercept'] = roi_intercept
+            if isdefined(self.inputs.glycemie):
+                stats['CMRGLC'] = roi_ki * (self.inputs.glycemie / 18.0 / LUMPED)
+            sio.savemat(self._out_file('stats', '.mat'), stats)
+        return runtime
+
+    def _out_file(self, name, ext='.nii.gz'):
+        return op.abspath('{p}_{n}{e}'.format(p=self.inputs.out_prefix, n=name, e=ext))
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['ki_file'] = self._out_file('Ki')
+        outputs['intercept_file'] = self._out_file('intercept')
+        if isdefined(self.inputs.glycemie):
+            outputs['cmr_glucose_file'] = self._out_file('CMRGLC')
+        if isdefined(self.inputs.segmentation_file):
+            outputs['stats_file'] = self._out_file('stats', '.mat')
+        return outputs
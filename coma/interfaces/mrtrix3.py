@@ -1,15 +1,126 @@
-def inclusion_filtering_mrtrix3(track_file, roi_file, fa_file, md_file, roi_names=None, registration_image_file=None, registration_matrix_file=None, prefix=None, tdi_threshold=10):
+import numpy as np
+import nibabel as nb
+
+
+def tdi_statistics(tdi, fa, md, tdi_threshold, voxel_volume):
+    '''
+    Returns the track volume in mm3 and the mean TDI above tdi_threshold,
+    and the mean FA and MD within the thresholded TDI, as the
+    fslstats -l <thr> -V / -l <thr> -M / -M calls on the TDI and on the
+    masked FA and MD images
+    '''
+    def nonzero_mean(values):
+        values = values[values != 0]
+        if len(values) == 0:
+            return 0.
+        return float(values.mean())
+    above = tdi > tdi_threshold
+    mask = tdi >= tdi_threshold
+    track_volume = np.count_nonzero(above) * voxel_volume
+    mean_tdi = nonzero_mean(tdi[above])
+    return nonzero_mean(fa[mask]), nonzero_mean(md[mask]), mean_tdi, track_volume
+
+
+def pair_tract_statistics(track_file, fa_image, fa_data, md_data, tdi_threshold,
+                          out_tdi_vol_name, out_fa_name, out_md_name):
+    '''
+    Computes the track density of one pair's streamlines on the FA grid and
+    its statistics (see tdi_statistics) in process, replacing the
+    Tracks2Prob, ImageMaths, MultiImageMaths and ImageStats nodes. The
+    binarised TDI and the masked FA and MD images are written when the
+    track volume is not zero.
+    '''
+    from coma.interfaces.streamlines import track_density
+    tdi = track_density(track_file, fa_image.get_filename())
+    voxel_volume = float(np.prod(fa_image.get_header().get_zooms()[0:3]))
+    mean_fa, mean_md, mean_tdi, track_volume = tdi_statistics(
+        tdi, fa_data, md_data, tdi_threshold, voxel_volume)
+    if track_volume > 0:
+        mask = tdi >= tdi_threshold
+        header = fa_image.get_header().copy()
+        header.set_data_dtype(np.int16)
+        nb.save(nb.Nifti1Image(mask.astype(np.int16), fa_image.get_affine(), header),
+                out_tdi_vol_name)
+        header.set_data_dtype(np.float32)
+        for data, out_file in ((fa_data, out_fa_name), (md_data, out_md_name)):
+            nb.save(nb.Nifti1Image((data * mask).astype(np.float32),
+                                   fa_image.get_affine(), header), out_file)
+    return mean_fa, mean_md, mean_tdi, track_volume
+
+
+def external_pair_tract_statistics(args):
+    '''
+    Runs Tracks2Prob, fslmaths and fslstats on the streamlines of one pair
+    and returns the same values as pair_tract_statistics. Takes one tuple
+    of arguments so that it can be mapped over a multiprocessing Pool.
+    '''
+    (track_file, fa_file, md_file, tdi_threshold, out_tdi_name,
+        out_tdi_vol_name, out_fa_name, out_md_name) = args
+    import nipype.interfaces.fsl as fsl
+    import nipype.interfaces.mrtrix as mrtrix
+
+    tracks2tdi = mrtrix.Tracks2Prob(in_file=track_file, template_file=fa_file,
+        out_filename=out_tdi_name, output_datatype="Int16")
+    tdi = tracks2tdi.run().outputs.tract_image
+    binarize_tdi = fsl.ImageMaths(in_file=tdi, op_string="-thr %d -bin" % tdi_threshold,
+        out_file=out_tdi_vol_name)
+    tdi_bin = binarize_tdi.run().outputs.out_file
+
+    means = []
+    for image_file, out_file in ((fa_file, out_fa_name), (md_file, out_md_name)):
+        mask = fsl.MultiImageMaths(in_file=tdi_bin, op_string="-mul %s",
+            operand_files=[image_file], out_file=out_file)
+        masked = mask.run().outputs.out_file
+        means.append(fsl.ImageStats(in_file=masked, op_string='-M').run().outputs.out_stat)
+
+    mean_tdi = fsl.ImageStats(in_file=tdi, op_string='-l %d -M' % tdi_threshold).run().outputs.out_stat
+    track_volume = fsl.ImageStats(in_file=tdi, op_string='-l %d -V' % tdi_threshold).run().outputs.out_stat
+    # First value is in voxels, 2nd is in volume
+    return means[0], means[1], mean_tdi, track_volume[1]
+
+
+def run_pair_tract_statistics(jobs, fa_file, md_file, tdi_threshold, engine="native", n_procs=None):
+    '''
+    Returns (mean FA, mean MD, mean TDI, track volume) for every job, a job
+    being (track_file, out_tdi_name, out_tdi_vol_name, out_fa_name,
+    out_md_name). The "native" engine computes them in process with the FA
+    and MD images loaded once; the "external" engine runs the MRtrix and
+    FSL tools for each pair on a pool of n_procs processes (all cores by
+    default).
+    '''
+    if engine == "native":
+        fa_image = nb.load(fa_file)
+        fa_data = fa_image.get_data()
+        md_data = nb.load(md_file).get_data()
+        return [pair_tract_statistics(track_file, fa_image, fa_data, md_data, tdi_threshold,
+                                      out_tdi_vol_name, out_fa_name, out_md_name)
+                for track_file, _, out_tdi_vol_name, out_fa_name, out_md_name in jobs]
+    elif engine != "external":
+        raise ValueError('Unknown engine: %s' % engine)
+
+    import multiprocessing
+    args = [(job[0], fa_file, md_file, tdi_threshold) + tuple(job[1:]) for job in jobs]
+    if n_procs == 1 or len(args) < 2:
+        return [external_pair_tract_statistics(a) for a in args]
+    pool = multiprocessing.Pool(n_procs)
+    try:
+        return pool.map(external_pair_tract_statistics, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def inclusion_filtering_mrtrix3(track_file, roi_file, fa_file, md_file, roi_names=None, registration_image_file=None, registration_matrix_file=None, prefix=None, tdi_threshold=10, engine="native", n_procs=None, n_nodes=100):
     import os
     import os.path as op
     import numpy as np
-    import glob
     from coma.workflows.dmn import get_rois, save_heatmap
     from coma.interfaces.dti import write_trackvis_scene
-    import nipype.pipeline.engine as pe
-    import nipype.interfaces.fsl as fsl
-    import nipype.interfaces.mrtrix as mrtrix
-    import nipype.interfaces.diffusion_toolkit as dtk
+    from coma.interfaces.streamlines import convert_tractogram, merge_tractograms, extract_pair_tracks
+    from coma.interfaces.streamlines import tract_profile, label_centroids
+    from coma.interfaces.mrtrix3 import run_pair_tract_statistics
     from nipype.utils.filemanip import split_filename
+    import nibabel as nb
     import subprocess
     import shutil
 
@@ -34,140 +145,85 @@ def inclusion_filtering_mrtrix3(track_file, roi_file, fa_file, md_file, roi_name
         "-metric", "invlength_invnodevolume",
         track_file, roi_file, invLen_invVol_out_matrix])
 
-    subprocess.call(["tcknodeextract", "-assignment_voxel_lookup",
-        track_file, roi_file, prefix + "_"])
+    # All pairs in one pass over the tracks (as tcknodeextract -assignment_voxel_lookup)
+    pair_files = {}
+    for idx_i, roi_i in enumerate(rois):
+        for idx_j, roi_j in enumerate(rois):
+            if idx_j >= idx_i:
+                pair_files[(roi_i, roi_j)] = op.abspath(prefix + "_%s-%s.tck" % (roi_i, roi_j))
+    extract_pair_tracks(track_file, roi_file, pair_files)
 
     fa_matrix_thr = np.zeros((len(rois), len(rois)))
     md_matrix_thr = np.zeros((len(rois), len(rois)))
     tdi_matrix = np.zeros((len(rois), len(rois)))
     track_volume_matrix = np.zeros((len(rois), len(rois)))
 
-    out_files = []
-    track_files = []
+    pairs = []
+    jobs = []
     for idx_i, roi_i in enumerate(rois):
         for idx_j, roi_j in enumerate(rois):
             if idx_j >= idx_i:
-
-                filtered_tracks = glob.glob(op.abspath(prefix + "_%s-%s.tck" % (roi_i, roi_j)))[0]
-                print(filtered_tracks)
-
                 if roi_names is None:
-                    roi_i = str(int(roi_i))
-                    roi_j = str(int(roi_j))
-                    idpair = "%s_%s" % (roi_i, roi_j)
+                    idpair = "%s_%s" % (str(int(roi_i)), str(int(roi_j)))
                     idpair = idpair.replace(".","-")
                 else:
-                    roi_name_i = roi_names[idx_i]
-                    roi_name_j = roi_names[idx_j]
-                    idpair = "%s_%s" % (roi_name_i, roi_name_j)
+                    idpair = "%s_%s" % (roi_names[idx_i], roi_names[idx_j])
 
-                tracks2tdi = pe.Node(interface=mrtrix.Tracks2Prob(), name='tdi_%s' % idpair)
-                tracks2tdi.inputs.template_file = fa_file
-                tracks2tdi.inputs.in_file = filtered_tracks
+                filtered_tracks = pair_files[(roi_i, roi_j)]
                 out_tdi_name = op.abspath("%s_TDI_%s.nii.gz" % (prefix, idpair))
-                tracks2tdi.inputs.out_filename = out_tdi_name
-                tracks2tdi.inputs.output_datatype = "Int16"
-
-                binarize_tdi = pe.Node(interface=fsl.ImageMaths(), name='binarize_tdi_%s' % idpair)
-                binarize_tdi.inputs.op_string = "-thr %d -bin" % tdi_threshold
                 out_tdi_vol_name = op.abspath("%s_TDI_bin_%d_%s.nii.gz" % (prefix, tdi_threshold, idpair))
-                binarize_tdi.inputs.out_file = out_tdi_vol_name
-
-                mask_fa = pe.Node(interface=fsl.MultiImageMaths(), name='mask_fa_%s' % idpair)
-                mask_fa.inputs.op_string = "-mul %s"
-                mask_fa.inputs.operand_files = [fa_file]
                 out_fa_name = op.abspath("%s_FA_%s.nii.gz" % (prefix, idpair))
-                mask_fa.inputs.out_file = out_fa_name
-
-                mask_md = mask_fa.clone(name='mask_md_%s' % idpair)
-                mask_md.inputs.operand_files = [md_file]
                 out_md_name = op.abspath("%s_MD_%s.nii.gz" % (prefix, idpair))
-                mask_md.inputs.out_file = out_md_name
-
-                mean_fa = pe.Node(interface=fsl.ImageStats(op_string = '-M'), name = 'mean_fa_%s' % idpair) 
-                mean_md = pe.Node(interface=fsl.ImageStats(op_string = '-M'), name = 'mean_md_%s' % idpair)
-                mean_tdi = pe.Node(interface=fsl.ImageStats(op_string = '-l %d -M' % tdi_threshold), name = 'mean_tdi_%s' % idpair)
-                track_volume = pe.Node(interface=fsl.ImageStats(op_string = '-l %d -V' % tdi_threshold), name = 'track_volume_%s' % idpair)
-
-                tck2trk = mrtrix.MRTrix2TrackVis()
-                tck2trk.inputs.image_file = fa_file
-                tck2trk.inputs.in_file = filtered_tracks
-                trk_file = op.abspath("%s_%s.trk" % (prefix, idpair))
-                tck2trk.inputs.out_filename = trk_file
-                tck2trk.base_dir = op.abspath(".")
-
-                if registration_image_file is not None and registration_matrix_file is not None:
-                    tck2trk.inputs.registration_image_file = registration_image_file
-                    tck2trk.inputs.matrix_file = registration_matrix_file
-
-                workflow = pe.Workflow(name=idpair)
-                workflow.base_dir = op.abspath(idpair)
-
-                workflow.connect(
-                    [(tracks2tdi, binarize_tdi, [("tract_image", "in_file")])])
-                workflow.connect(
-                    [(binarize_tdi, mask_fa, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(binarize_tdi, mask_md, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(mask_fa, mean_fa, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(mask_md, mean_md, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(tracks2tdi, mean_tdi, [("tract_image", "in_file")])])
-                workflow.connect(
-                    [(tracks2tdi, track_volume, [("tract_image", "in_file")])])
-
-                workflow.config['execution'] = {'remove_unnecessary_outputs': 'false',
-                                                   'hash_method': 'timestamp'}
-                result = workflow.run()
-                tck2trk.run()
-
-                fa_masked = glob.glob(out_fa_name)[0]
-                md_masked = glob.glob(out_md_name)[0]
-
-                if roi_names is not None:
-                    tracks = op.abspath(prefix + "_%s-%s.tck" % (roi_name_i, roi_name_j))
-                    shutil.move(filtered_tracks, tracks)
-                else:
-                    tracks = filtered_tracks
-
-                tdi = glob.glob(out_tdi_vol_name)[0]
-
-                nodes = result.nodes()
-                node_names = [s.name for s in nodes]
-                
-                mean_fa_node = [nodes[idx] for idx, s in enumerate(node_names) if "mean_fa" in s][0]
-                mean_fa = mean_fa_node.result.outputs.out_stat
-                
-                mean_md_node = [nodes[idx] for idx, s in enumerate(node_names) if "mean_md" in s][0]
-                mean_md = mean_md_node.result.outputs.out_stat
-                
-                mean_tdi_node = [nodes[idx] for idx, s in enumerate(node_names) if "mean_tdi" in s][0]
-                mean_tdi = mean_tdi_node.result.outputs.out_stat
-                
-                track_volume_node = [nodes[idx] for idx, s in enumerate(node_names) if "track_volume" in s][0]
-                track_volume = track_volume_node.result.outputs.out_stat[1] # First value is in voxels, 2nd is in volume
-
-                if track_volume == 0:
-                    os.remove(fa_masked)
-                    os.remove(md_masked)
-                    os.remove(tdi)
-                else:
-                    out_files.append(md_masked)
-                    out_files.append(fa_masked)
-                    out_files.append(tracks)
-                    out_files.append(tdi)
-                
-                if op.exists(trk_file):
-                    out_files.append(trk_file)
-                    track_files.append(trk_file)
-
-                assert(0 <= mean_fa < 1)
-                fa_matrix_thr[idx_i, idx_j] = mean_fa
-                md_matrix_thr[idx_i, idx_j] = mean_md
-                tdi_matrix[idx_i, idx_j] = mean_tdi
-                track_volume_matrix[idx_i, idx_j] = track_volume
+                pairs.append((idx_i, idx_j, idpair))
+                jobs.append((filtered_tracks, out_tdi_name, out_tdi_vol_name, out_fa_name, out_md_name))
+
+    results = run_pair_tract_statistics(jobs, fa_file, md_file, tdi_threshold, engine, n_procs)
+
+    # Along-tract FA and MD profiles, running from ROI i to ROI j
+    fa_image = nb.load(fa_file)
+    fa_data = fa_image.get_data()
+    md_data = nb.load(md_file).get_data()
+    centroids = label_centroids(roi_file, rois)
+    fa_profiles = np.zeros((len(pairs), n_nodes))
+    md_profiles = np.zeros((len(pairs), n_nodes))
+
+    out_files = []
+    track_files = []
+    for idx_pair, ((idx_i, idx_j, idpair), job, result) in enumerate(zip(pairs, jobs, results)):
+        filtered_tracks, _, tdi, fa_masked, md_masked = job
+        mean_fa, mean_md, mean_tdi, track_volume = result
+        fa_profiles[idx_pair], md_profiles[idx_pair] = tract_profile(filtered_tracks,
+            fa_image.get_affine(), [fa_data, md_data], n_nodes, start_point=centroids[idx_i])
+
+        trk_file = op.abspath("%s_%s.trk" % (prefix, idpair))
+        convert_tractogram(filtered_tracks, trk_file, fa_file,
+            registration_image_file, registration_matrix_file)
+
+        if roi_names is not None:
+            tracks = op.abspath(prefix + "_%s-%s.tck" % (roi_names[idx_i], roi_names[idx_j]))
+            shutil.move(filtered_tracks, tracks)
+        else:
+            tracks = filtered_tracks
+
+        if track_volume == 0:
+            for empty_file in (fa_masked, md_masked, tdi):
+                if op.exists(empty_file):
+                    os.remove(empty_file)
+        else:
+            out_files.append(md_masked)
+            out_files.append(fa_masked)
+            out_files.append(tracks)
+            out_files.append(tdi)
+
+        if op.exists(trk_file):
+            out_files.append(trk_file)
+            track_files.append(trk_file)
+
+        assert(0 <= mean_fa < 1)
+        fa_matrix_thr[idx_i, idx_j] = mean_fa
+        md_matrix_thr[idx_i, idx_j] = mean_md
+        tdi_matrix[idx_i, idx_j] = mean_tdi
+        track_volume_matrix[idx_i, idx_j] = track_volume
 
 
     fa_matrix = np.loadtxt(fa_out_matrix)
@@ -188,7 +244,9 @@ def inclusion_filtering_mrtrix3(track_file, roi_file, fa_file, md_file, roi_name
         _, prefix, _ = split_filename(track_file)
         npz_data = op.abspath("%s_connectivity.npz" % prefix)
     np.savez(npz_data, fa=fa_matrix, md=md_matrix, tdi=tdi_matrix, trkvol=track_volume_matrix,
-        fa_thr=fa_matrix_thr, md_thr=md_matrix_thr, invLen_invVol=invLen_invVol_matrix)
+        fa_thr=fa_matrix_thr, md_thr=md_matrix_thr, invLen_invVol=invLen_invVol_matrix,
+        fa_profile=fa_profiles, md_profile=md_profiles,
+        profile_pairs=np.array([pair[0:2] for pair in pairs], dtype=int).reshape(-1, 2))
 
 
     print("Saving heatmaps...")
@@ -214,10 +272,7 @@ def inclusion_filtering_mrtrix3(track_file, roi_file, fa_file, md_file, roi_name
 
     out_merged_file = op.abspath('%s_MergedTracks.trk' % prefix)
     skip = 80.
-    track_merge = pe.Node(interface=dtk.TrackMerge(), name='track_merge')
-    track_merge.inputs.track_files = track_files
-    track_merge.inputs.output_file = out_merged_file
-    track_merge.run()
+    merge_tractograms(track_files, out_merged_file)
 
     track_names = []
     for t in track_files:
@@ -9,11 +9,12 @@ from string import Template
 import nibabel as nb
 import glob
 import logging
+import multiprocessing
 import numpy as np
 import random
 import shutil
 import scipy.io as sio
-from ..helpers import analyze_to_nifti, nifti_to_analyze, switch_datatype
+from ..helpers import analyze_to_nifti, nifti_to_analyze
 logging.basicConfig()
 iflogger = logging.getLogger('interface')
 
@@ -48,23 +49,24 @@ def parse_pve_results(results_text_file):
     return out_data
 
 
-def fix_roi_values_freesurferLUT(roi_image, white_matter_file, csf_file, prob_thresh):    
-    from coma.helpers import wm_labels_only, csf_labels_only, prepare_for_uint8
-    _, name, _ = split_filename(roi_image)
+def save_label_image(data, like_image, in_file, suffix):
+    '''
+    Saves data as uint8 with the geometry of like_image, named after in_file
+    '''
+    label_image = nb.Nifti1Image(
+        dataobj=data.astype(np.uint8), affine=like_image.get_affine(), header=like_image.get_header())
+    label_image.set_data_dtype(np.uint8)
+    _, name, _ = split_filename(in_file)
+    out_file = op.abspath(name + suffix)
+    nb.save(label_image, out_file)
+    return out_file
 
-    white_matter_default = 2
-    csf_default = 3
 
-    # Get regions labelled white and csf
-    wm_label_file = op.abspath(name + "_WM.nii.gz")
-    wm_only = wm_labels_only(roi_image, out_filename=wm_label_file)
-    wm_label_image = nb.load(wm_only)
-    wm_labels = wm_label_image.get_data()
+def fix_roi_values_freesurferLUT(roi_image, white_matter_file, csf_file, prob_thresh):
+    from coma.helpers import WM_LABELS, CSF_LABELS, prepare_for_uint8
 
-    csf_label_file = op.abspath(name + "_CSF.nii.gz")
-    csf_only = csf_labels_only(roi_image, out_filename=csf_label_file)
-    csf_label_image = nb.load(csf_only)
-    csf_labels = csf_label_image.get_data()
+    white_matter_default = 2
+    csf_default = 3
 
     wm_image = nb.load(white_matter_file)
     wm_data = wm_image.get_data()
@@ -75,54 +77,42 @@ def fix_roi_values_freesurferLUT(roi_image, white_matter_file, csf_file, prob_th
     data = image.get_data()
 
     assert(data.shape == wm_data.shape == csf_data.shape)
-    data[np.where(wm_labels > 0)] = white_matter_default
-    data[np.where(csf_labels > 0)] = csf_default
-
-    # Be careful with the brackets here. & takes priority over comparisons
-    data[np.where((wm_data > prob_thresh) & (data == 0))] = white_matter_default
-    data[np.where((csf_data > prob_thresh) & (data == 0))] = csf_default
-
-    wm_labels[np.where(data == white_matter_default)] = 1
-    wm_labels[np.where(data == csf_default)] = 0
-    wm_labels[np.where(data == 0)] = 0
-    wm_labels = wm_labels.astype(np.uint8)
-
-    new_wm_label_image = nb.Nifti1Image(
-        dataobj=wm_labels, affine=wm_image.get_affine(), header=wm_image.get_header())
-    new_wm_label_image.set_data_dtype(np.uint8)
-    _, name, _ = split_filename(white_matter_file)
-    wm_label_file = op.abspath(name + "_fixedWM.nii.gz")
-    nb.save(new_wm_label_image, wm_label_file)
-
-    csf_data[np.where(data != csf_default)] = 0
-    csf_data[np.where(csf_labels > 0)] = 1
-
-    csf_data = csf_data.astype(np.uint8)
-    csf_label_image = nb.Nifti1Image(
-        dataobj=csf_data, affine=csf_image.get_affine(), header=csf_image.get_header())
-    csf_label_image.set_data_dtype(np.uint8)
-    _, name, _ = split_filename(csf_file)
-    csf_label_file = op.abspath(name + "_fixedCSF.nii.gz")
-    nb.save(csf_label_image, csf_label_file)
 
-    hdr = image.get_header()
+    # Regions labelled white matter and CSF are found through a lookup
+    # table over the unique labels rather than one pass per label
+    labels, inverse = np.unique(data, return_inverse=True)
+    is_wm_label = np.in1d(labels, WM_LABELS)
+    is_csf_label = np.in1d(labels, CSF_LABELS)
+    csf_labels = is_csf_label[inverse].reshape(data.shape)
+    lut = labels.copy()
+    lut[is_wm_label] = white_matter_default
+    lut[is_csf_label] = csf_default
+    data = lut[inverse].reshape(data.shape)
+
+    # Unlabelled voxels are assigned from the probability maps, WM first
+    unlabelled = data == 0
+    wm_fill = unlabelled & (wm_data > prob_thresh)
+    data[wm_fill] = white_matter_default
+    data[unlabelled & ~wm_fill & (csf_data > prob_thresh)] = csf_default
+
+    wm_label_file = save_label_image(
+        data == white_matter_default, wm_image, white_matter_file, "_fixedWM.nii.gz")
+
+    csf_fixed = np.where(data == csf_default, csf_data, 0)
+    csf_fixed[csf_labels] = 1
+    csf_label_file = save_label_image(
+        csf_fixed, csf_image, csf_file, "_fixedCSF.nii.gz")
 
     data_uint8, remap_dict = prepare_for_uint8(data, ignore=range(0, 3))
     data_uint8 = data_uint8.astype(np.uint8)
-    data_uint8[np.where(data == csf_default)] = csf_default
-    data_uint8[np.where(data == white_matter_default)] = white_matter_default
-
-    fixed = nb.Nifti1Image(
-        dataobj=data_uint8, affine=image.get_affine(), header=hdr)
-    _, name, _ = split_filename(roi_image)
-    fixed.set_data_dtype(np.uint8)
-    fixed_roi_image = op.abspath(name + "_fixedROIs.nii.gz")
-    nb.save(fixed, fixed_roi_image)
+    data_uint8[data == csf_default] = csf_default
+
+    fixed_roi_image = save_label_image(
+        data_uint8, image, roi_image, "_fixedROIs.nii.gz")
     return fixed_roi_image, wm_label_file, csf_label_file, remap_dict
 
 def fix_roi_values_noLUT(roi_image, gm_file, white_matter_file, csf_file, prob_thresh):
     from coma.helpers import prepare_for_uint8
-    _, name, _ = split_filename(roi_image)
 
     white_matter_default = 2
     csf_default = 3
@@ -141,50 +131,33 @@ def fix_roi_values_noLUT(roi_image, gm_file, white_matter_file, csf_file, prob_t
 
     data_uint8, remap_dict = prepare_for_uint8(data, ignore=[0])
     data_uint8 = data_uint8.astype(np.uint8)
-    data_uint8[np.where(data_uint8 == csf_default)] = csf_default
-    data_uint8[np.where(data_uint8 == white_matter_default)] = white_matter_default
-
-    # Be careful with the brackets here. & takes priority over comparisons
-    data_uint8[np.where((wm_data > prob_thresh) & (data_uint8 == 0))] = white_matter_default
-    data_uint8[np.where((csf_data > prob_thresh) & (data_uint8 == 0))] = csf_default
-
-    wm_data[np.where(data_uint8 == white_matter_default)] = 1
-    wm_data[np.where(data_uint8 == csf_default)] = 0
-    wm_data[np.where(data_uint8 == 0)] = 0
-    wm_data = wm_data.astype(np.uint8)
 
-    new_wm_label_image = nb.Nifti1Image(
-        dataobj=wm_data, affine=wm_image.get_affine(), header=wm_image.get_header())
-    new_wm_label_image.set_data_dtype(np.uint8)
-    _, name, _ = split_filename(white_matter_file)
-    wm_label_file = op.abspath(name + "_fixedWM.nii.gz")
-    nb.save(new_wm_label_image, wm_label_file)
-
-    csf_data[np.where(data_uint8 != csf_default)] = 0
-    csf_data = csf_data.astype(np.uint8)
-    csf_label_image = nb.Nifti1Image(
-        dataobj=csf_data, affine=csf_image.get_affine(), header=csf_image.get_header())
-    csf_label_image.set_data_dtype(np.uint8)
-    _, name, _ = split_filename(csf_file)
-    csf_label_file = op.abspath(name + "_fixedCSF.nii.gz")
-    nb.save(csf_label_image, csf_label_file)
+    # Unlabelled voxels are assigned from the probability maps, WM first
+    unlabelled = data_uint8 == 0
+    wm_fill = unlabelled & (wm_data > prob_thresh)
+    data_uint8[wm_fill] = white_matter_default
+    data_uint8[unlabelled & ~wm_fill & (csf_data > prob_thresh)] = csf_default
 
-    hdr = image.get_header()
+    # Inside the ROIs the WM map keeps its (truncated) probabilities
+    is_wm = data_uint8 == white_matter_default
+    wm_fixed = np.where(is_wm, 1, wm_data)
+    wm_fixed[~is_wm & ((data_uint8 == csf_default) | (data_uint8 == 0))] = 0
+    wm_label_file = save_label_image(
+        wm_fixed, wm_image, white_matter_file, "_fixedWM.nii.gz")
 
-    unlabelled = np.where((gm_data > prob_thresh) & (data_uint8 == 0))[0]
+    csf_fixed = np.where(data_uint8 == csf_default, csf_data, 0)
+    csf_label_file = save_label_image(
+        csf_fixed, csf_image, csf_file, "_fixedCSF.nii.gz")
 
     # Create extra ROI if there are extra GM regions in the GM mask
-    if len(unlabelled) > 0:
+    unlabelled = data_uint8 == 0
+    if np.any(unlabelled & (gm_data > prob_thresh)):
         highestlabel = np.max(data_uint8)
         assert(highestlabel != 255)
-        data_uint8[np.where((gm_data > 0) & (data_uint8 == 0))] = highestlabel + 1
-
-    fixed = nb.Nifti1Image(
-        dataobj=data_uint8, affine=image.get_affine(), header=hdr)
-    _, name, _ = split_filename(roi_image)
-    fixed.set_data_dtype(np.uint8)
-    fixed_roi_image = op.abspath(name + "_fixedROIs.nii.gz")
-    nb.save(fixed, fixed_roi_image)
+        data_uint8[unlabelled & (gm_data > 0)] = highestlabel + 1
+
+    fixed_roi_image = save_label_image(
+        data_uint8, image, roi_image, "_fixedROIs.nii.gz")
     return fixed_roi_image, wm_label_file, csf_label_file, remap_dict
 
 
@@ -240,6 +213,203 @@ def write_config_dat(roi_file, LUT=None, remap_dict=None):
     return op.abspath(out_file)
 
 
+def prepare_pvelab_inputs(pet_file, t1_file, grey_matter_file, grey_matter_binary_mask,
+                          white_matter_file, csf_file, roi_file, use_fs_LUT=True):
+    '''
+    Writes the Analyze images, SubjectList.lst and ROI_names.dat that
+    runbatch_nogui expects into the current directory
+    '''
+    list_path = op.abspath("SubjectList.lst")
+    pet_path, _ = nifti_to_analyze(pet_file)
+    t1_path, _ = nifti_to_analyze(t1_file)
+    f = open(list_path, 'w')
+    f.write("%s;%s" % (pet_path, t1_path))
+    f.close()
+
+    _, name, _ = split_filename(grey_matter_file)
+    gm_path, _ = nifti_to_analyze(grey_matter_file, np.uint8, name + "_u8")
+    iflogger.info("Writing to %s" % gm_path)
+
+    fixed_roi_file, fixed_wm, fixed_csf, remap_dict = fix_roi_values(
+        roi_file, grey_matter_binary_mask, white_matter_file,
+        csf_file, use_fs_LUT)
+
+    rois_path, _ = nifti_to_analyze(fixed_roi_file)
+    iflogger.info("Writing to %s" % rois_path)
+    iflogger.info("Writing to %s" % fixed_wm)
+    iflogger.info("Writing to %s" % fixed_csf)
+
+    _, name, _ = split_filename(fixed_wm)
+    wm_path, _ = nifti_to_analyze(fixed_wm, np.uint8, name + "_u8")
+    iflogger.info("Writing to %s" % wm_path)
+
+    _, name, _ = split_filename(fixed_csf)
+    csf_path, _ = nifti_to_analyze(fixed_csf, np.uint8, name + "_u8")
+    iflogger.info("Writing to %s" % csf_path)
+
+    if use_fs_LUT:
+        fs_dir = os.environ['FREESURFER_HOME']
+        LUT = op.join(fs_dir, "FreeSurferColorLUT.txt")
+        dat_path = write_config_dat(
+            fixed_roi_file, LUT, remap_dict)
+    else:
+        dat_path = write_config_dat(
+            fixed_roi_file)
+    iflogger.info("Writing to %s" % dat_path)
+
+    return dict(
+        list_path=list_path,
+        gm_path=gm_path,
+        wm_path=wm_path,
+        csf_path=csf_path,
+        rois_path=rois_path,
+        dat_path=dat_path)
+
+
+def pvelab_script(paths, x_fwhm, y_fwhm, z_fwhm, subject_dir=None):
+    '''
+    MATLAB snippet running runbatch_nogui on one prepared subject. If
+    subject_dir is given, MATLAB changes into it first so the pve_*
+    results folder is written next to that subject's inputs.
+    '''
+    d = dict(paths)
+    d.update(X_PSF=x_fwhm, Y_PSF=y_fwhm, Z_PSF=z_fwhm)
+    script = Template("""
+        filelist = '$list_path';
+        gm = '$gm_path';
+        wm = '$wm_path';
+        csf = '$csf_path';
+        rois = '$rois_path';
+        dat = '$dat_path';
+        x_fwhm = '$X_PSF';
+        y_fwhm = '$Y_PSF';
+        z_fwhm = '$Z_PSF';
+        runbatch_nogui(filelist, gm, wm, csf, rois, dat, x_fwhm, y_fwhm, z_fwhm)
+        """).substitute(d)
+    if subject_dir is not None:
+        script = "\n        cd('%s');" % subject_dir + script
+    return script
+
+
+# Output spec field and PVELab file name of every image PVELab writes,
+# in the order they are listed in out_files
+PVELAB_IMAGES = [('occu_mueller_gartner', 'r_volume_Occu_MG'),
+                 ('occu_meltzer', 'r_volume_Occu_Meltzer'),
+                 ('meltzer', 'r_volume_Meltzer'),
+                 ('mueller_gartner_rousset', 'r_volume_MGRousset'),
+                 ('mueller_gartner_WMroi', 'r_volume_MGCS'),
+                 ('virtual_pet_image', 'r_volume_Virtual_PET'),
+                 ('white_matter_roi', 'r_volume_CSWMROI'),
+                 ('alfano_alfano', 'r_volume_AlfanoAlfano'),
+                 ('alfano_cs', 'r_volume_AlfanoCS'),
+                 ('alfano_rousset', 'r_volume_AlfanoRousset'),
+                 ('mueller_gartner_alfano', 'r_volume_MGAlfano'),
+                 ('mask', 'r_volume_Mask'),
+                 ('point_spread_image', 'r_volume_PSF')]
+PVELAB_IMAGE_NAMES = [field for field, _ in PVELAB_IMAGES]
+
+
+def collect_pvelab_outputs(pet_file, t1_file, converted_outputs=None, compresslevel=None,
+                           n_threads=None):
+    '''
+    Converts the PVELab results written to pve_<pet name> in the current
+    directory back to NIfTI and saves the parsed results table. Only the
+    images named in converted_outputs (default: all) are converted, in a
+    thread pool since the gzip compression releases the GIL.
+    '''
+    from multiprocessing.pool import ThreadPool
+    if converted_outputs is None:
+        converted_outputs = PVELAB_IMAGE_NAMES
+    orig_t1 = nb.load(t1_file)
+    orig_affine = orig_t1.get_affine()
+    _, foldername, _ = split_filename(pet_file)
+
+    jobs = []
+    for field, filename in PVELAB_IMAGES:
+        if field not in converted_outputs:
+            continue
+        img = op.join("pve_%s" % foldername, filename + ".img")
+        if not op.exists(img):
+            raise IOError("PVELab did not write %s" % img)
+        # The PSF image keeps its own geometry
+        affine = None if field == 'point_spread_image' else orig_affine
+        jobs.append((img, affine))
+    if jobs:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(lambda job: analyze_to_nifti(job[0], affine=job[1],
+                                                  compresslevel=compresslevel), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    try:
+        rousset_mat_file = glob.glob(
+            "pve_%s/r_volume_Rousset.mat" % foldername)[0]
+    except IndexError:
+        # On Ubuntu using pve64, the matlab file is saved with a capital M
+        rousset_mat_file = glob.glob(
+            "pve_%s/r_volume_Rousset.Mat" % foldername)[0]
+
+    shutil.copyfile(rousset_mat_file, op.abspath("r_volume_Rousset.mat"))
+
+    results_text_file = glob.glob(
+        "pve_%s/r_volume_pve.txt" % foldername)[0]
+    shutil.copyfile(results_text_file, op.abspath("r_volume_pve.txt"))
+
+    results_matlab_mat = op.abspath("%s_pve.mat" % foldername)
+    results_numpy_npz = op.abspath("%s_pve.npz" % foldername)
+
+    out_data = parse_pve_results(results_text_file)
+    sio.savemat(results_matlab_mat, mdict=out_data)
+    np.savez(results_numpy_npz, **out_data)
+    return results_matlab_mat, results_numpy_npz
+
+
+def pvelab_outputs(pet_file, white_matter_file, csf_file, out_dir=None, converted_outputs=None):
+    '''
+    Output files of one PVELab run, in out_dir or the current directory
+    '''
+    if out_dir is None:
+        out_dir = os.getcwd()
+    if converted_outputs is None:
+        converted_outputs = PVELAB_IMAGE_NAMES
+    out_path = lambda filename: op.abspath(op.join(out_dir, filename))
+    outputs = {}
+    _, foldername, _ = split_filename(pet_file)
+    outputs['results_matlab_mat'] = out_path("%s_pve.mat" % foldername)
+    outputs['results_numpy_npz'] = out_path("%s_pve.npz" % foldername)
+
+    outputs['results_text_file'] = out_path("r_volume_pve.txt")
+    _, name, _ = split_filename(white_matter_file)
+    outputs['wm_label_file'] = out_path(name + "_fixedWM.nii.gz")
+    _, name, _ = split_filename(csf_file)
+    outputs['csf_label_file'] = out_path(name + "_fixedCSF.nii.gz")
+    outputs['rousset_mat_file'] = out_path("r_volume_Rousset.mat")
+    for field, filename in PVELAB_IMAGES:
+        if field in converted_outputs:
+            outputs[field] = out_path(filename + ".nii.gz")
+
+    out_files = []
+    for field in PVELAB_IMAGE_NAMES[:7] + ['rousset_mat_file'] + PVELAB_IMAGE_NAMES[7:11]:
+        if field in outputs:
+            out_files.append(outputs[field])
+    outputs['out_files'] = out_files
+    return outputs
+
+
+def _converted_outputs(inputs):
+    if isdefined(inputs.converted_outputs):
+        return inputs.converted_outputs
+    return PVELAB_IMAGE_NAMES
+
+
+def _compresslevel(inputs):
+    if isdefined(inputs.compresslevel):
+        return inputs.compresslevel
+    return None
+
+
 class PartialVolumeCorrectionInputSpec(BaseInterfaceInputSpec):
     pet_file = File(exists=True, mandatory=True,
                     desc='The input PET image')
@@ -262,6 +432,9 @@ class PartialVolumeCorrectionInputSpec(BaseInterfaceInputSpec):
     x_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
     y_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
     z_dir_point_spread_function_FWHM = traits.Float(0, usedefault=True)
+    converted_outputs = traits.List(traits.Enum(*PVELAB_IMAGE_NAMES),
+                                    desc='PVELab images to convert back to NIfTI (default: all)')
+    compresslevel = traits.Range(low=0, high=9, desc='gzip level of the converted images')
 
 
 class PartialVolumeCorrectionOutputSpec(TraitedSpec):
@@ -321,134 +494,437 @@ class PartialVolumeCorrection(BaseInterface):
     output_spec = PartialVolumeCorrectionOutputSpec
 
     def _run_interface(self, runtime):
-        list_path = op.abspath("SubjectList.lst")
-        pet_path, _ = nifti_to_analyze(self.inputs.pet_file)
-        t1_path, _ = nifti_to_analyze(self.inputs.t1_file)
-        f = open(list_path, 'w')
-        f.write("%s;%s" % (pet_path, t1_path))
-        f.close()
+        paths = prepare_pvelab_inputs(self.inputs.pet_file, self.inputs.t1_file,
+            self.inputs.grey_matter_file, self.inputs.grey_matter_binary_mask,
+            self.inputs.white_matter_file, self.inputs.csf_file,
+            self.inputs.roi_file, self.inputs.use_fs_LUT)
+        script = pvelab_script(paths, self.inputs.x_dir_point_spread_function_FWHM,
+                               self.inputs.y_dir_point_spread_function_FWHM,
+                               self.inputs.z_dir_point_spread_function_FWHM)
+        mlab = MatlabCommand(script=script, mfile=True,
+                             prescript=[''], postscript=[''])
+        result = mlab.run()
+        collect_pvelab_outputs(self.inputs.pet_file, self.inputs.t1_file,
+                               _converted_outputs(self.inputs), _compresslevel(self.inputs))
+        return result.runtime
 
-        orig_t1 = nb.load(self.inputs.t1_file)
-        orig_affine = orig_t1.get_affine()
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(pvelab_outputs(self.inputs.pet_file, self.inputs.white_matter_file,
+                                      self.inputs.csf_file,
+                                      converted_outputs=_converted_outputs(self.inputs)))
+        return outputs
 
-        gm_uint8 = switch_datatype(self.inputs.grey_matter_file)
-        gm_path, _ = nifti_to_analyze(gm_uint8)
-        iflogger.info("Writing to %s" % gm_path)
 
-        fixed_roi_file, fixed_wm, fixed_csf, remap_dict = fix_roi_values(
-            self.inputs.roi_file, self.inputs.grey_matter_binary_mask, 
-            self.inputs.white_matter_file,
-            self.inputs.csf_file, self.inputs.use_fs_LUT)
+def _prepare_pvelab_subject(args):
+    subject_dir, inputs = args
+    cwd = os.getcwd()
+    os.chdir(subject_dir)
+    try:
+        return prepare_pvelab_inputs(*inputs)
+    finally:
+        os.chdir(cwd)
+
+
+def _collect_pvelab_subject(args):
+    subject_dir, pet_file, t1_file, converted, level = args
+    cwd = os.getcwd()
+    os.chdir(subject_dir)
+    try:
+        return collect_pvelab_outputs(pet_file, t1_file, converted, level)
+    finally:
+        os.chdir(cwd)
+
+
+class BatchPartialVolumeCorrectionInputSpec(BaseInterfaceInputSpec):
+    pet_files = InputMultiPath(File(exists=True), mandatory=True,
+                    desc='The input PET images, one per subject')
+    t1_files = InputMultiPath(File(exists=True), mandatory=True,
+                   desc='The input T1 images, one per subject')
+    white_matter_files = InputMultiPath(File(exists=True), mandatory=True,
+                             desc='White matter probability maps')
+    grey_matter_files = InputMultiPath(File(exists=True), mandatory=True,
+                            desc='Grey matter probability maps')
+    grey_matter_binary_masks = InputMultiPath(File(exists=True), mandatory=True,
+                            desc='Hard-segmented binary grey matter masks')
+    csf_files = InputMultiPath(File(exists=True), mandatory=True,
+                    desc='Cerebrospinal fluid probability maps')
+    roi_files = InputMultiPath(File(exists=True), mandatory=True,
+                    desc='The input ROI images')
+    subject_ids = traits.List(traits.Str, desc='Names of the per-subject working directories')
+    use_fs_LUT = traits.Bool(True, usedefault=True,
+                             desc='Uses the Freesurfer lookup table for names in the atlas')
+    x_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
+    y_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
+    z_dir_point_spread_function_FWHM = traits.Float(0, usedefault=True)
+    n_procs = traits.Int(desc='Number of processes used to prepare and collect the subjects')
+    converted_outputs = traits.List(traits.Enum(*PVELAB_IMAGE_NAMES),
+                                    desc='PVELab images to convert back to NIfTI (default: all)')
+    compresslevel = traits.Range(low=0, high=9, desc='gzip level of the converted images')
+
+
+class BatchPartialVolumeCorrectionOutputSpec(TraitedSpec):
+    results_matlab_mat = OutputMultiPath(File(exists=True), desc='results_matlab_mat for each subject')
+    results_numpy_npz = OutputMultiPath(File(exists=True), desc='results_numpy_npz for each subject')
+    results_text_file = OutputMultiPath(File(exists=True), desc='results_text_file for each subject')
+    wm_label_file = OutputMultiPath(File(exists=True), desc='wm_label_file for each subject')
+    csf_label_file = OutputMultiPath(File(exists=True), desc='csf_label_file for each subject')
+    alfano_alfano = OutputMultiPath(File(exists=True), desc='alfano_alfano for each subject')
+    alfano_cs = OutputMultiPath(File(exists=True), desc='alfano_cs for each subject')
+    alfano_rousset = OutputMultiPath(File(exists=True), desc='alfano_rousset for each subject')
+    mueller_gartner_alfano = OutputMultiPath(File(exists=True), desc='mueller_gartner_alfano for each subject')
+    mask = OutputMultiPath(File(exists=True), desc='mask for each subject')
+    occu_mueller_gartner = OutputMultiPath(File(exists=True), desc='occu_mueller_gartner for each subject')
+    occu_meltzer = OutputMultiPath(File(exists=True), desc='occu_meltzer for each subject')
+    meltzer = OutputMultiPath(File(exists=True), desc='meltzer for each subject')
+    mueller_gartner_rousset = OutputMultiPath(File(exists=True), desc='mueller_gartner_rousset for each subject')
+    mueller_gartner_WMroi = OutputMultiPath(File(exists=True), desc='mueller_gartner_WMroi for each subject')
+    virtual_pet_image = OutputMultiPath(File(exists=True), desc='virtual_pet_image for each subject')
+    white_matter_roi = OutputMultiPath(File(exists=True), desc='white_matter_roi for each subject')
+    rousset_mat_file = OutputMultiPath(File(exists=True), desc='rousset_mat_file for each subject')
+    point_spread_image = OutputMultiPath(File(exists=True), desc='point_spread_image for each subject')
+    out_files = OutputMultiPath(File,
+                                exists=True, desc='all PVE files')
 
 
-        
+class BatchPartialVolumeCorrection(BaseInterface):
 
-        rois_path, _ = nifti_to_analyze(fixed_roi_file)
-        iflogger.info("Writing to %s" % rois_path)
-        iflogger.info("Writing to %s" % fixed_wm)
-        iflogger.info("Writing to %s" % fixed_csf)
+    """
+    Runs PVELab partial volume correction for a cohort in one MATLAB
+    session. The inputs of each subject are prepared in parallel in their
+    own directory, runbatch_nogui is called for every subject from a
+    single script, and the results are returned as lists ordered like
+    pet_files.
+
+    Example
+    -------
+
+    >>> import coma.interfaces as ci
+    >>> pvc = ci.BatchPartialVolumeCorrection()
+    >>> pvc.inputs.pet_files = ['pet1.nii', 'pet2.nii']
+    >>> pvc.inputs.t1_files = ['t1_1.nii', 't1_2.nii']
+    >>> pvc.inputs.subject_ids = ['subj1', 'subj2']
+    >>> pvc.run()                                       # doctest: +SKIP
+    """
+    input_spec = BatchPartialVolumeCorrectionInputSpec
+    output_spec = BatchPartialVolumeCorrectionOutputSpec
 
-        wm_uint8 = switch_datatype(fixed_wm)
-        wm_path, _ = nifti_to_analyze(wm_uint8)
-        iflogger.info("Writing to %s" % wm_path)
+    def _subject_dirs(self):
+        if isdefined(self.inputs.subject_ids):
+            names = self.inputs.subject_ids
+        else:
+            names = ["subject%03d" % idx for idx in range(len(self.inputs.pet_files))]
+        return [op.abspath(name) for name in names]
 
-        csf_uint8 = switch_datatype(fixed_csf)
-        csf_path, _ = nifti_to_analyze(csf_uint8)
-        iflogger.info("Writing to %s" % csf_path)
+    def _run_interface(self, runtime):
+        n_subjects = len(self.inputs.pet_files)
+        per_subject = [self.inputs.t1_files, self.inputs.grey_matter_files,
+                       self.inputs.grey_matter_binary_masks, self.inputs.white_matter_files,
+                       self.inputs.csf_files, self.inputs.roi_files]
+        if any(len(files) != n_subjects for files in per_subject):
+            raise ValueError('The same number of images must be given for every input')
+        subject_dirs = self._subject_dirs()
+        if len(subject_dirs) != n_subjects or len(set(subject_dirs)) != n_subjects:
+            raise ValueError('One unique subject ID is required per PET image')
+
+        for subject_dir in subject_dirs:
+            if not op.exists(subject_dir):
+                os.makedirs(subject_dir)
+
+        jobs = []
+        for idx, subject_dir in enumerate(subject_dirs):
+            inputs = [op.abspath(files[idx]) for files in [self.inputs.pet_files] + per_subject]
+            jobs.append((subject_dir, inputs + [self.inputs.use_fs_LUT]))
+
+        n_procs = None
+        if isdefined(self.inputs.n_procs):
+            n_procs = self.inputs.n_procs
+        pool = multiprocessing.Pool(n_procs)
+        try:
+            paths = pool.map(_prepare_pvelab_subject, jobs)
+
+            script = "".join([pvelab_script(subject_paths,
+                                self.inputs.x_dir_point_spread_function_FWHM,
+                                self.inputs.y_dir_point_spread_function_FWHM,
+                                self.inputs.z_dir_point_spread_function_FWHM,
+                                subject_dir)
+                              for subject_dir, subject_paths in zip(subject_dirs, paths)])
+            script += "\n        cd('%s');\n" % os.getcwd()
+            mlab = MatlabCommand(script=script, mfile=True,
+                                 prescript=[''], postscript=[''])
+            result = mlab.run()
+
+            pool.map(_collect_pvelab_subject,
+                     [(subject_dir, op.abspath(self.inputs.pet_files[idx]),
+                       op.abspath(self.inputs.t1_files[idx]),
+                       _converted_outputs(self.inputs), _compresslevel(self.inputs))
+                      for idx, subject_dir in enumerate(subject_dirs)])
+        finally:
+            pool.close()
+            pool.join()
+        return result.runtime
 
-        if self.inputs.use_fs_LUT:
-            fs_dir = os.environ['FREESURFER_HOME']
-            LUT = op.join(fs_dir, "FreeSurferColorLUT.txt")
-            dat_path = write_config_dat(
-                fixed_roi_file, LUT, remap_dict)
-        else:
-            dat_path = write_config_dat(
-                fixed_roi_file)
-        iflogger.info("Writing to %s" % dat_path)
-
-        d = dict(
-            list_path=list_path,
-            gm_path=gm_path,
-            wm_path=wm_path,
-            csf_path=csf_path,
-            rois_path=rois_path,
-            dat_path=dat_path,
-            X_PSF=self.inputs.x_dir_point_spread_function_FWHM,
-            Y_PSF=self.inputs.y_dir_point_spread_function_FWHM,
-            Z_PSF=self.inputs.z_dir_point_spread_function_FWHM)
-        script = Template("""       
-        filelist = '$list_path';
-        gm = '$gm_path';
-        wm = '$wm_path';
-        csf = '$csf_path';
-        rois = '$rois_path';
-        dat = '$dat_path';
-        x_fwhm = '$X_PSF';
-        y_fwhm = '$Y_PSF';
-        z_fwhm = '$Z_PSF';
-        runbatch_nogui(filelist, gm, wm, csf, rois, dat, x_fwhm, y_fwhm, z_fwhm)
-        """).substitute(d)
-        mlab = MatlabCommand(script=script, mfile=True,
-                             prescript=[''], postscript=[''])
-        result = mlab.run()
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        out_files = []
+        for idx, subject_dir in enumerate(self._subject_dirs()):
+            subject_outputs = pvelab_outputs(self.inputs.pet_files[idx],
+                                             self.inputs.white_matter_files[idx],
+                                             self.inputs.csf_files[idx], subject_dir,
+                                             _converted_outputs(self.inputs))
+            out_files.extend(subject_outputs.pop('out_files'))
+            for key, value in subject_outputs.items():
+                if not isdefined(outputs[key]):
+                    outputs[key] = []
+                outputs[key].append(value)
+        outputs['out_files'] = out_files
+        return outputs
+
+
+def psf_sigma(fwhm, voxel_size):
+    '''
+    Converts the full-width at half-maximum of a Gaussian PSF (in mm)
+    into a standard deviation in voxels for each axis.
+    '''
+    fwhm = np.asarray(fwhm, dtype=np.float64)
+    voxel_size = np.asarray(voxel_size[0:3], dtype=np.float64)
+    return fwhm / (2 * np.sqrt(2 * np.log(2))) / voxel_size
+
+
+def convolve_psf(data, sigma):
+    from scipy.ndimage import gaussian_filter
+    return gaussian_filter(np.asarray(data, dtype=np.float32), sigma, mode='constant')
 
-        _, foldername, _ = split_filename(self.inputs.pet_file)
-        occu_MG_img = glob.glob("pve_%s/r_volume_Occu_MG.img" % foldername)[0]
-        analyze_to_nifti(occu_MG_img, affine=orig_affine)
-        occu_meltzer_img = glob.glob(
-            "pve_%s/r_volume_Occu_Meltzer.img" % foldername)[0]
-        analyze_to_nifti(occu_meltzer_img, affine=orig_affine)
-        meltzer_img = glob.glob("pve_%s/r_volume_Meltzer.img" % foldername)[0]
-        analyze_to_nifti(meltzer_img, affine=orig_affine)
-        MG_rousset_img = glob.glob(
-            "pve_%s/r_volume_MGRousset.img" % foldername)[0]
-        analyze_to_nifti(MG_rousset_img, affine=orig_affine)
-        MGCS_img = glob.glob("pve_%s/r_volume_MGCS.img" % foldername)[0]
-        analyze_to_nifti(MGCS_img, affine=orig_affine)
-        virtual_PET_img = glob.glob(
-            "pve_%s/r_volume_Virtual_PET.img" % foldername)[0]
-        analyze_to_nifti(virtual_PET_img, affine=orig_affine)
-        centrum_semiovalue_WM_img = glob.glob(
-            "pve_%s/r_volume_CSWMROI.img" % foldername)[0]
-        analyze_to_nifti(centrum_semiovalue_WM_img, affine=orig_affine)
-        alfano_alfano_img = glob.glob(
-            "pve_%s/r_volume_AlfanoAlfano.img" % foldername)[0]
-        analyze_to_nifti(alfano_alfano_img, affine=orig_affine)
-        alfano_cs_img = glob.glob("pve_%s/r_volume_AlfanoCS.img" %
-                                  foldername)[0]
-        analyze_to_nifti(alfano_cs_img, affine=orig_affine)
-        alfano_rousset_img = glob.glob(
-            "pve_%s/r_volume_AlfanoRousset.img" % foldername)[0]
-        analyze_to_nifti(alfano_rousset_img, affine=orig_affine)
-        mg_alfano_img = glob.glob("pve_%s/r_volume_MGAlfano.img" %
-                                  foldername)[0]
-        analyze_to_nifti(mg_alfano_img, affine=orig_affine)
-        mask_img = glob.glob("pve_%s/r_volume_Mask.img" % foldername)[0]
-        analyze_to_nifti(mask_img, affine=orig_affine)
-        PSF_img = glob.glob("pve_%s/r_volume_PSF.img" % foldername)[0]
-        analyze_to_nifti(PSF_img)
 
+def _gtm_column(args):
+    '''
+    Spreads one region through the PSF and sums the result over every
+    region. Only a bounding box around the region, padded by four
+    standard deviations of the PSF, is convolved.
+    '''
+    labels_file, label, bounding_box, sigma, n_labels = args
+    labels = np.load(labels_file, mmap_mode='r')
+    padded = []
+    for axis, box in enumerate(bounding_box):
+        pad = int(np.ceil(4 * sigma[axis]))
+        padded.append(slice(max(box.start - pad, 0),
+                            min(box.stop + pad, labels.shape[axis])))
+    padded = tuple(padded)
+    crop = np.asarray(labels[padded])
+    spread = convolve_psf(crop == label, sigma)
+    return np.bincount(crop.ravel(), weights=spread.ravel(), minlength=n_labels)
+
+
+def geometric_transfer_matrix(labels, regions, sigma, n_procs=None):
+    '''
+    Computes the geometric transfer matrix (GTM) of Rousset et al. 1998.
+    Element (i, j) is the fraction of the signal of region j that is
+    measured in region i once blurred by the PSF. The regions are
+    convolved in parallel.
+    '''
+    from scipy.ndimage import find_objects
+    n_labels = int(labels.max()) + 1
+    counts = np.bincount(labels.ravel(), minlength=n_labels).astype(np.float64)
+    bounding_boxes = find_objects(labels)
+
+    labels_file = op.abspath('gtm_labels.npy')
+    np.save(labels_file, labels)
+    jobs = [(labels_file, region, bounding_boxes[region - 1], sigma, n_labels)
+            for region in regions]
+    if n_procs == 1:
+        columns = [_gtm_column(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(n_procs)
         try:
-            rousset_mat_file = glob.glob(
-                "pve_%s/r_volume_Rousset.mat" % foldername)[0]
-        except IndexError:
-            # On Ubuntu using pve64, the matlab file is saved with a capital M
-            rousset_mat_file = glob.glob(
-                "pve_%s/r_volume_Rousset.Mat" % foldername)[0]
+            columns = pool.map(_gtm_column, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    os.remove(labels_file)
+
+    gtm = np.array([column[regions] / counts[regions] for column in columns]).T
+    return gtm
+
+
+def get_region_names(rois, use_fs_LUT, remap_dict):
+    if use_fs_LUT:
+        from ..helpers import get_names
+        fs_dir = os.environ['FREESURFER_HOME']
+        LUT_dict = get_names(op.join(fs_dir, "FreeSurferColorLUT.txt"))
+        return [LUT_dict.get(remap_dict.get(roi, roi), "Region%i" % roi) for roi in rois]
+    return ["Region%i" % (idx + 1) for idx in range(len(rois))]
+
+
+def write_pve_results(results_text_file, pet_file, gm_file, wm_slice_used, region_names, rows):
+    '''
+    Writes the regional results in the same layout as PVELab's
+    r_volume_pve.txt, so they can be read with parse_pve_results.
+    '''
+    with open(results_text_file, 'w') as res:
+        res.write("PET file name: %s\n" % pet_file)
+        res.write("Labeled segmented GM file name %s\n" % gm_file)
+        res.write("PET SLICE USED FOR mean WM activity MEASURE: %i\n" % wm_slice_used)
+        res.write("DATA OF..., %s\n" % ", ".join(region_names))
+        for rowname, values in rows:
+            res.write("%s, %s\n" % (rowname, ", ".join(["%f" % x for x in values])))
+    return results_text_file
+
+
+class NativePartialVolumeCorrectionInputSpec(BaseInterfaceInputSpec):
+    pet_file = File(exists=True, mandatory=True,
+                    desc='The input PET image')
+    t1_file = File(exists=True,
+                   desc='The input T1 (not used, accepted for compatibility with PartialVolumeCorrection)')
+    white_matter_file = File(exists=True, mandatory=True,
+                             desc='White matter probability map')
+    grey_matter_file = File(exists=True,
+                            desc='Grey matter probability map')
+    grey_matter_binary_mask = File(exists=True,
+                            desc='Hard-segmented binary grey matter mask')
+    csf_file = File(exists=True, mandatory=True,
+                    desc='Cerebrospinal fluid probability map')
+    roi_file = File(exists=True, mandatory=True,
+                    desc='The input ROI image')
+    use_fs_LUT = traits.Bool(True, usedefault=True,
+                             desc='Uses the Freesurfer lookup table for names in the atlas')
+    x_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
+    y_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
+    z_dir_point_spread_function_FWHM = traits.Float(0, usedefault=True)
+    minimum_tissue_fraction = traits.Float(0.1, usedefault=True,
+                                           desc='Voxels whose blurred tissue fraction is below this are not corrected')
+    n_procs = traits.Int(desc='Number of processes used to build the transfer matrix (defaults to all cores)')
+
 
-        shutil.copyfile(rousset_mat_file, op.abspath("r_volume_Rousset.mat"))
+class NativePartialVolumeCorrection(BaseInterface):
+
+    """
+    Region-based partial volume correction without PVELab or MATLAB
+
+    The regions (atlas ROIs in grey matter, white matter and CSF) are
+    spread through a Gaussian PSF to build the geometric transfer matrix,
+    which is inverted for the Rousset estimates. Meltzer and
+    M\"{u}eller-Gartner images are then computed voxelwise, the latter with
+    the WM value from Rousset and from a centrum semiovale WM ROI.
+    The results are written with the same names, and the same .npz/.mat
+    layout, as PartialVolumeCorrection. The occupancy and Alfano outputs
+    of PVELab are not computed.
+
+    """
+    input_spec = NativePartialVolumeCorrectionInputSpec
+    output_spec = PartialVolumeCorrectionOutputSpec
 
-        results_text_file = glob.glob(
-            "pve_%s/r_volume_pve.txt" % foldername)[0]
-        shutil.copyfile(results_text_file, op.abspath("r_volume_pve.txt"))
+    def _run_interface(self, runtime):
+        white_matter_default = 2
+        csf_default = 3
+        fixed_roi_file, _, _, remap_dict = fix_roi_values(
+            self.inputs.roi_file, self.inputs.grey_matter_binary_mask,
+            self.inputs.white_matter_file,
+            self.inputs.csf_file, self.inputs.use_fs_LUT)
 
-        results_matlab_mat = op.abspath("%s_pve.mat" % foldername)
-        results_numpy_npz = op.abspath("%s_pve.npz" % foldername)
+        pet_image = nb.load(self.inputs.pet_file)
+        pet = pet_image.get_data().astype(np.float32)
+        labels = nb.load(fixed_roi_file).get_data().astype(np.int32)
+        if pet.shape[0:3] != labels.shape:
+            raise ValueError('The PET image {p} and the ROI image {r} must be on the same grid'.format(
+                p=pet.shape, r=labels.shape))
+        pet = pet.reshape(labels.shape)
+        affine = pet_image.get_affine()
+        voxel_size = pet_image.get_header().get_zooms()[0:3]
+        sigma = psf_sigma([self.inputs.x_dir_point_spread_function_FWHM,
+                           self.inputs.y_dir_point_spread_function_FWHM,
+                           self.inputs.z_dir_point_spread_function_FWHM], voxel_size)
+
+        regions = np.unique(labels)
+        regions = regions[regions > 0]
+        rois = regions[regions > csf_default]
+        n_procs = None
+        if isdefined(self.inputs.n_procs):
+            n_procs = self.inputs.n_procs
+        iflogger.info('Building the transfer matrix for {n} regions'.format(n=len(regions)))
+        gtm = geometric_transfer_matrix(labels, regions, sigma, n_procs)
+
+        counts = np.bincount(labels.ravel(), minlength=regions.max() + 1).astype(np.float64)
+        observed = np.bincount(labels.ravel(), weights=pet.ravel(),
+                               minlength=regions.max() + 1)[regions] / counts[regions]
+        rousset = np.linalg.solve(gtm, observed)
+
+        gm = labels > csf_default
+        wm = labels == white_matter_default
+        gm_spread = convolve_psf(gm, sigma)
+        wm_spread = convolve_psf(wm, sigma)
+        min_fraction = self.inputs.minimum_tissue_fraction
+
+        # Meltzer: two compartments, brain tissue and CSF (assumed to be empty)
+        tissue = gm | wm
+        tissue_spread = gm_spread + wm_spread
+        meltzer = np.zeros(labels.shape, dtype=np.float32)
+        valid = tissue & (tissue_spread > min_fraction)
+        meltzer[valid] = pet[valid] / tissue_spread[valid]
+
+        # Centrum semiovale WM ROI: the axial slice with the most voxels
+        # that are (almost) unaffected by spill-in from other tissues
+        pure_wm = wm & (wm_spread >= 0.95)
+        if not pure_wm.any():
+            pure_wm = wm & (wm_spread >= wm_spread[wm].max() * 0.95)
+        wm_slice_used = int(np.argmax(pure_wm.sum(axis=0).sum(axis=0)))
+        cs_wm_roi = np.zeros(labels.shape, dtype=bool)
+        cs_wm_roi[:, :, wm_slice_used] = pure_wm[:, :, wm_slice_used]
+        wm_cs_value = pet[cs_wm_roi].mean()
+
+        if white_matter_default in regions:
+            wm_rousset_value = rousset[np.where(regions == white_matter_default)[0][0]]
+        else:
+            wm_rousset_value = wm_cs_value
+
+        # Mueller-Gartner: three compartments with the WM value known
+        valid = gm & (gm_spread > min_fraction)
+        mg_rousset = np.zeros(labels.shape, dtype=np.float32)
+        mg_rousset[valid] = (pet[valid] - wm_rousset_value * wm_spread[valid]) / gm_spread[valid]
+        mg_cs = np.zeros(labels.shape, dtype=np.float32)
+        mg_cs[valid] = (pet[valid] - wm_cs_value * wm_spread[valid]) / gm_spread[valid]
+
+        # By linearity one convolution of the region-wise true values
+        # gives the simulated PET
+        true_values = np.zeros(regions.max() + 1, dtype=np.float32)
+        true_values[regions] = rousset
+        virtual_pet = convolve_psf(true_values[labels], sigma)
+
+        impulse = np.zeros(labels.shape, dtype=np.float32)
+        impulse[tuple([s // 2 for s in labels.shape])] = 1
+        point_spread = convolve_psf(impulse, sigma)
+
+        out_images = {"Meltzer": meltzer, "MGRousset": mg_rousset, "MGCS": mg_cs,
+                      "Virtual_PET": virtual_pet, "CSWMROI": cs_wm_roi.astype(np.uint8),
+                      "Mask": tissue.astype(np.uint8), "PSF": point_spread}
+        for name, data in out_images.items():
+            nb.save(nb.Nifti1Image(data, affine), op.abspath("r_volume_%s.nii.gz" % name))
+
+        sio.savemat(op.abspath("r_volume_Rousset.mat"),
+                    {"GTM": gtm, "regions": regions, "observed": observed,
+                     "rousset": rousset, "sigma_voxels": sigma})
+
+        def regional_means(data):
+            return np.bincount(labels.ravel(), weights=data.ravel(),
+                               minlength=regions.max() + 1)[rois] / counts[rois]
+
+        roi_index = np.searchsorted(regions, rois)
+        voxel_volume = np.prod(voxel_size) / 1000.0
+        rows = [("VOLUMES (cc)", counts[rois] * voxel_volume),
+                ("Original", observed[roi_index]),
+                ("Meltzer", regional_means(meltzer)),
+                ("MG CS", regional_means(mg_cs)),
+                ("MG Rousset", regional_means(mg_rousset)),
+                ("Rousset", rousset[roi_index])]
+        region_names = get_region_names(rois, self.inputs.use_fs_LUT, remap_dict)
+        results_text_file = write_pve_results(
+            op.abspath("r_volume_pve.txt"), op.abspath(self.inputs.pet_file),
+            fixed_roi_file, wm_slice_used + 1, region_names, rows)
 
+        _, foldername, _ = split_filename(self.inputs.pet_file)
         out_data = parse_pve_results(results_text_file)
-        sio.savemat(results_matlab_mat, mdict=out_data)
-        np.savez(results_numpy_npz, **out_data)
-        return result.runtime
+        sio.savemat(op.abspath("%s_pve.mat" % foldername), mdict=out_data)
+        np.savez(op.abspath("%s_pve.npz" % foldername), **out_data)
+        return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
@@ -456,15 +932,11 @@ class PartialVolumeCorrection(BaseInterface):
         _, foldername, _ = split_filename(self.inputs.pet_file)
         outputs['results_matlab_mat'] = op.abspath("%s_pve.mat" % foldername)
         outputs['results_numpy_npz'] = op.abspath("%s_pve.npz" % foldername)
-
         outputs['results_text_file'] = op.abspath("r_volume_pve.txt")
         _, name, _ = split_filename(self.inputs.white_matter_file)
         outputs['wm_label_file'] = op.abspath(name + "_fixedWM.nii.gz")
         _, name, _ = split_filename(self.inputs.csf_file)
         outputs['csf_label_file'] = op.abspath(name + "_fixedCSF.nii.gz")
-        outputs['occu_mueller_gartner'] = op.abspath("r_volume_Occu_MG.nii.gz")
-        outputs['occu_mueller_gartner'] = op.abspath("r_volume_Occu_MG.nii.gz")
-        outputs['occu_meltzer'] = op.abspath("r_volume_Occu_Meltzer.nii.gz")
         outputs['meltzer'] = op.abspath("r_volume_Meltzer.nii.gz")
         outputs['mueller_gartner_rousset'] = op.abspath(
             "r_volume_MGRousset.nii.gz")
@@ -475,22 +947,190 @@ class PartialVolumeCorrection(BaseInterface):
         outputs['rousset_mat_file'] = op.abspath("r_volume_Rousset.mat")
         outputs['point_spread_image'] = op.abspath("r_volume_PSF.nii.gz")
         outputs['mask'] = op.abspath("r_volume_Mask.nii.gz")
-        outputs['alfano_alfano'] = op.abspath("r_volume_AlfanoAlfano.nii.gz")
-        outputs['alfano_cs'] = op.abspath("r_volume_AlfanoCS.nii.gz")
-        outputs['alfano_rousset'] = op.abspath("r_volume_AlfanoRousset.nii.gz")
-        outputs['mueller_gartner_alfano'] = op.abspath(
-            "r_volume_MGAlfano.nii.gz")
-        outputs['out_files'] = [outputs['occu_mueller_gartner'],
-                                outputs['occu_meltzer'],
-                                outputs['meltzer'],
+        outputs['out_files'] = [outputs['meltzer'],
                                 outputs['mueller_gartner_rousset'],
                                 outputs['mueller_gartner_WMroi'],
                                 outputs['virtual_pet_image'],
                                 outputs['white_matter_roi'],
                                 outputs['rousset_mat_file'],
-                                outputs['alfano_alfano'],
-                                outputs['alfano_cs'],
-                                outputs['alfano_rousset'],
-                                outputs['mueller_gartner_alfano'],
                                 ]
         return outputs
+
+
+def gaussian_otf(shape, sigma):
+    '''
+    Optical transfer function of a Gaussian PSF (sigma in voxels) for the
+    real FFT of a volume of the given shape. The Gaussian is transformed
+    analytically, so no kernel image is needed.
+    '''
+    otf = np.ones((), dtype=np.float32)
+    for axis, (n, s) in enumerate(zip(shape, sigma)):
+        if axis == len(shape) - 1:
+            frequencies = np.fft.rfftfreq(n)
+        else:
+            frequencies = np.fft.fftfreq(n)
+        factor = np.exp(-2 * (np.pi * s * frequencies) ** 2).astype(np.float32)
+        otf = otf[..., np.newaxis] * factor
+    return otf
+
+
+class FFTConvolver(object):
+    '''
+    Convolves volumes with a Gaussian PSF through the FFT. The volume is
+    zero-padded by three standard deviations so the circular convolution
+    does not wrap around.
+    '''
+    def __init__(self, shape, sigma):
+        self.shape = tuple(shape)
+        self.pad = [int(np.ceil(3 * s)) for s in sigma]
+        self.padded_shape = tuple(n + 2 * p for n, p in zip(shape, self.pad))
+        self.crop = tuple(slice(p, p + n) for n, p in zip(shape, self.pad))
+        self.otf = gaussian_otf(self.padded_shape, sigma)
+
+    def __call__(self, data):
+        padded = np.zeros(self.padded_shape, dtype=np.float32)
+        padded[self.crop] = data
+        spectrum = np.fft.rfftn(padded)
+        spectrum *= self.otf
+        return np.fft.irfftn(spectrum, self.padded_shape)[self.crop].astype(np.float32)
+
+
+def region_based_voxelwise(pet, labels, regions, sigma, convolve, n_procs=None):
+    '''
+    Region-based voxelwise correction (Thomas et al. 2011): the PET is
+    scaled voxelwise by the ratio of a piecewise-constant image of the
+    GTM-corrected regional values to its blurred version.
+    '''
+    gtm = geometric_transfer_matrix(labels, regions, sigma, n_procs)
+    counts = np.bincount(labels.ravel(), minlength=regions.max() + 1).astype(np.float64)
+    observed = np.bincount(labels.ravel(), weights=pet.ravel(),
+                           minlength=regions.max() + 1)[regions] / counts[regions]
+    true_values = np.zeros(regions.max() + 1, dtype=np.float32)
+    true_values[regions] = np.linalg.solve(gtm, observed)
+    synthetic = true_values[labels]
+    blurred = convolve(synthetic)
+    corrected = np.zeros(pet.shape, dtype=np.float32)
+    valid = (labels > 0) & (np.abs(blurred) > 1e-6 * np.abs(synthetic).max())
+    corrected[valid] = pet[valid] * synthetic[valid] / blurred[valid]
+    return corrected
+
+
+def iterative_deconvolution(pet, convolve, method='richardson_lucy', max_iterations=30,
+                            tolerance=1e-3, alpha=1.0, mask=None):
+    '''
+    Van Cittert or Richardson-Lucy deconvolution of the PET image.
+    Iterations stop early once the relative change of the estimate is
+    below the tolerance. Returns the estimate and the iterations used.
+    '''
+    observed = np.asarray(pet, dtype=np.float32)
+    if method == 'richardson_lucy':
+        observed = np.clip(observed, 0, None)
+    estimate = observed.copy()
+    eps = np.float32(1e-6 * max(observed.max(), 1e-12))
+    for iteration in range(1, max_iterations + 1):
+        if method == 'richardson_lucy':
+            ratio = observed / np.maximum(convolve(estimate), eps)
+            # The Gaussian PSF is symmetric, so it is its own adjoint
+            updated = estimate * convolve(ratio)
+        else:
+            updated = estimate + alpha * (observed - convolve(estimate))
+        if mask is not None:
+            updated[~mask] = 0
+        change = np.linalg.norm(updated - estimate) / max(np.linalg.norm(estimate), eps)
+        estimate = updated
+        if change < tolerance:
+            break
+    return estimate, iteration
+
+
+class VoxelwisePartialVolumeCorrectionInputSpec(BaseInterfaceInputSpec):
+    pet_file = File(exists=True, mandatory=True,
+                    desc='The input PET image')
+    method = traits.Enum('rbv', 'richardson_lucy', 'van_cittert', usedefault=True,
+                         desc='Region-based voxelwise correction, or Richardson-Lucy / Van Cittert deconvolution')
+    roi_file = File(exists=True, desc='The input ROI image (required for rbv)')
+    white_matter_file = File(exists=True,
+                             desc='White matter probability map (required for rbv)')
+    csf_file = File(exists=True,
+                    desc='Cerebrospinal fluid probability map (required for rbv)')
+    grey_matter_binary_mask = File(exists=True,
+                            desc='Hard-segmented binary grey matter mask')
+    use_fs_LUT = traits.Bool(True, usedefault=True,
+                             desc='The ROI image uses the Freesurfer lookup table')
+    mask_file = File(exists=True, desc='Brain mask; the deconvolved image is set to zero outside it')
+    x_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
+    y_dir_point_spread_function_FWHM = traits.Float(8, usedefault=True)
+    z_dir_point_spread_function_FWHM = traits.Float(0, usedefault=True)
+    max_iterations = traits.Int(30, usedefault=True, desc='Maximum number of deconvolution iterations')
+    tolerance = traits.Float(1e-3, usedefault=True,
+                             desc='Stop once the relative change between iterations is below this')
+    alpha = traits.Float(1.0, usedefault=True, desc='Step size of the Van Cittert iterations')
+    n_procs = traits.Int(desc='Number of processes used to build the transfer matrix (rbv)')
+    out_file = File(desc='Output corrected image')
+
+
+class VoxelwisePartialVolumeCorrectionOutputSpec(TraitedSpec):
+    corrected_pet = File(exists=True, desc='Voxelwise partial volume corrected PET image')
+
+
+class VoxelwisePartialVolumeCorrection(BaseInterface):
+
+    """
+    Voxelwise partial volume correction, either region-based voxelwise
+    (RBV) or iterative Richardson-Lucy / Van Cittert deconvolution. The
+    PSF is applied through the FFT on float32 volumes.
+
+    """
+    input_spec = VoxelwisePartialVolumeCorrectionInputSpec
+    output_spec = VoxelwisePartialVolumeCorrectionOutputSpec
+
+    def _run_interface(self, runtime):
+        pet_image = nb.load(self.inputs.pet_file)
+        pet = pet_image.get_data().astype(np.float32)
+        pet = pet.reshape(pet.shape[0:3])
+        sigma = psf_sigma([self.inputs.x_dir_point_spread_function_FWHM,
+                           self.inputs.y_dir_point_spread_function_FWHM,
+                           self.inputs.z_dir_point_spread_function_FWHM],
+                          pet_image.get_header().get_zooms())
+        convolve = FFTConvolver(pet.shape, sigma)
+
+        if self.inputs.method == 'rbv':
+            if not (isdefined(self.inputs.roi_file) and isdefined(self.inputs.white_matter_file)
+                    and isdefined(self.inputs.csf_file)):
+                raise ValueError('RBV requires the ROI, white matter and CSF images')
+            fixed_roi_file, _, _, _ = fix_roi_values(
+                self.inputs.roi_file, self.inputs.grey_matter_binary_mask,
+                self.inputs.white_matter_file,
+                self.inputs.csf_file, self.inputs.use_fs_LUT)
+            labels = nb.load(fixed_roi_file).get_data().astype(np.int32)
+            if labels.shape != pet.shape:
+                raise ValueError('The PET image {p} and the ROI image {r} must be on the same grid'.format(
+                    p=pet.shape, r=labels.shape))
+            regions = np.unique(labels)
+            regions = regions[regions > 0]
+            n_procs = None
+            if isdefined(self.inputs.n_procs):
+                n_procs = self.inputs.n_procs
+            corrected = region_based_voxelwise(pet, labels, regions, sigma, convolve, n_procs)
+        else:
+            mask = None
+            if isdefined(self.inputs.mask_file):
+                mask = nb.load(self.inputs.mask_file).get_data().reshape(pet.shape) > 0
+            corrected, iterations = iterative_deconvolution(
+                pet, convolve, self.inputs.method, self.inputs.max_iterations,
+                self.inputs.tolerance, self.inputs.alpha, mask)
+            iflogger.info('{m} stopped after {i} iterations'.format(m=self.inputs.method, i=iterations))
+
+        nb.save(nb.Nifti1Image(corrected, pet_image.get_affine()), self._gen_outfilename())
+        return runtime
+
+    def _gen_outfilename(self):
+        if isdefined(self.inputs.out_file):
+            return op.abspath(self.inputs.out_file)
+        _, name, _ = split_filename(self.inputs.pet_file)
+        return op.abspath(name + "_" + self.inputs.method + ".nii.gz")
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['corrected_pet'] = self._gen_outfilename()
+        return outputs
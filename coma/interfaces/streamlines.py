@@ -0,0 +1,984 @@
+import os
+import os.path as op
+import numpy as np
+import nibabel as nb
+from nipype import logging
+iflogger = logging.getLogger('interface')
+
+# TrackVis version 2 header (1000 bytes)
+TRK_HEADER_DTYPE = np.dtype([('id_string', 'S6'), ('dim', '<i2', (3,)),
+    ('voxel_size', '<f4', (3,)), ('origin', '<f4', (3,)), ('n_scalars', '<i2'),
+    ('scalar_name', 'S20', (10,)), ('n_properties', '<i2'),
+    ('property_name', 'S20', (10,)), ('vox_to_ras', '<f4', (4, 4)),
+    ('reserved', 'S444'), ('voxel_order', 'S4'), ('pad2', 'S4'),
+    ('image_orientation_patient', '<f4', (6,)), ('pad1', 'S2'),
+    ('invert_x', 'S1'), ('invert_y', 'S1'), ('invert_z', 'S1'),
+    ('swap_xy', 'S1'), ('swap_yz', 'S1'), ('swap_zx', 'S1'),
+    ('n_count', '<i4'), ('version', '<i4'), ('hdr_size', '<i4')])
+TRK_COUNT_OFFSET = 988
+TCK_DATATYPES = {'Float32LE': '<f4', 'Float32BE': '>f4',
+                 'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+
+def apply_affine(affine, points):
+    '''
+    Applies a 4x4 affine to an (N, 3) array of points
+    '''
+    affine = np.asarray(affine, dtype=np.float64)
+    return (np.dot(points, affine[0:3, 0:3].T) + affine[0:3, 3]).astype(np.float32)
+
+
+def read_trk_header(track_file):
+    '''
+    Reads the 1000 byte header of a TrackVis file (as a 0-d structured
+    array in the byte order of the file)
+    '''
+    with open(track_file, 'rb') as f:
+        buf = f.read(TRK_HEADER_DTYPE.itemsize)
+    for dtype in (TRK_HEADER_DTYPE, TRK_HEADER_DTYPE.newbyteorder('>')):
+        header = np.frombuffer(buf, dtype).copy().reshape(())
+        if header['hdr_size'] == TRK_HEADER_DTYPE.itemsize:
+            return header
+    raise ValueError('%s is not a TrackVis file' % track_file)
+
+
+def read_tck_header(track_file):
+    '''
+    Reads the key: value pairs of an MRtrix .tck header as a dict
+    '''
+    header = {}
+    with open(track_file, 'rb') as f:
+        magic = f.readline().strip()
+        if magic != b'mrtrix tracks':
+            raise ValueError('%s is not an MRtrix track file' % track_file)
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            header[key.strip()] = value.strip()
+    return header
+
+
+def trk_header_for_image(image_file, n_properties=0, property_names=None):
+    '''
+    Builds a TrackVis header whose geometry is that of a NIfTI image
+    '''
+    image = nb.load(image_file)
+    affine = image.get_affine()
+    header = np.zeros((), dtype=TRK_HEADER_DTYPE)
+    header['id_string'] = b'TRACK'
+    header['dim'] = image.shape[0:3]
+    header['voxel_size'] = image.get_header().get_zooms()[0:3]
+    header['vox_to_ras'] = affine
+    header['voxel_order'] = ''.join(nb.aff2axcodes(affine)).encode('latin-1')
+    header['n_properties'] = n_properties
+    for idx, name in enumerate(property_names or []):
+        header['property_name'][idx] = name.encode('latin-1')
+    header['version'] = 2
+    header['hdr_size'] = TRK_HEADER_DTYPE.itemsize
+    return header
+
+
+def trk_voxmm_to_rasmm(header):
+    '''
+    Returns the affine from TrackVis voxmm coordinates, where voxel centres
+    are at (i + 0.5) * voxel size, to RAS+ millimetres
+    '''
+    voxel_size = np.asarray(header['voxel_size'], dtype=np.float64)
+    if np.any(voxel_size == 0):
+        raise ValueError('The TrackVis header has no voxel size')
+    vox_to_ras = np.asarray(header['vox_to_ras'], dtype=np.float64)
+    if vox_to_ras[3, 3] == 0:
+        raise ValueError('The TrackVis header has no vox_to_ras affine, '
+                         'give a reference image')
+    voxmm_to_vox = np.eye(4)
+    voxmm_to_vox[0:3, 0:3] = np.diag(1 / voxel_size)
+    voxmm_to_vox[0:3, 3] = -0.5
+    return np.dot(vox_to_ras, voxmm_to_vox)
+
+
+class Tractogram(object):
+    '''
+    Streamlines of a .tck or .trk file, read through a memory map.
+
+    The file is scanned once for the position and length of every
+    streamline; the points are only read when a streamline or a chunk of
+    streamlines is requested. to_rasmm maps the stored coordinates to RAS+
+    millimetres (identity for .tck, voxmm to world for .trk).
+
+    Example
+    -------
+
+    >>> from coma.interfaces.streamlines import load_tractogram
+    >>> tracts = load_tractogram('Bend1_fiber_tracks.tck')   # doctest: +SKIP
+    >>> for points, offsets in tracts.iter_chunks(100000):   # doctest: +SKIP
+    ...     lengths = np.diff(offsets)
+    '''
+
+    def __init__(self, track_file, reference=None):
+        self.track_file = op.abspath(track_file)
+        if track_file.endswith('.tck'):
+            self._scan_tck()
+        elif track_file.endswith('.trk'):
+            self._scan_trk(reference)
+        else:
+            raise ValueError('Unknown streamline format: %s' % track_file)
+
+    def _scan_tck(self, rows_per_block=2 ** 22):
+        self.format = 'tck'
+        self.header = read_tck_header(self.track_file)
+        datatype = self.header.get('datatype', 'Float32LE')
+        if datatype not in TCK_DATATYPES:
+            raise ValueError('Unsupported .tck datatype: %s' % datatype)
+        offset = int(self.header['file'].split()[1])
+        dtype = np.dtype(TCK_DATATYPES[datatype])
+        n_rows = (op.getsize(self.track_file) - offset) // (3 * dtype.itemsize)
+        self.data = np.memmap(self.track_file, dtype=dtype, mode='r', offset=offset,
+                              shape=(n_rows * 3,))
+        self.stride = 3
+        self.n_scalars = 0
+        self.n_properties = 0
+        self.to_rasmm = np.eye(4)
+
+        # Streamlines end with a row of NaNs, the file with a row of Infs
+        rows = self.data.reshape(n_rows, 3)
+        delimiters = []
+        end = n_rows
+        for start in range(0, n_rows, rows_per_block):
+            block = np.asarray(rows[start:start + rows_per_block, 0])
+            delimiters.append(np.where(np.isnan(block))[0] + start)
+            infinite = np.where(np.isinf(block))[0]
+            if len(infinite):
+                end = start + infinite[0]
+                delimiters[-1] = delimiters[-1][delimiters[-1] < end]
+                break
+        delimiters = np.concatenate(delimiters).astype(np.int64)
+        first_rows = np.concatenate([[0], delimiters[:-1] + 1]).astype(np.int64)
+        self.lengths = delimiters - first_rows
+        self.starts = first_rows * 3
+
+    def _scan_trk(self, reference=None):
+        self.format = 'trk'
+        self.header = read_trk_header(self.track_file)
+        self.n_scalars = int(self.header['n_scalars'])
+        self.n_properties = int(self.header['n_properties'])
+        self.stride = 3 + self.n_scalars
+        dtype = np.dtype(self.header.dtype['hdr_size'].str[0] + 'f4')
+        n_values = (op.getsize(self.track_file) - TRK_HEADER_DTYPE.itemsize) // 4
+        self.data = np.memmap(self.track_file, dtype=dtype, mode='r',
+                              offset=TRK_HEADER_DTYPE.itemsize, shape=(n_values,))
+        counts = self.data.view(dtype.str.replace('f', 'i'))
+
+        # Each streamline is its point count followed by its points and
+        # properties, so the positions can only be found one after the other
+        starts = []
+        lengths = []
+        position = 0
+        n_count = int(self.header['n_count'])
+        while position < n_values and (n_count == 0 or len(starts) < n_count):
+            n_points = int(counts[position])
+            starts.append(position + 1)
+            lengths.append(n_points)
+            position += 1 + n_points * self.stride + self.n_properties
+        self.starts = np.array(starts, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+
+        header = self.header
+        if reference is not None and header['vox_to_ras'][3, 3] == 0:
+            header = trk_header_for_image(reference)
+            if np.all(self.header['voxel_size'] > 0):
+                header['voxel_size'] = self.header['voxel_size']
+        self.to_rasmm = trk_voxmm_to_rasmm(header)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def n_points(self):
+        return int(self.lengths.sum())
+
+    def __getitem__(self, index):
+        '''
+        Returns the points of one streamline, in stored coordinates, as a
+        view into the memory map
+        '''
+        start = self.starts[index]
+        n_points = self.lengths[index]
+        return self.data[start:start + n_points * self.stride].reshape(
+            n_points, self.stride)[:, 0:3]
+
+    def _gather(self, first, last, columns):
+        starts = self.starts[first:last]
+        lengths = self.lengths[first:last]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # Position of the first value of every point of the chunk
+        point_in_streamline = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        rows = np.repeat(starts, lengths) + point_in_streamline * self.stride
+        values = np.asarray(self.data[rows[:, np.newaxis] + np.asarray(columns)])
+        return values, offsets
+
+    def iter_chunks(self, chunk_size=100000, space='rasmm', scalars=False):
+        '''
+        Yields the streamlines chunk_size at a time as (points, offsets),
+        points being an (N, 3) float32 array of the concatenated streamlines
+        and offsets the (chunk_size + 1) positions where they start and end.
+        Points are in RAS+ mm, or as stored if space is 'native'. With
+        scalars, the per-point scalars of a .trk are yielded as a third
+        (N, n_scalars) array.
+        '''
+        for first in range(0, len(self), chunk_size):
+            last = min(first + chunk_size, len(self))
+            points, offsets = self._gather(first, last, [0, 1, 2])
+            if space == 'rasmm':
+                points = apply_affine(self.to_rasmm, points)
+            elif space != 'native':
+                raise ValueError('Unknown space: %s' % space)
+            points = points.astype(np.float32)
+            if scalars:
+                values, _ = self._gather(first, last, list(range(3, self.stride)))
+                yield points, offsets, values.astype(np.float32)
+            else:
+                yield points, offsets
+
+    def streamlines(self, space='rasmm', chunk_size=100000):
+        '''
+        Yields the streamlines one at a time as (n_points, 3) arrays
+        '''
+        for points, offsets in self.iter_chunks(chunk_size, space):
+            for start, stop in zip(offsets[:-1], offsets[1:]):
+                yield points[start:stop]
+
+    def properties(self):
+        '''
+        Returns the (streamlines, n_properties) properties of a .trk
+        '''
+        if self.n_properties == 0:
+            return np.zeros((len(self), 0), dtype=np.float32)
+        rows = self.starts + self.lengths * self.stride
+        return np.asarray(self.data[rows[:, np.newaxis] + np.arange(self.n_properties)])
+
+
+def load_tractogram(track_file, reference=None):
+    '''
+    Opens a .tck or .trk file (see Tractogram). A reference image gives
+    the geometry of a .trk whose header has no vox_to_ras.
+    '''
+    return Tractogram(track_file, reference)
+
+
+class StreamlineWriter(object):
+    '''
+    Appends streamlines to a .tck or .trk file without holding them in
+    memory. The streamline count is written to the header on close().
+    Points are given in RAS+ mm, or as stored if space is 'native'. A
+    .trk needs a header (see trk_header_for_image) for its geometry.
+    '''
+
+    def __init__(self, out_file, header=None, space='rasmm'):
+        self.out_file = op.abspath(out_file)
+        self.space = space
+        self.count = 0
+        if out_file.endswith('.tck'):
+            self.format = 'tck'
+            self.from_rasmm = np.eye(4)
+            self.n_properties = 0
+            self._start_tck(header or {})
+        elif out_file.endswith('.trk'):
+            if header is None:
+                raise ValueError('A TrackVis header is required to write %s' % out_file)
+            self.format = 'trk'
+            self.header = np.array(header, dtype=TRK_HEADER_DTYPE)
+            self.header['n_scalars'] = 0
+            self.header['n_count'] = 0
+            self.n_properties = int(self.header['n_properties'])
+            self.from_rasmm = np.linalg.inv(trk_voxmm_to_rasmm(self.header))
+            self.fobj = open(self.out_file, 'wb')
+            self.fobj.write(self.header.tobytes())
+        else:
+            raise ValueError('Unknown streamline format: %s' % out_file)
+
+    def _start_tck(self, header):
+        lines = [b'mrtrix tracks', b'datatype: Float32LE']
+        for key, value in sorted(header.items()):
+            if key not in ('datatype', 'count', 'file', 'total_count'):
+                lines.append(('%s: %s' % (key, value)).encode('latin-1'))
+        # Fixed width count, so it can be rewritten in place
+        lines.append(b'count: %010d' % 0)
+        self._count_position = len(b'\n'.join(lines)) - 10
+        text = b'\n'.join(lines) + b'\n'
+        base = len(text) + len(b'file: . \nEND\n')
+        offset = base + 1
+        while base + len(str(offset)) > offset:
+            offset = base + len(str(offset))
+        text += ('file: . %d\nEND\n' % offset).encode('latin-1')
+        self.fobj = open(self.out_file, 'wb')
+        self.fobj.write(text)
+        self.fobj.write(b'\x00' * (offset - len(text)))
+
+    def append(self, points, offsets=None, properties=None):
+        '''
+        Appends the streamlines of a flat (N, 3) point array split at
+        offsets (a single streamline if offsets is None). properties is a
+        (streamlines, n_properties) array for a .trk.
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if offsets is None:
+            offsets = [0, len(points)]
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n_streamlines = len(offsets) - 1
+        if self.space == 'rasmm':
+            points = apply_affine(self.from_rasmm, points)
+        points = points.astype('<f4')
+        lengths = np.diff(offsets)
+
+        if self.format == 'tck':
+            # One row of NaNs after every streamline
+            rows = np.empty((len(points) + n_streamlines, 3), dtype='<f4')
+            rows.fill(np.nan)
+            point_rows = np.arange(len(points)) + np.repeat(np.arange(n_streamlines), lengths)
+            rows[point_rows] = points
+            self.fobj.write(rows.tobytes())
+        else:
+            if properties is None:
+                properties = np.zeros((n_streamlines, self.n_properties))
+            properties = np.asarray(properties, dtype='<f4').reshape(n_streamlines, self.n_properties)
+            # Point count, points and properties of every streamline
+            record_sizes = 1 + 3 * lengths + self.n_properties
+            record_starts = np.concatenate([[0], np.cumsum(record_sizes)]).astype(np.int64)
+            values = np.empty(record_starts[-1], dtype='<f4')
+            values[record_starts[:-1]] = lengths.astype('<i4').view('<f4')
+            point_in_streamline = np.arange(len(points)) - np.repeat(offsets[:-1], lengths)
+            positions = np.repeat(record_starts[:-1] + 1, lengths) + 3 * point_in_streamline
+            values[positions[:, np.newaxis] + np.arange(3)] = points
+            if self.n_properties:
+                property_starts = record_starts[1:] - self.n_properties
+                values[property_starts[:, np.newaxis] + np.arange(self.n_properties)] = properties
+            self.fobj.write(values.tobytes())
+        self.count += n_streamlines
+
+    def append_streamlines(self, streamlines, properties=None):
+        streamlines = list(streamlines)
+        if not streamlines:
+            return
+        lengths = [len(s) for s in streamlines]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.append(np.concatenate(streamlines), offsets, properties)
+
+    def close(self):
+        if self.fobj.closed:
+            return self.out_file
+        if self.format == 'tck':
+            self.fobj.write(np.array([np.inf] * 3, dtype='<f4').tobytes())
+            self.fobj.seek(self._count_position)
+            self.fobj.write(b'%010d' % self.count)
+        else:
+            self.fobj.seek(TRK_COUNT_OFFSET)
+            self.fobj.write(np.array(self.count, dtype='<i4').tobytes())
+        self.fobj.close()
+        return self.out_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def flirt_voxel_affine(matrix_file, in_file, reference_file):
+    '''
+    Converts a FLIRT matrix, which works on scaled voxel coordinates (with
+    x flipped for images with a positive determinant), into an affine from
+    the voxel indices of in_file to those of reference_file
+    '''
+    def scaled_voxels(image):
+        zooms = image.get_header().get_zooms()[0:3]
+        scaling = np.diag(list(zooms) + [1.])
+        if np.linalg.det(image.get_affine()) > 0:
+            flip = np.eye(4)
+            flip[0, 0] = -1
+            flip[0, 3] = image.shape[0] - 1
+            scaling = np.dot(scaling, flip)
+        return scaling
+    in_image = nb.load(in_file)
+    reference = nb.load(reference_file)
+    matrix = np.loadtxt(matrix_file)
+    return np.dot(np.linalg.inv(scaled_voxels(reference)),
+                  np.dot(matrix, scaled_voxels(in_image)))
+
+
+def convert_tractogram(in_file, out_file, image_file, registration_image_file=None,
+                       matrix_file=None, chunk_size=100000):
+    '''
+    Converts between .tck and .trk, chunk_size streamlines at a time. The
+    .trk geometry is that of image_file or, when a FLIRT matrix_file from
+    image_file to registration_image_file is given, of the registration
+    image, the streamlines being moved with it (as MRTrix2TrackVis does).
+
+    Example
+    -------
+
+    >>> from coma.interfaces.streamlines import convert_tractogram
+    >>> convert_tractogram('tracks.tck', 'tracks.trk', 'fa.nii.gz')   # doctest: +SKIP
+    '''
+    tractogram = load_tractogram(in_file, reference=image_file)
+    world = np.eye(4)
+    header_image = image_file
+    if matrix_file is not None and registration_image_file is not None:
+        image = nb.load(image_file)
+        registration = nb.load(registration_image_file)
+        voxels = flirt_voxel_affine(matrix_file, image_file, registration_image_file)
+        world = np.dot(registration.get_affine(),
+                       np.dot(voxels, np.linalg.inv(image.get_affine())))
+        header_image = registration_image_file
+
+    header = None
+    if out_file.endswith('.trk'):
+        header = trk_header_for_image(header_image)
+    elif tractogram.format == 'tck':
+        header = tractogram.header
+    writer = StreamlineWriter(out_file, header)
+    try:
+        for points, offsets in tractogram.iter_chunks(chunk_size):
+            writer.append(apply_affine(world, points), offsets)
+    finally:
+        writer.close()
+    return writer.out_file
+
+
+def merge_tractograms(in_files, out_file, reference=None, chunk_size=100000):
+    '''
+    Concatenates streamline files into one .tck or .trk. In a merged .trk
+    the first property of every streamline is the index of the file it
+    came from, so TrackVis scenes can show each input as its own track
+    group (as TrackVis' track_merge does). The geometry of a merged .trk
+    is that of the reference image, or of the first .trk input.
+    '''
+    header = None
+    if out_file.endswith('.trk'):
+        if reference is not None:
+            header = trk_header_for_image(reference, 1, ['source'])
+        else:
+            trk_files = [f for f in in_files if f.endswith('.trk')]
+            if not trk_files:
+                raise ValueError('A reference image is required to merge into %s' % out_file)
+            header = np.array(read_trk_header(trk_files[0]), dtype=TRK_HEADER_DTYPE)
+            header['n_properties'] = 1
+            header['property_name'] = b''
+            header['property_name'][0] = b'source'
+    writer = StreamlineWriter(out_file, header)
+    try:
+        for index, in_file in enumerate(in_files):
+            tractogram = load_tractogram(in_file, reference)
+            for points, offsets in tractogram.iter_chunks(chunk_size):
+                properties = None
+                if writer.format == 'trk':
+                    properties = np.empty((len(offsets) - 1, 1))
+                    properties.fill(index)
+                writer.append(points, offsets, properties)
+    finally:
+        writer.close()
+    return writer.out_file
+
+
+def voxel_lookup(points, data, rasmm_to_vox):
+    '''
+    Returns the values of a 3D array at the voxels nearest to (N, 3) RAS+
+    mm points, 0 for points outside the image
+    '''
+    voxels = np.round(apply_affine(rasmm_to_vox, points)).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < data.shape[0:3]), axis=1)
+    values = np.zeros(len(points), dtype=data.dtype)
+    voxels = voxels[inside]
+    values[inside] = data[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+    return values
+
+
+def assign_streamlines(track_file, roi_file, rois=None, endpoints_only=True,
+                       chunk_size=100000):
+    '''
+    Assigns every streamline to the ROIs of a label image in one pass over
+    the tractogram, looking up the voxel of each point (as MRtrix'
+    -assignment_voxel_lookup does).
+
+    With endpoints_only, returns a (streamlines, 2) int32 array with the
+    sorted indices into rois of the ROIs at both ends, -1 where an end is
+    outside every ROI. Otherwise returns a uint64 bitmask per streamline
+    of the ROIs any of its points pass through (at most 64 ROIs).
+    '''
+    roi_image = nb.load(roi_file)
+    labels = np.asarray(roi_image.get_data()).astype(int)
+    if rois is None:
+        rois = [r for r in np.unique(labels) if r != 0]
+    if not endpoints_only and len(rois) > 64:
+        raise ValueError('At most 64 ROIs can be assigned from all points, got %d' % len(rois))
+    # Label value -> ROI index + 1, so that 0 stays background
+    lookup = np.zeros(labels.max() + 1, dtype=np.int32)
+    lookup[np.asarray(rois, dtype=int)] = np.arange(1, len(rois) + 1)
+    index = lookup[np.clip(labels, 0, None)]
+    rasmm_to_vox = np.linalg.inv(roi_image.get_affine())
+
+    tractogram = load_tractogram(track_file, reference=roi_file)
+    if endpoints_only:
+        assignment = np.empty((len(tractogram), 2), dtype=np.int32)
+    else:
+        assignment = np.zeros(len(tractogram), dtype=np.uint64)
+    first = 0
+    for points, offsets in tractogram.iter_chunks(chunk_size):
+        last = first + len(offsets) - 1
+        lengths = np.diff(offsets)
+        nonempty = lengths > 0
+        if endpoints_only:
+            ends = np.zeros((last - first, 2), dtype=np.int32)
+            ends[nonempty, 0] = voxel_lookup(points[offsets[:-1][nonempty]], index, rasmm_to_vox)
+            ends[nonempty, 1] = voxel_lookup(points[offsets[1:][nonempty] - 1], index, rasmm_to_vox)
+            ends.sort(axis=1)
+            assignment[first:last] = ends - 1
+        else:
+            visited = voxel_lookup(points, index, rasmm_to_vox).astype(np.uint64)
+            bits = np.where(visited > 0, np.left_shift(np.uint64(1), visited - np.uint64(1)),
+                            np.uint64(0))
+            masks = np.zeros(last - first, dtype=np.uint64)
+            if nonempty.any():
+                masks[nonempty] = np.bitwise_or.reduceat(bits, offsets[:-1][nonempty])
+            assignment[first:last] = masks
+        first = last
+    return assignment
+
+
+def _select_streamlines(points, offsets, selected):
+    lengths = np.diff(offsets)[selected]
+    point_in_streamline = np.arange(lengths.sum()) - np.repeat(
+        np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    rows = np.repeat(offsets[:-1][selected], lengths) + point_in_streamline
+    return points[rows], np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def extract_pair_tracks(track_file, roi_file, pair_files, endpoints_only=True,
+                        chunk_size=100000, max_open_files=256):
+    '''
+    Writes the streamlines connecting each pair of ROIs to its own file,
+    replacing one tcknodeextract or FilterTracks run per pair with a single
+    assignment pass (see assign_streamlines). pair_files maps (label_i,
+    label_j) to an output file. With endpoints_only a streamline belongs to
+    the pair of ROIs at its ends (label_i == label_j selects streamlines
+    with both ends in one ROI), otherwise to every pair of ROIs it passes
+    through. A file is written for every pair, empty or not. Returns a dict
+    of streamline counts per pair.
+
+    Example
+    -------
+
+    >>> from coma.interfaces.streamlines import extract_pair_tracks
+    >>> pairs = {(1, 2): 'Bend1_1-2.tck', (1, 3): 'Bend1_1-3.tck'}
+    >>> extract_pair_tracks('tracks.tck', 'rois.nii.gz', pairs)   # doctest: +SKIP
+    '''
+    pairs = sorted(pair_files)
+    rois = sorted(set(int(r) for pair in pairs for r in pair))
+    roi_index = dict((roi, idx) for idx, roi in enumerate(rois))
+    assignment = assign_streamlines(track_file, roi_file, rois, endpoints_only, chunk_size)
+
+    tractogram = load_tractogram(track_file, reference=roi_file)
+    # Outputs in the input format keep its header and stored coordinates
+    same_format = all(f.endswith('.' + tractogram.format) for f in pair_files.values())
+    space = 'native' if same_format else 'rasmm'
+
+    def header_for(out_file):
+        if out_file.endswith('.' + tractogram.format):
+            return tractogram.header
+        if out_file.endswith('.trk'):
+            return trk_header_for_image(roi_file)
+        return None
+
+    counts = {}
+    # Writers are kept open for max_open_files pairs at a time, the
+    # tractogram being read once per batch
+    for batch_start in range(0, len(pairs), max_open_files):
+        batch = pairs[batch_start:batch_start + max_open_files]
+        selectors = []
+        for pair in batch:
+            idx_i, idx_j = sorted(roi_index[int(r)] for r in pair)
+            if endpoints_only:
+                selectors.append((idx_i, idx_j))
+            else:
+                selectors.append(np.uint64((1 << idx_i) | (1 << idx_j)))
+        writers = [StreamlineWriter(pair_files[pair], header_for(pair_files[pair]), space)
+                   for pair in batch]
+        try:
+            first = 0
+            for points, offsets in tractogram.iter_chunks(chunk_size, space):
+                last = first + len(offsets) - 1
+                chunk = assignment[first:last]
+                for writer, selector in zip(writers, selectors):
+                    if endpoints_only:
+                        selected = np.flatnonzero((chunk[:, 0] == selector[0]) &
+                                                   (chunk[:, 1] == selector[1]))
+                    else:
+                        selected = np.flatnonzero(chunk & selector == selector)
+                    if len(selected):
+                        writer.append(*_select_streamlines(points, offsets, selected))
+                first = last
+        finally:
+            for writer in writers:
+                writer.close()
+        for pair, writer in zip(batch, writers):
+            counts[pair] = writer.count
+    return counts
+
+
+def _subdivide(points, offsets, step):
+    # Inserts points along every segment longer than step
+    lengths = np.diff(offsets)
+    is_last = np.zeros(len(points), dtype=bool)
+    is_last[offsets[1:][lengths > 0] - 1] = True
+    segment_starts = np.flatnonzero(~is_last)
+    delta = points[segment_starts + 1] - points[segment_starts]
+    n_steps = np.maximum(1, np.ceil(np.sqrt((delta ** 2).sum(axis=1)) / step)).astype(np.int64)
+    counts = np.ones(len(points), dtype=np.int64)
+    counts[segment_starts] = n_steps
+    increments = np.zeros(points.shape, dtype=np.float64)
+    increments[segment_starts] = delta / n_steps[:, np.newaxis]
+    source = np.repeat(np.arange(len(points)), counts)
+    cumulative = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    within = np.arange(cumulative[-1]) - np.repeat(cumulative[:-1], counts)
+    return points[source] + within[:, np.newaxis] * increments[source], cumulative[offsets]
+
+
+def track_density(track_file, image_file, step=0.5, chunk_size=100000):
+    '''
+    Returns the track density image of a tractogram on the grid of
+    image_file: the number of streamlines passing through each voxel (as
+    tracks2prob). Segments are subdivided every step voxels so that voxels
+    crossed between two points are counted.
+    '''
+    image = nb.load(image_file)
+    shape = image.shape[0:3]
+    n_voxels = int(np.prod(shape))
+    rasmm_to_vox = np.linalg.inv(image.get_affine())
+    density = np.zeros(n_voxels, dtype=np.int64)
+    tractogram = load_tractogram(track_file, reference=image_file)
+    for points, offsets in tractogram.iter_chunks(chunk_size):
+        voxels, offsets = _subdivide(apply_affine(rasmm_to_vox, points), offsets, step)
+        voxels = np.round(voxels).astype(np.int64)
+        streamline = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+        linear = np.ravel_multi_index(voxels[inside].T, shape)
+        # Each streamline counts once in every voxel it visits
+        visits = np.unique(streamline[inside] * n_voxels + linear)
+        density += np.bincount(visits % n_voxels, minlength=n_voxels)
+    return density.reshape(shape)
+
+
+class StreamlineIndex(object):
+    '''
+    Voxel index of the streamlines of a tractogram on the grid of an image.
+
+    For every voxel crossed by at least one streamline, the index holds
+    the sorted ids of those streamlines (in compressed sparse row form:
+    the occupied voxels, pointers into the id array, and the ids), so that
+    include / exclude queries against any mask or label set only have to
+    look up the voxels of the mask. It is built in one pass over the
+    tractogram and cached next to the track file.
+
+    Example
+    -------
+
+    >>> from coma.interfaces.streamlines import load_streamline_index
+    >>> index = load_streamline_index('tracks.tck', 'rois.nii.gz')   # doctest: +SKIP
+    >>> labels = nb.load('rois.nii.gz').get_data()   # doctest: +SKIP
+    >>> ids = index.query_labels(labels, include=[3, 5], exclude=[9])   # doctest: +SKIP
+    '''
+
+    def __init__(self, voxels, pointers, streamline_ids, shape, affine, n_streamlines,
+                 step=None):
+        self.voxels = voxels
+        self.pointers = pointers
+        self.streamline_ids = streamline_ids
+        self.shape = tuple(int(s) for s in shape)
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.n_streamlines = int(n_streamlines)
+        # Sampling step (in voxels) along the streamlines, None if unknown
+        self.step = None if step is None else float(step)
+
+    @classmethod
+    def build(cls, track_file, image_file, step=0.5, chunk_size=100000):
+        image = nb.load(image_file)
+        shape = image.shape[0:3]
+        rasmm_to_vox = np.linalg.inv(image.get_affine())
+        tractogram = load_tractogram(track_file, reference=image_file)
+        n_streamlines = len(tractogram)
+        # (voxel, streamline) pairs encoded as voxel * n_streamlines + id,
+        # so that one sort orders them by voxel and then by streamline
+        keys = []
+        first = 0
+        for points, offsets in tractogram.iter_chunks(chunk_size):
+            voxels, offsets = _subdivide(apply_affine(rasmm_to_vox, points), offsets, step)
+            voxels = np.round(voxels).astype(np.int64)
+            streamline = np.repeat(np.arange(first, first + len(offsets) - 1), np.diff(offsets))
+            inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+            linear = np.ravel_multi_index(voxels[inside].T, shape)
+            keys.append(np.unique(linear * n_streamlines + streamline[inside]))
+            first += len(offsets) - 1
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        keys.sort()
+        voxels, starts = np.unique(keys // max(n_streamlines, 1), return_index=True)
+        pointers = np.concatenate([starts, [len(keys)]]).astype(np.int64)
+        streamline_ids = (keys % max(n_streamlines, 1)).astype(np.int32)
+        return cls(voxels, pointers, streamline_ids, shape, image.get_affine(), n_streamlines,
+                   step)
+
+    def save(self, out_file):
+        np.savez(out_file, voxels=self.voxels, pointers=self.pointers,
+                 streamline_ids=self.streamline_ids, shape=self.shape,
+                 affine=self.affine, n_streamlines=self.n_streamlines,
+                 step=np.nan if self.step is None else self.step)
+        return op.abspath(out_file)
+
+    @classmethod
+    def load(cls, in_file):
+        index = np.load(in_file)
+        step = None
+        if 'step' in index.files and np.isfinite(index['step']):
+            step = index['step']
+        return cls(index['voxels'], index['pointers'], index['streamline_ids'],
+                   index['shape'], index['affine'], index['n_streamlines'], step)
+
+    def streamlines_in(self, mask):
+        '''
+        Returns the sorted ids of the streamlines passing through a boolean
+        mask on the index grid
+        '''
+        mask = np.asarray(mask)
+        if mask.shape[0:3] != self.shape:
+            raise ValueError('Mask shape %s does not match the index grid %s'
+                             % (mask.shape, self.shape))
+        wanted = np.flatnonzero(mask.ravel())
+        positions = np.searchsorted(self.voxels, wanted)
+        positions = positions[positions < len(self.voxels)]
+        positions = positions[np.in1d(self.voxels[positions], wanted)]
+        lengths = self.pointers[positions + 1] - self.pointers[positions]
+        rows = np.repeat(self.pointers[positions] - np.concatenate([[0], np.cumsum(lengths)[:-1]]),
+                         lengths) + np.arange(lengths.sum())
+        return np.unique(self.streamline_ids[rows]).astype(np.int64)
+
+    def query(self, include=(), exclude=()):
+        '''
+        Returns the ids of the streamlines passing through every include
+        mask and through none of the exclude masks (all streamlines if no
+        include mask is given)
+        '''
+        selected = np.arange(self.n_streamlines)
+        for mask in include:
+            selected = np.intersect1d(selected, self.streamlines_in(mask), assume_unique=True)
+        for mask in exclude:
+            selected = np.setdiff1d(selected, self.streamlines_in(mask), assume_unique=True)
+        return selected
+
+    def query_labels(self, labels, include=(), exclude=()):
+        '''
+        As query, with one mask per label value of a label image; a list of
+        values as one item stands for their union
+        '''
+        def masks(values):
+            return [np.in1d(labels, np.ravel(value)).reshape(labels.shape) for value in values]
+        return self.query(masks(include), masks(exclude))
+
+
+def load_streamline_index(track_file, image_file, cache_file=None, step=0.5, chunk_size=100000):
+    '''
+    Returns the StreamlineIndex of a track file on the grid of image_file,
+    reading it from cache_file (<track file>_index.npz by default) when it
+    was built from the same tractogram, grid and step, and building and
+    caching it otherwise. If the cache cannot be written there (e.g. the
+    track file is in a read-only directory), it goes to the working
+    directory instead.
+    '''
+    if cache_file is None:
+        cache_file = op.splitext(op.abspath(track_file))[0] + '_index.npz'
+    cache_file = op.abspath(cache_file)
+    cache_files = [cache_file]
+    local_cache_file = op.join(os.getcwd(), op.basename(cache_file))
+    if local_cache_file != cache_file:
+        cache_files.append(local_cache_file)
+
+    image = nb.load(image_file)
+    for in_file in cache_files:
+        if op.exists(in_file) and op.getmtime(in_file) >= op.getmtime(track_file):
+            index = StreamlineIndex.load(in_file)
+            if (index.shape == image.shape[0:3] and np.allclose(index.affine, image.get_affine())
+                    and index.step is not None and np.isclose(index.step, step)):
+                return index
+    index = StreamlineIndex.build(track_file, image_file, step, chunk_size)
+    for out_file in cache_files:
+        try:
+            index.save(out_file)
+            break
+        except (IOError, OSError) as e:
+            iflogger.warning('Could not cache the streamline index as {f}: {e}'.format(f=out_file, e=e))
+    return index
+
+
+def write_streamlines(track_file, streamline_ids, out_file, reference=None, chunk_size=100000):
+    '''
+    Writes the streamlines with the given ids (e.g. from a StreamlineIndex
+    query) to out_file in one pass over the track file
+    '''
+    tractogram = load_tractogram(track_file, reference)
+    streamline_ids = np.asarray(streamline_ids, dtype=np.int64)
+    if out_file.endswith('.' + tractogram.format):
+        writer = StreamlineWriter(out_file, tractogram.header, 'native')
+    elif out_file.endswith('.trk'):
+        if reference is None:
+            raise ValueError('A reference image is required to write %s' % out_file)
+        writer = StreamlineWriter(out_file, trk_header_for_image(reference))
+    else:
+        writer = StreamlineWriter(out_file)
+    try:
+        first = 0
+        for points, offsets in tractogram.iter_chunks(chunk_size, writer.space):
+            last = first + len(offsets) - 1
+            selected = streamline_ids[(streamline_ids >= first) & (streamline_ids < last)] - first
+            if len(selected):
+                writer.append(*_select_streamlines(points, offsets, selected))
+            first = last
+    finally:
+        writer.close()
+    return writer.out_file
+
+
+def filter_tracks(track_file, roi_file, include=None, exclude=None, out_file=None):
+    '''
+    Keeps the streamlines passing through every ROI label in include and
+    through none in exclude, as FilterTracks with one mask per label but
+    without writing the masks. Items of include / exclude may be lists of
+    labels, standing for their union. Without include, streamlines passing
+    through any ROI are kept. The voxel index is cached next to the
+    track file, so further queries do not read the tractogram again.
+    '''
+    import os.path as op
+    import numpy as np
+    import nibabel as nb
+    from coma.interfaces.streamlines import load_streamline_index, write_streamlines
+    from nipype.utils.filemanip import split_filename
+    labels = nb.load(roi_file).get_data()
+    index = load_streamline_index(track_file, roi_file)
+    if include is None:
+        include = [[l for l in np.unique(labels) if l != 0]]
+    ids = index.query_labels(labels, include, exclude or [])
+    if out_file is None:
+        _, name, ext = split_filename(track_file)
+        out_file = op.abspath(name + "_filtered" + ext)
+    return write_streamlines(track_file, ids, out_file, reference=roi_file)
+
+
+def resample_streamlines(points, offsets, n_points):
+    '''
+    Resamples every streamline of a flat (N, 3) point array split at offsets
+    to n_points points equally spaced along its length. Returns an
+    (streamlines, n_points, 3) array.
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    n_streamlines = len(lengths)
+    if np.any(lengths == 0):
+        raise ValueError('Cannot resample empty streamlines')
+    # Arc length at every point, continuing across streamlines (the step
+    # from the last point of one streamline to the next one is not counted)
+    steps = np.zeros(len(points))
+    steps[1:] = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    steps[offsets[:-1]] = 0
+    arc = np.cumsum(steps)
+    base = arc[offsets[:-1]]
+    total = arc[offsets[1:] - 1] - base
+
+    fractions = np.linspace(0, 1, n_points)
+    targets = base[:, np.newaxis] + total[:, np.newaxis] * fractions
+    # Segment (point, point + 1) holding each target, kept inside its streamline
+    first = np.repeat(offsets[:-1], n_points).reshape(n_streamlines, n_points)
+    last_segment = np.maximum(offsets[1:] - 2, offsets[:-1])
+    segment = np.searchsorted(arc, targets, side='right') - 1
+    segment = np.clip(segment, first, last_segment[:, np.newaxis])
+    following = np.minimum(segment + 1, (offsets[1:] - 1)[:, np.newaxis])
+    span = arc[following] - arc[segment]
+    weight = np.zeros(span.shape)
+    np.divide(targets - arc[segment], span, out=weight, where=span > 0)
+    weight = np.clip(weight, 0, 1)[..., np.newaxis]
+    return points[segment] * (1 - weight) + points[following] * weight
+
+
+def orient_streamlines(resampled, start_point=None):
+    '''
+    Flips resampled streamlines so that they all run the same way: from the
+    end nearest start_point if given, otherwise in the direction of the
+    first streamline
+    '''
+    resampled = np.asarray(resampled)
+    if start_point is not None:
+        start_point = np.asarray(start_point, dtype=np.float64)
+        flip = (np.sqrt(((resampled[:, -1] - start_point) ** 2).sum(axis=1)) <
+                np.sqrt(((resampled[:, 0] - start_point) ** 2).sum(axis=1)))
+    else:
+        reference = resampled[0]
+        same = np.sqrt(((resampled - reference) ** 2).sum(axis=2)).mean(axis=1)
+        flipped = np.sqrt(((resampled[:, ::-1] - reference) ** 2).sum(axis=2)).mean(axis=1)
+        flip = flipped < same
+    resampled = resampled.copy()
+    resampled[flip] = resampled[flip, ::-1]
+    return resampled
+
+
+def tract_profile(track_file, affine, volumes, n_nodes=100, start_point=None,
+                  reference=None, chunk_size=100000):
+    '''
+    Returns the profiles of 3D volumes (e.g. FA and MD) along a bundle as a
+    (volumes, n_nodes) array. Every streamline is resampled to n_nodes
+    points and oriented (see orient_streamlines), the volumes are sampled
+    at all points at once by trilinear interpolation, and the values at
+    each node are averaged with Gaussian weights on the Mahalanobis
+    distance of each streamline from the bundle core at that node, so that
+    outlying streamlines count less. The profiles are NaN for an empty
+    bundle.
+    '''
+    from scipy.ndimage import map_coordinates
+    tractogram = load_tractogram(track_file, reference)
+    nonempty = tractogram.lengths > 0
+    if not nonempty.any():
+        return np.nan * np.ones((len(volumes), n_nodes))
+    resampled = []
+    for points, offsets in tractogram.iter_chunks(chunk_size):
+        keep = np.diff(offsets) > 0
+        if keep.any():
+            points, offsets = _select_streamlines(points, offsets, np.flatnonzero(keep))
+            resampled.append(resample_streamlines(points, offsets, n_nodes))
+    resampled = orient_streamlines(np.concatenate(resampled), start_point)
+
+    # Gaussian weights, normalised at every node
+    n_streamlines = len(resampled)
+    weights = np.ones((n_streamlines, n_nodes))
+    if n_streamlines > 3:
+        deviation = resampled - resampled.mean(axis=0)
+        covariance = np.einsum('snk,snl->nkl', deviation, deviation) / (n_streamlines - 1)
+        covariance += np.eye(3) * 1e-6
+        precision = np.linalg.inv(covariance)
+        mahalanobis = np.sqrt(np.einsum('snk,nkl,snl->sn', deviation, precision, deviation))
+        weights = np.exp(-0.5 * mahalanobis ** 2)
+    weights /= weights.sum(axis=0)
+
+    voxels = apply_affine(np.linalg.inv(affine), resampled.reshape(-1, 3)).T
+    profiles = np.empty((len(volumes), n_nodes))
+    for idx, volume in enumerate(volumes):
+        values = map_coordinates(np.asarray(volume, dtype=np.float64), voxels,
+                                 order=1, mode='nearest').reshape(n_streamlines, n_nodes)
+        profiles[idx] = (values * weights).sum(axis=0)
+    return profiles
+
+
+def label_centroids(roi_file, rois):
+    '''
+    Returns the RAS+ mm centroid of each ROI label as an (rois, 3) array
+    '''
+    roi_image = nb.load(roi_file)
+    labels = np.asarray(roi_image.get_data()).astype(int)
+    centroids = np.array([np.argwhere(labels == roi).mean(axis=0) for roi in rois])
+    return apply_affine(roi_image.get_affine(), centroids)
@@ -6,11 +6,12 @@ import nipype.interfaces.fsl as fsl
 import nipype.interfaces.freesurfer as fs
 import nipype.pipeline.engine as pe
 import coma.interfaces as ci
+from nipype.interfaces.utility import Function
 
 from ..interfaces import SingleSubjectICA, CreateDenoisedImage, MatchingClassification, ComputeFingerprint
-from ..helpers import get_component_index
+from ..helpers import get_component_index, subject_staging_dir
 
-def create_denoised_timecourse_workflow(name="denoised"):
+def create_denoised_timecourse_workflow(name="denoised", staging_dir=None):
     try: 
         coma_rest_lib_path = os.environ['COMA_REST_LIB_ROOT']
     except KeyError:
@@ -23,6 +24,14 @@ def create_denoised_timecourse_workflow(name="denoised"):
     # Create the GIFT ICA node
     ica = pe.Node(interface=SingleSubjectICA(), name='ica')
 
+    # The ICA and ComaRestLib nodes link their inputs into one staging directory per subject
+    if staging_dir is not None:
+        subject_staging_interface = Function(input_names=["staging_dir", "subject_id"],
+                                 output_names=["staging_dir"],
+                                 function=subject_staging_dir)
+        staging = pe.Node(interface=subject_staging_interface, name='staging')
+        staging.inputs.staging_dir = staging_dir
+
     # Create the resampling nodes. Functional images and ICA maps must have the same dimensions as the segmentation file
     resampleFunctional = pe.MapNode(interface=fs.MRIConvert(), name='resampleFunctional', iterfield=['in_file'])
     resampleFunctional.inputs.out_type = 'nii'
@@ -61,6 +70,11 @@ def create_denoised_timecourse_workflow(name="denoised"):
     workflow.connect([(inputnode, ica,[('functional_images', 'in_files')])])
     workflow.connect([(inputnode, ica,[('subject_id', 'prefix')])])
 
+    if staging_dir is not None:
+        workflow.connect([(inputnode, staging,[('subject_id', 'subject_id')])])
+        for node in [ica, denoised_image, matching_classification, compute_fingerprints]:
+            workflow.connect([(staging, node,[('staging_dir', 'staging_dir')])])
+
     # Create Nodes from segmentation file
     #workflow.connect([(inputnode, createnodes,[('segmentation_file', 'roi_file')])])
 
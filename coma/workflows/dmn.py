@@ -4,6 +4,7 @@ import nipype.pipeline.engine as pe          # pypeline engine
 import nipype.interfaces.fsl as fsl
 import nipype.interfaces.mrtrix as mrtrix
 from coma.interfaces.mrtrix3 import inclusion_filtering_mrtrix3
+from coma.interfaces.streamlines import filter_tracks
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -143,21 +144,19 @@ def split_roi(roi_file, roi_names=None, prefix=None, binarize=True):
     return roi_files
 
 
-def inclusion_filtering(track_file, roi_file, fa_file, md_file, roi_names=None, registration_image_file=None, registration_matrix_file=None, prefix=None, tdi_threshold=10):
+def inclusion_filtering(track_file, roi_file, fa_file, md_file, roi_names=None, registration_image_file=None, registration_matrix_file=None, prefix=None, tdi_threshold=10, engine="native", n_procs=None, n_nodes=100):
     import os
     import os.path as op
     import numpy as np
-    import glob
-    from coma.workflows.dmn import split_roi, get_rois, save_heatmap
+    from coma.workflows.dmn import get_rois, save_heatmap
     from coma.interfaces.dti import write_trackvis_scene
-    import nipype.pipeline.engine as pe
-    import nipype.interfaces.fsl as fsl
-    import nipype.interfaces.mrtrix as mrtrix
-    import nipype.interfaces.diffusion_toolkit as dtk
+    from coma.interfaces.streamlines import convert_tractogram, merge_tractograms, extract_pair_tracks
+    from coma.interfaces.streamlines import tract_profile, label_centroids
+    from coma.interfaces.mrtrix3 import run_pair_tract_statistics
     from nipype.utils.filemanip import split_filename
+    import nibabel as nb
 
     rois = get_rois(roi_file)
-    roi_files = split_roi(roi_file, roi_names, prefix)
     out_files = []
 
     fa_matrix = np.zeros((len(rois), len(rois)))
@@ -165,143 +164,75 @@ def inclusion_filtering(track_file, roi_file, fa_file, md_file, roi_names=None,
     tdi_matrix = np.zeros((len(rois), len(rois)))
     track_volume_matrix = np.zeros((len(rois), len(rois)))
 
-    track_files = []
-    for idx_i, roi_i in enumerate(rois):
-        if roi_names is None:
-            roi_i_file = [s for s in roi_files if "%d" % roi_i in s]
-            roi_i = str(int(roi_i))
-        else:
-            roi_i_file = [s for s in roi_files if "%s" % roi_names[idx_i] in s]
-            roi_i = roi_names[idx_i]
-
-        filter_tracks_roi_i = pe.Node(interface=mrtrix.FilterTracks(), name='filt_%s' % roi_i)
-        filter_tracks_roi_i.inputs.in_file = track_file
-        filter_tracks_roi_i.inputs.include_file = roi_i_file[0]
-        out_roi_i_filtered = op.abspath("%s_FiltTracks_%s.tck" % (prefix, roi_i))
-        filter_tracks_roi_i.inputs.out_filename = out_roi_i_filtered
-        filter_tracks_roi_i.run()
+    if roi_names is None:
+        roi_labels = [str(int(roi)) for roi in rois]
+    else:
+        roi_labels = roi_names
 
+    # Tracks passing through both ROIs of each pair, found in one pass over
+    # the track file rather than a FilterTracks run per ROI and per pair
+    idpairs = {}
+    pair_files = {}
+    for idx_i, roi_i in enumerate(rois):
         for idx_j, roi_j in enumerate(rois):
             if idx_j > idx_i:
+                idpair = "%s_%s" % (roi_labels[idx_i], roi_labels[idx_j])
                 if roi_names is None:
-                    roi_j = str(int(roi_j))
-                    idpair = "%s_%s" % (roi_i, roi_j)
                     idpair = idpair.replace(".","-")
-                    roi_j_file = [s for s in roi_files if "%s" % roi_j in s]
-                else:
-                    roi_j = roi_names[idx_j]
-                    roi_j_file = [s for s in roi_files if "%s" % roi_names[idx_j] in s]
-                    idpair = "%s_%s" % (roi_i, roi_j)
-
-                filter_tracks_roi_i_roi_j = pe.Node(interface=mrtrix.FilterTracks(), name='filt_%s' % idpair)
-                filter_tracks_roi_i_roi_j.inputs.in_file = out_roi_i_filtered
-                filter_tracks_roi_i_roi_j.inputs.include_file = roi_j_file[0]
-                filter_tracks_roi_i_roi_j.inputs.out_filename = "%s_FiltTracks_%s.tck" % (prefix, idpair)
-
-                tracks2tdi = pe.Node(interface=mrtrix.Tracks2Prob(), name='tdi_%s' % idpair)
-                tracks2tdi.inputs.template_file = fa_file
-                out_tdi_name = op.abspath("%s_TDI_%s.nii.gz" % (prefix, idpair))
-                tracks2tdi.inputs.out_filename = out_tdi_name
-                tracks2tdi.inputs.output_datatype = "Int16"
+                idpairs[(roi_i, roi_j)] = idpair
+                pair_files[(roi_i, roi_j)] = op.abspath("%s_FiltTracks_%s.tck" % (prefix, idpair))
+    extract_pair_tracks(track_file, roi_file, pair_files, endpoints_only=False)
 
-                binarize_tdi = pe.Node(interface=fsl.ImageMaths(), name='binarize_tdi_%s' % idpair)
-                binarize_tdi.inputs.op_string = "-thr %d -bin" % tdi_threshold
+    pairs = []
+    jobs = []
+    for idx_i, roi_i in enumerate(rois):
+        for idx_j, roi_j in enumerate(rois):
+            if idx_j > idx_i:
+                idpair = idpairs[(roi_i, roi_j)]
+                out_tdi_name = op.abspath("%s_TDI_%s.nii.gz" % (prefix, idpair))
                 out_tdi_vol_name = op.abspath("%s_TDI_bin_%d_%s.nii.gz" % (prefix, tdi_threshold, idpair))
-                binarize_tdi.inputs.out_file = out_tdi_vol_name
-
-                mask_fa = pe.Node(interface=fsl.MultiImageMaths(), name='mask_fa_%s' % idpair)
-                mask_fa.inputs.op_string = "-mul %s"
-                mask_fa.inputs.operand_files = [fa_file]
                 out_fa_name = op.abspath("%s_FA_%s.nii.gz" % (prefix, idpair))
-                mask_fa.inputs.out_file = out_fa_name
-
-                mask_md = mask_fa.clone(name='mask_md_%s' % idpair)
-                mask_md.inputs.operand_files = [md_file]
                 out_md_name = op.abspath("%s_MD_%s.nii.gz" % (prefix, idpair))
-                mask_md.inputs.out_file = out_md_name
-
-                mean_fa = pe.Node(interface=fsl.ImageStats(op_string = '-M'), name = 'mean_fa_%s' % idpair) 
-                mean_md = pe.Node(interface=fsl.ImageStats(op_string = '-M'), name = 'mean_md_%s' % idpair)
-                mean_tdi = pe.Node(interface=fsl.ImageStats(op_string = '-l %d -M' % tdi_threshold), name = 'mean_tdi_%s' % idpair)
-                track_volume = pe.Node(interface=fsl.ImageStats(op_string = '-l %d -V' % tdi_threshold), name = 'track_volume_%s' % idpair)
-
-                tck2trk = pe.Node(interface=mrtrix.MRTrix2TrackVis(), name='tck2trk')
-                tck2trk.inputs.image_file = fa_file
-                tck2trk.inputs.out_filename = idpair + ".trk"
-
-
-                if registration_image_file is not None and registration_matrix_file is not None:
-                    tck2trk.inputs.registration_image_file = registration_image_file
-                    tck2trk.inputs.matrix_file = registration_matrix_file
-
-                workflow = pe.Workflow(name=idpair)
-                workflow.base_dir = op.abspath(idpair)
-
-                workflow.connect(
-                    [(filter_tracks_roi_i_roi_j, tracks2tdi, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(filter_tracks_roi_i_roi_j, tck2trk, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(tracks2tdi, binarize_tdi, [("tract_image", "in_file")])])
-                workflow.connect(
-                    [(binarize_tdi, mask_fa, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(binarize_tdi, mask_md, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(mask_fa, mean_fa, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(mask_md, mean_md, [("out_file", "in_file")])])
-                workflow.connect(
-                    [(tracks2tdi, mean_tdi, [("tract_image", "in_file")])])
-                workflow.connect(
-                    [(tracks2tdi, track_volume, [("tract_image", "in_file")])])
-
-                workflow.config['execution'] = {'remove_unnecessary_outputs': 'false',
-                                                   'hash_method': 'timestamp'}
-
-                result = workflow.run()
-                fa_masked = glob.glob(out_fa_name)[0]
-                md_masked = glob.glob(out_md_name)[0]
-                tracks    = glob.glob(op.abspath(op.join(idpair,idpair,'filt_%s' % idpair, "%s_FiltTracks_%s.tck" % (prefix, idpair))))[0]
-                tdi = glob.glob(out_tdi_vol_name)[0]
-
-                nodes = result.nodes()
-                node_names = [s.name for s in nodes]
-                
-                mean_fa_node = [nodes[idx] for idx, s in enumerate(node_names) if "mean_fa" in s][0]
-                mean_fa = mean_fa_node.result.outputs.out_stat
-                
-                mean_md_node = [nodes[idx] for idx, s in enumerate(node_names) if "mean_md" in s][0]
-                mean_md = mean_md_node.result.outputs.out_stat
-                
-                mean_tdi_node = [nodes[idx] for idx, s in enumerate(node_names) if "mean_tdi" in s][0]
-                mean_tdi = mean_tdi_node.result.outputs.out_stat
-                
-                track_volume_node = [nodes[idx] for idx, s in enumerate(node_names) if "track_volume" in s][0]
-                track_volume = track_volume_node.result.outputs.out_stat[1] # First value is in voxels, 2nd is in volume
-
-                trk_node = [nodes[idx] for idx, s in enumerate(node_names) if "tck2trk" in s][0]
-                trk_file = trk_node.result.outputs.out_file
-
-                if track_volume == 0:
-                    os.remove(fa_masked)
-                    os.remove(md_masked)
-                    os.remove(tdi)
-                    os.remove(tracks)
-                else:
-                    out_files.append(md_masked)
-                    out_files.append(fa_masked)
-                    out_files.append(tracks)
-                    out_files.append(tdi)
-                    out_files.append(trk_file)
-
-                track_files.append(trk_file)
-
-                assert(0 <= mean_fa < 1)
-                fa_matrix[idx_i, idx_j] = mean_fa
-                md_matrix[idx_i, idx_j] = mean_md
-                tdi_matrix[idx_i, idx_j] = mean_tdi
-                track_volume_matrix[idx_i, idx_j] = track_volume
+                pairs.append((idx_i, idx_j, idpair))
+                jobs.append((pair_files[(roi_i, roi_j)], out_tdi_name, out_tdi_vol_name, out_fa_name, out_md_name))
+
+    results = run_pair_tract_statistics(jobs, fa_file, md_file, tdi_threshold, engine, n_procs)
+
+    # Along-tract FA and MD profiles, running from ROI i to ROI j
+    fa_image = nb.load(fa_file)
+    fa_data = fa_image.get_data()
+    md_data = nb.load(md_file).get_data()
+    centroids = label_centroids(roi_file, rois)
+    fa_profiles = np.zeros((len(pairs), n_nodes))
+    md_profiles = np.zeros((len(pairs), n_nodes))
+
+    track_files = []
+    for idx_pair, ((idx_i, idx_j, idpair), job, result) in enumerate(zip(pairs, jobs, results)):
+        tracks, _, tdi, fa_masked, md_masked = job
+        mean_fa, mean_md, mean_tdi, track_volume = result
+        fa_profiles[idx_pair], md_profiles[idx_pair] = tract_profile(tracks,
+            fa_image.get_affine(), [fa_data, md_data], n_nodes, start_point=centroids[idx_i])
+        trk_file = convert_tractogram(tracks, op.abspath(idpair + ".trk"), fa_file,
+            registration_image_file, registration_matrix_file)
+
+        if track_volume == 0:
+            for empty_file in (fa_masked, md_masked, tdi, tracks):
+                if op.exists(empty_file):
+                    os.remove(empty_file)
+        else:
+            out_files.append(md_masked)
+            out_files.append(fa_masked)
+            out_files.append(tracks)
+            out_files.append(tdi)
+            out_files.append(trk_file)
+
+        track_files.append(trk_file)
+
+        assert(0 <= mean_fa < 1)
+        fa_matrix[idx_i, idx_j] = mean_fa
+        md_matrix[idx_i, idx_j] = mean_md
+        tdi_matrix[idx_i, idx_j] = mean_tdi
+        track_volume_matrix[idx_i, idx_j] = track_volume
 
 
     fa_matrix = fa_matrix + fa_matrix.T
@@ -313,7 +244,9 @@ def inclusion_filtering(track_file, roi_file, fa_file, md_file, roi_names=None,
     else:
         _, prefix, _ = split_filename(track_file)
         npz_data = op.abspath("%s_connectivity.npz" % prefix)
-    np.savez(npz_data, fa=fa_matrix, md=md_matrix, tdi=tdi_matrix, trkvol=track_volume_matrix)
+    np.savez(npz_data, fa=fa_matrix, md=md_matrix, tdi=tdi_matrix, trkvol=track_volume_matrix,
+        fa_profile=fa_profiles, md_profile=md_profiles,
+        profile_pairs=np.array([pair[0:2] for pair in pairs], dtype=int).reshape(-1, 2))
 
 
     print("Saving heatmaps...")
@@ -331,10 +264,7 @@ def inclusion_filtering(track_file, roi_file, fa_file, md_file, roi_names=None,
 
     out_merged_file = op.abspath('%s_MergedTracks.trk' % prefix)
     skip = 80.
-    track_merge = pe.Node(interface=dtk.TrackMerge(), name='track_merge')
-    track_merge.inputs.track_files = track_files
-    track_merge.inputs.output_file = out_merged_file
-    track_merge.run()
+    merge_tractograms(track_files, out_merged_file)
 
     track_names = []
     for t in track_files:
@@ -378,13 +308,12 @@ def create_paired_tract_analysis_wf(name="track_filtering"):
 
 
 
-    binarize_rois = pe.Node(interface=fsl.ImageMaths(), name='binarize_rois')
-    binarize_rois.inputs.op_string = "-bin"
-
-    filter_tracks = pe.Node(interface=mrtrix.FilterTracks(), name='filter_tracks')
+    filter_tracks_interface = util.Function(input_names=["track_file", "roi_file", "include", "exclude", "out_file"],
+        output_names=["out_file"], function=filter_tracks)
+    filter_tracks_node = pe.Node(interface=filter_tracks_interface, name='filter_tracks')
 
     incl_filt_interface = util.Function(input_names=["track_file", "roi_file", "fa_file", "md_file",
-        "roi_names", "registration_image_file", "registration_matrix_file", "prefix", "tdi_threshold"],
+        "roi_names", "registration_image_file", "registration_matrix_file", "prefix", "tdi_threshold", "engine", "n_procs", "n_nodes"],
         output_names=["out_files", "npz_data", "summary_images"], function=inclusion_filtering_mrtrix3)
     paired_inclusion_filtering = pe.Node(interface=incl_filt_interface, name='paired_inclusion_filtering')
 
@@ -400,13 +329,11 @@ def create_paired_tract_analysis_wf(name="track_filtering"):
     workflow.base_output_dir = name
 
     workflow.connect(
-        [(inputnode, filter_tracks, [("track_file", "in_file")])])
-    workflow.connect(
-        [(inputnode, binarize_rois, [("roi_file", "in_file")])])
+        [(inputnode, filter_tracks_node, [("track_file", "track_file")])])
     workflow.connect(
-        [(binarize_rois, filter_tracks, [("out_file", "include_file")])])
+        [(inputnode, filter_tracks_node, [("roi_file", "roi_file")])])
     workflow.connect(
-        [(filter_tracks, paired_inclusion_filtering, [("out_file", "track_file")])])
+        [(filter_tracks_node, paired_inclusion_filtering, [("out_file", "track_file")])])
     workflow.connect(
         [(inputnode, paired_inclusion_filtering, [("roi_names", "roi_names")])])
     workflow.connect(
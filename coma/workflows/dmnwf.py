@@ -2,6 +2,7 @@ import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 import nipype.interfaces.fsl as fsl
 import nipype.interfaces.freesurfer as fs
+import os.path as op
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -240,7 +241,8 @@ def create_reg_and_label_wf(name="reg_wf", manual_seg_rois=False):
     return workflow
 
 
-def create_dmn_pipeline_step1(name="dmn_step1", scale_by_glycemia=True, manual_seg_rois=False):
+def create_dmn_pipeline_step1(name="dmn_step1", scale_by_glycemia=True, manual_seg_rois=False,
+                              cohort_store=None):
     inputfields = ["subjects_dir",
                      "subject_id",
                      "dwi",
@@ -313,10 +315,12 @@ def create_dmn_pipeline_step1(name="dmn_step1", scale_by_glycemia=True, manual_s
     compute_SUV_norm_glycemia = pe.Node(interface=compute_SUV_interface, name='compute_SUV_norm_glycemia')
 
     scale_PVC_matrix_interface = util.Function(input_names=["subject_id", "in_file", "dose", "weight", "delay",
-        "scan_time", "isotope", 'height', "glycemie", "scale_SUV_by_glycemia"],
+        "scan_time", "isotope", 'height', "glycemie", "scale_SUV_by_glycemia", "cohort_store"],
         output_names=["out_npz", "out_matlab_mat"], function=scale_PVC_matrix_fn)
     scale_PVC_matrix = pe.Node(interface=scale_PVC_matrix_interface, name='scale_PVC_matrix')
     scale_PVC_matrix.inputs.scale_SUV_by_glycemia = scale_by_glycemia
+    if cohort_store is not None:
+        scale_PVC_matrix.inputs.cohort_store = op.abspath(cohort_store)
 
     single_fiber_mask_cortex_only = pe.Node(
         interface=fsl.MultiImageMaths(), name='single_fiber_mask_cortex_only')
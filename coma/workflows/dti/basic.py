@@ -54,13 +54,15 @@ def damaged_brain_dti_processing(name="dwi_preproc", use_FAST_masks=True):
     Define the nodes
     '''
     nonlinfit_interface = util.Function(
-        input_names=["dwi", "bvecs", "bvals", "base_name"],
+        input_names=["dwi", "bvecs", "bvals", "base_name", "n_procs", "chunk_size",
+                     "outputs", "compresslevel", "n_threads"],
         output_names=["tensor", "FA", "MD", "evecs", "evals",
                       "rgb_fa", "norm", "mode", "binary_mask", "b0_masked"],
         function=nonlinfit_fn)
 
     nonlinfit_node = pe.Node(
         interface=nonlinfit_interface, name="nonlinfit_node")
+    nonlinfit_node.inputs.outputs = ["FA", "MD", "rgb_fa", "mode"]
 
     erode_mask_firstpass = pe.Node(interface=mrtrix.Erode(),
                                    name='erode_mask_firstpass')
@@ -6,9 +6,14 @@ import nipype.interfaces.fsl as fsl
 import nipype.interfaces.freesurfer as fs
 import nipype.algorithms.misc as misc
 import nipype.pipeline.engine as pe
-from ..interfaces import SingleSubjectICA, MatchingClassification, ComputeFingerprint, CreateDenoisedImage
+from ..interfaces import (SingleSubjectICA, MatchingClassification, ComputeFingerprint, CreateDenoisedImage,
+                          NuisanceRegression, TemporalFilter, CreateConnectivityThreshold, ConnectivityGraph,
+                          RegionalValues, SimpleTimeCourseCorrelationGraph)
 from nipype.interfaces.utility import Function
 from nipype.workflows.dmri.connectivity.group_connectivity import (pullnodeIDs, concatcsv)
+from ..helpers import (subject_staging_dir, get_component_index, get_component_index_resampled,
+                       pull_template_name, remove_unconnected_graphs, remove_unconnected_graphs_and_threshold,
+                       remove_unconnected_graphs_avg_and_cff, nxstats_and_merge_csvs)
 
 def group_fmri_graphs(subject_id, in_file, component_index, matching_stats):
     def flatten_arrays(array_of_arrays):
@@ -50,7 +55,8 @@ def removeNoneValues(in_files):
     return out_files
 
 
-def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=False):
+def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=False, staging_dir=None,
+                       with_nuisance_regression=False, with_temporal_filter=False):
     try:
         coma_rest_lib_path = os.environ['COMA_REST_LIB_ROOT']
     except KeyError:
@@ -59,6 +65,14 @@ def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=Fal
     inputnode_within = pe.Node(interface=util.IdentityInterface(fields=["subject_id", "functional_images", "segmentation_file", "repetition_time", "resolution_network_file"]), name="inputnode_within")
 
     ica = pe.Node(interface=SingleSubjectICA(), name='ica')
+    # The ICA and ComaRestLib nodes link their inputs into one staging directory per subject
+    if staging_dir is not None:
+        subject_staging_interface = Function(input_names=["staging_dir", "subject_id"],
+                                 output_names=["staging_dir"],
+                                 function=subject_staging_dir)
+        staging = pe.Node(interface=subject_staging_interface, name='staging')
+        staging.inputs.staging_dir = staging_dir
+
     # Create the resampling nodes. Functional images and ICA maps must have the same dimensions as the segmentation file
     resampleFunctional = pe.MapNode(interface=fs.MRIConvert(), name='resampleFunctional', iterfield=['in_file'])
     resampleFunctional.inputs.out_type = 'nii'
@@ -78,11 +92,18 @@ def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=Fal
     compute_fingerprints = pe.MapNode(interface=ComputeFingerprint(), name='compute_fingerprints', iterfield=['in_file', 'component_index'])
     compute_fingerprints.inputs.coma_rest_lib_path = coma_rest_lib_path
 
+    # Band-pass filters the functional images before the thresholding and correlation
+    if with_temporal_filter:
+        filter_functional = pe.Node(interface=TemporalFilter(), name='filter_functional')
+        filter_functional.inputs.lowpass = 0.1
+        if with_simple_timecourse_correlation:
+            filter_neuronal = filter_functional.clone('filter_neuronal')
+
     # Create the functional connectivity thresholding and mapping nodes
     createnodes = pe.Node(interface=cmtk.CreateNodes(), name="CreateNodes")
-    connectivity_threshold = pe.Node(interface=cmtk.CreateConnectivityThreshold(), name='connectivity_threshold')
-    connectivity_graph = pe.MapNode(interface=cmtk.ConnectivityGraph(), name='connectivity_graph', iterfield=['in_file', 'component_index'])
-    neuronal_regional_timecourses = pe.Node(interface=cmtk.RegionalValues(), name="neuronal_regional_timecourses")
+    connectivity_threshold = pe.Node(interface=CreateConnectivityThreshold(), name='connectivity_threshold')
+    connectivity_graph = pe.MapNode(interface=ConnectivityGraph(), name='connectivity_graph', iterfield=['in_file', 'component_index'])
+    neuronal_regional_timecourses = pe.Node(interface=RegionalValues(), name="neuronal_regional_timecourses")
 
     # Define the CFF Converter, NetworkX MATLAB -> CommaSeparatedValue nodes
     graphCFFConverter = pe.Node(interface=cmtk.CFFConverter(), name="graphCFFConverter")
@@ -146,12 +167,14 @@ def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=Fal
     TCcorrCFFConverter = pe.Node(interface=cmtk.CFFConverter(), name="TCcorrCFFConverter")
     if with_simple_timecourse_correlation:
         split_non_neuronal = split_neuronal.clone(name='split_non_neuronal')
-        neuronal_time_course_correlation = pe.Node(interface=cmtk.SimpleTimeCourseCorrelationGraph(), name='neuronal_time_course_correlation')
+        neuronal_time_course_correlation = pe.Node(interface=SimpleTimeCourseCorrelationGraph(), name='neuronal_time_course_correlation')
         neuronal_time_course_correlation.inputs.out_network_file = 'neuronal.pck'
-        non_neuronal_time_course_correlation = pe.Node(interface=cmtk.SimpleTimeCourseCorrelationGraph(), name='non_neuronal_time_course_correlation')
+        non_neuronal_time_course_correlation = pe.Node(interface=SimpleTimeCourseCorrelationGraph(), name='non_neuronal_time_course_correlation')
         non_neuronal_time_course_correlation.inputs.out_network_file = 'non_neuronal.pck'
         TCcorrCFFConverter.inputs.out_file = 'time_course_correlation.cff'
         mergeSTCC = pe.Node(interface=util.Merge(2), name='mergeSTCC')
+        if with_nuisance_regression:
+            nuisance_regression = pe.Node(interface=NuisanceRegression(), name='nuisance_regression')
     else:
         TCcorrCFFConverter.inputs.out_file = 'time_courses.cff'
 
@@ -162,15 +185,18 @@ def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=Fal
     func_ntwk.connect([(inputnode_within, ica,[('functional_images', 'in_files')])])
     func_ntwk.connect([(inputnode_within, ica,[('subject_id', 'prefix')])])
 
+    if staging_dir is not None:
+        func_ntwk.connect([(inputnode_within, staging,[('subject_id', 'subject_id')])])
+        for node in [ica, denoised_image, matching_classification, compute_fingerprints]:
+            func_ntwk.connect([(staging, node,[('staging_dir', 'staging_dir')])])
+
     # Create the denoised image
-    func_ntwk.connect([(inputnode_within, denoised_image,[('subject_id', 'prefix')])])
     func_ntwk.connect([(inputnode_within, denoised_image,[('repetition_time', 'repetition_time')])])
     func_ntwk.connect([(ica, denoised_image,[('independent_component_images', 'in_files')])])
     func_ntwk.connect([(ica, denoised_image,[('mask_image', 'ica_mask_image')])])
     func_ntwk.connect([(ica, denoised_image,[('independent_component_timecourse', 'time_course_image')])])
 
     # Runs the matching classification
-    func_ntwk.connect([(inputnode_within, matching_classification,[('subject_id', 'prefix')])])
     func_ntwk.connect([(inputnode_within, matching_classification,[('repetition_time', 'repetition_time')])])
     func_ntwk.connect([(ica, matching_classification,[('independent_component_images', 'in_files')])])
     func_ntwk.connect([(ica, matching_classification,[('mask_image', 'ica_mask_image')])])
@@ -187,7 +213,12 @@ def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=Fal
     # Calculates the the t-value threshold for each node/IC
     func_ntwk.connect([(inputnode_within, resampleFunctional,[('functional_images', 'in_file')])])
     func_ntwk.connect([(inputnode_within, resampleFunctional,[('segmentation_file', 'reslice_like')])])
-    func_ntwk.connect([(resampleFunctional, connectivity_threshold,[('out_file', 'in_files')])])
+    if with_temporal_filter:
+        func_ntwk.connect([(resampleFunctional, filter_functional,[('out_file', 'in_files')])])
+        func_ntwk.connect([(inputnode_within, filter_functional,[('repetition_time', 'repetition_time')])])
+        func_ntwk.connect([(filter_functional, connectivity_threshold,[('out_file', 'in_file4d')])])
+    else:
+        func_ntwk.connect([(resampleFunctional, connectivity_threshold,[('out_file', 'in_files')])])
     func_ntwk.connect([(ica, connectivity_threshold,[('independent_component_timecourse', 'time_course_file')])])
     func_ntwk.connect([(inputnode_within, connectivity_threshold,[('segmentation_file', 'segmentation_file')])])
 
@@ -209,7 +240,22 @@ def create_fmri_graphs(name="functional", with_simple_timecourse_correlation=Fal
     if with_simple_timecourse_correlation:
         func_ntwk.connect([(inputnode_within, neuronal_time_course_correlation,[('segmentation_file', 'segmentation_file')])])
         func_ntwk.connect([(createnodes, neuronal_time_course_correlation,[('node_network', 'structural_network')])])
-        func_ntwk.connect([(resample_neuronal, neuronal_time_course_correlation,[('out_file', 'in_files')])])
+        if with_nuisance_regression and with_temporal_filter:
+            func_ntwk.connect([(resample_neuronal, nuisance_regression,[('out_file', 'in_files')])])
+            func_ntwk.connect([(inputnode_within, nuisance_regression,[('segmentation_file', 'segmentation_file')])])
+            func_ntwk.connect([(nuisance_regression, filter_neuronal,[('out_file', 'in_file4d')])])
+            func_ntwk.connect([(inputnode_within, filter_neuronal,[('repetition_time', 'repetition_time')])])
+            func_ntwk.connect([(filter_neuronal, neuronal_time_course_correlation,[('out_file', 'in_file4d')])])
+        elif with_nuisance_regression:
+            func_ntwk.connect([(resample_neuronal, nuisance_regression,[('out_file', 'in_files')])])
+            func_ntwk.connect([(inputnode_within, nuisance_regression,[('segmentation_file', 'segmentation_file')])])
+            func_ntwk.connect([(nuisance_regression, neuronal_time_course_correlation,[('out_file', 'in_file4d')])])
+        elif with_temporal_filter:
+            func_ntwk.connect([(resample_neuronal, filter_neuronal,[('out_file', 'in_files')])])
+            func_ntwk.connect([(inputnode_within, filter_neuronal,[('repetition_time', 'repetition_time')])])
+            func_ntwk.connect([(filter_neuronal, neuronal_time_course_correlation,[('out_file', 'in_file4d')])])
+        else:
+            func_ntwk.connect([(resample_neuronal, neuronal_time_course_correlation,[('out_file', 'in_files')])])
         func_ntwk.connect([(neuronal_time_course_correlation, mergeSTCC,[('network_file', 'in1')])])
 
         func_ntwk.connect([(denoised_image, split_non_neuronal,[('non_neuronal_image', 'in_file')])])
@@ -5,10 +5,12 @@ from ..helpers import select_CSF, select_WM, select_GM
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
-from coma.interfaces.pve import PartialVolumeCorrection
+from coma.interfaces.pve import (PartialVolumeCorrection, NativePartialVolumeCorrection,
+    VoxelwisePartialVolumeCorrection)
 from coma.helpers import add_subj_name_to_PET_T1
 
-def create_pet_quantification_wf(name="petquant", segment_t1=True):
+def create_pet_quantification_wf(name="petquant", segment_t1=True, native_pvc=False,
+                                voxelwise_pvc=None):
 
     '''
     Define inputs and outputs of the workflow
@@ -68,11 +70,23 @@ def create_pet_quantification_wf(name="petquant", segment_t1=True):
     applyxfm_rois = applyxfm_t1.clone("applyxfm_rois")
     applyxfm_rois.inputs.interp = 'nearestneighbour'
 
-    pve_correction = pe.Node(
-        interface=PartialVolumeCorrection(), name='pve_correction')
-    pve_correction.inputs.skip_atlas = False
+    if native_pvc:
+        pve_correction = pe.Node(
+            interface=NativePartialVolumeCorrection(), name='pve_correction')
+    else:
+        pve_correction = pe.Node(
+            interface=PartialVolumeCorrection(), name='pve_correction')
+        pve_correction.inputs.skip_atlas = False
     pve_correction.inputs.use_fs_LUT = False
 
+    # Optional voxelwise correction ('rbv', 'richardson_lucy' or 'van_cittert'),
+    # used instead of the Mueller-Gartner image for the corrected PET in T1 space
+    if voxelwise_pvc is not None:
+        voxelwise_correction = pe.Node(
+            interface=VoxelwisePartialVolumeCorrection(), name='voxelwise_correction')
+        voxelwise_correction.inputs.method = voxelwise_pvc
+        voxelwise_correction.inputs.use_fs_LUT = False
+
     applyxfm_CorrectedPET = pe.Node(interface=fsl.ApplyXfm(), name = 'applyxfm_CorrectedPET')
     applyxfm_CorrectedPET.inputs.apply_xfm = True
     applyxfm_CorrectedPET.inputs.interp = 'trilinear'
@@ -164,8 +178,22 @@ def create_pet_quantification_wf(name="petquant", segment_t1=True):
         [(applyxfm_csf, pve_correction, [('out_file', 'csf_file')])])
     workflow.connect(
         [(applyxfm_rois, pve_correction, [('out_file', 'roi_file')])])
-    workflow.connect(
-        [(pve_correction, applyxfm_CorrectedPET, [('mueller_gartner_rousset', 'in_file')])])
+    if voxelwise_pvc is not None:
+        workflow.connect(
+            [(inputnode, voxelwise_correction, [('pet', 'pet_file')])])
+        workflow.connect(
+            [(applyxfm_gmmask, voxelwise_correction, [('out_file', 'grey_matter_binary_mask')])])
+        workflow.connect(
+            [(applyxfm_wm, voxelwise_correction, [('out_file', 'white_matter_file')])])
+        workflow.connect(
+            [(applyxfm_csf, voxelwise_correction, [('out_file', 'csf_file')])])
+        workflow.connect(
+            [(applyxfm_rois, voxelwise_correction, [('out_file', 'roi_file')])])
+        workflow.connect(
+            [(voxelwise_correction, applyxfm_CorrectedPET, [('corrected_pet', 'in_file')])])
+    else:
+        workflow.connect(
+            [(pve_correction, applyxfm_CorrectedPET, [('mueller_gartner_rousset', 'in_file')])])
 
     workflow.connect(
         [(inputnode, applyxfm_CorrectedPET, [('t1', 'reference')])])
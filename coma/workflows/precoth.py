@@ -139,10 +139,12 @@ def create_precoth_pipeline(name="precoth", tractography_type='probabilistic', r
                                                  "scan_time"]),
         name="inputnode")
 
-    nonlinfit_interface = util.Function(input_names=["dwi", "bvecs", "bvals", "base_name"],
+    nonlinfit_interface = util.Function(input_names=["dwi", "bvecs", "bvals", "base_name", "n_procs", "chunk_size",
+        "outputs", "compresslevel", "n_threads"],
     output_names=["tensor", "FA", "MD", "evecs", "evals", "rgb_fa", "norm", "mode", "binary_mask", "b0_masked"], function=nonlinfit_fn)
 
     nonlinfit_node = pe.Node(interface=nonlinfit_interface, name="nonlinfit_node")
+    nonlinfit_node.inputs.outputs = ["FA", "MD", "rgb_fa"]
 
     coregister = pe.Node(interface=fsl.FLIRT(dof=12), name = 'coregister')
     coregister.inputs.cost = ('normmi')
@@ -446,10 +448,12 @@ def create_precoth_pipeline_step1(name="precoth_step1", reg_pet_T1=True, auto_re
                                                  "fdgpet"]),
         name="inputnode")
 
-    nonlinfit_interface = util.Function(input_names=["dwi", "bvecs", "bvals", "base_name"],
+    nonlinfit_interface = util.Function(input_names=["dwi", "bvecs", "bvals", "base_name", "n_procs", "chunk_size",
+        "outputs", "compresslevel", "n_threads"],
     output_names=["tensor", "FA", "MD", "evecs", "evals", "rgb_fa", "norm", "mode", "binary_mask", "b0_masked"], function=nonlinfit_fn)
 
     nonlinfit_node = pe.Node(interface=nonlinfit_interface, name="nonlinfit_node")
+    nonlinfit_node.inputs.outputs = ["FA", "MD", "rgb_fa", "mode"]
     erode_mask_firstpass = pe.Node(interface=mrtrix.Erode(),
                                    name='erode_mask_firstpass')
     erode_mask_firstpass.inputs.out_filename = "b0_mask_median3D_erode.nii.gz"
@@ -3,11 +3,14 @@ import nipype.interfaces.utility as util     # utility
 import nipype.interfaces.cmtk as cmtk
 import nipype.interfaces.freesurfer as fs
 import nipype.algorithms.misc as misc
+import coma.interfaces as ci
 
 
-def create_rsfmri_correlation_network(name="functional", have_nodes_already=False):
+def create_rsfmri_correlation_network(name="functional", have_nodes_already=False, with_nuisance_regression=False,
+                                      with_temporal_filter=False):
     inputnode_within = pe.Node(interface=util.IdentityInterface(
-        fields=["subject_id", "functional_images", "segmentation_file", "resolution_network_file"]), name="inputnode_within")
+        fields=["subject_id", "functional_images", "segmentation_file", "resolution_network_file",
+                "repetition_time"]), name="inputnode_within")
 
     # Create the resampling nodes. Functional images must have the same
     # dimensions as the segmentation file
@@ -19,6 +22,17 @@ def create_rsfmri_correlation_network(name="functional", have_nodes_already=Fals
     if not have_nodes_already:
         createnodes = pe.Node(interface=cmtk.CreateNodes(), name="CreateNodes")
 
+    # Regresses the WM, CSF and polynomial trends from the resampled images
+    if with_nuisance_regression:
+        nuisance_regression = pe.Node(
+            interface=ci.NuisanceRegression(), name='nuisance_regression')
+
+    # Band-pass filters the timecourses (0.01-0.1 Hz by default)
+    if with_temporal_filter:
+        temporal_filter = pe.Node(
+            interface=ci.TemporalFilter(), name='temporal_filter')
+        temporal_filter.inputs.lowpass = 0.1
+
     # Define the correlation mapping node, the CFF Converter, and NetworkX
     # MATLAB -> CommaSeparatedValue node
     time_course_correlation = pe.Node(
@@ -39,8 +53,28 @@ def create_rsfmri_correlation_network(name="functional", have_nodes_already=Fals
         [(inputnode_within, resampleFunctional, [('functional_images', 'in_file')])])
     cor_ntwk.connect(
         [(inputnode_within, resampleFunctional, [('segmentation_file', 'reslice_like')])])
-    cor_ntwk.connect(
-        [(resampleFunctional, time_course_correlation, [('out_file', 'in_files')])])
+    if with_nuisance_regression:
+        cor_ntwk.connect(
+            [(resampleFunctional, nuisance_regression, [('out_file', 'in_files')])])
+        cor_ntwk.connect(
+            [(inputnode_within, nuisance_regression, [('segmentation_file', 'segmentation_file')])])
+    if with_temporal_filter:
+        cor_ntwk.connect(
+            [(inputnode_within, temporal_filter, [('repetition_time', 'repetition_time')])])
+        if with_nuisance_regression:
+            cor_ntwk.connect(
+                [(nuisance_regression, temporal_filter, [('out_file', 'in_file4d')])])
+        else:
+            cor_ntwk.connect(
+                [(resampleFunctional, temporal_filter, [('out_file', 'in_files')])])
+        cor_ntwk.connect(
+            [(temporal_filter, time_course_correlation, [('out_file', 'in_file4d')])])
+    elif with_nuisance_regression:
+        cor_ntwk.connect(
+            [(nuisance_regression, time_course_correlation, [('out_file', 'in_file4d')])])
+    else:
+        cor_ntwk.connect(
+            [(resampleFunctional, time_course_correlation, [('out_file', 'in_files')])])
 
     # Creates the nodes for the graph from the input segmentation file and
     # resolution network file
@@ -68,7 +102,8 @@ def create_rsfmri_correlation_network(name="functional", have_nodes_already=Fals
 
     # Create a higher-level workflow
     inputnode = pe.Node(interface=util.IdentityInterface(
-        fields=["subject_id", "functional_images", "segmentation_file", "resolution_network_file"]), name="inputnode")
+        fields=["subject_id", "functional_images", "segmentation_file", "resolution_network_file",
+                "repetition_time"]), name="inputnode")
 
     outputnode = pe.Node(interface=util.IdentityInterface(
         fields=["correlation_ntwk", "correlation_cff"]), name="outputnode")
@@ -82,7 +117,8 @@ def create_rsfmri_correlation_network(name="functional", have_nodes_already=Fals
                                  "inputnode_within.functional_images"),
                                 ("segmentation_file",
                                  "inputnode_within.segmentation_file"),
-                                ("resolution_network_file", "inputnode_within.resolution_network_file")])
+                                ("resolution_network_file", "inputnode_within.resolution_network_file"),
+                                ("repetition_time", "inputnode_within.repetition_time")])
          ])
 
     correlation.connect(
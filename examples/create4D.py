@@ -10,13 +10,10 @@ def create4Ddwi(name,out):
 	assert(len(a) >= 30)
 	print("%i volumes found" % len(a))
 	a.sort(key=lambda x: x[-8:])
-	import nibabel as nb
-	print("Concatenating %i files" % len(a))
-	b = nb.concat_images(a)
-	b.get_header()
+	from coma.helpers import write_4d_nifti
 	out_file = out+".nii.gz"
-	print("Writing to %s" % out_file)
-	nb.save(b, out_file)
+	print("Concatenating %i files to %s" % (len(a), out_file))
+	write_4d_nifti(out_file, a)
 	return out_file
 
 if __name__ == '__main__':
@@ -92,29 +92,27 @@ def nonlinfit_fn(dwi, bvecs, bvals, base_name):
 def remove_bad_volumes(dwi, bvec_file, bval_file, base_name, thresh):
     import numpy as np
     import nibabel as nb
+    import os
     import os.path as op
     from nipype.utils.filemanip import split_filename
 
-    dwi_4D = nb.load(dwi)
-    dwi_files = nb.four_to_three(dwi_4D)
+    from coma.helpers import open_memmap, write_4d_nifti
+    _, name, ext = split_filename(dwi)
+    uncompressed = None
+    if ext.endswith('.gz') and not op.exists(op.abspath(name + ext[:-3])):
+        uncompressed = op.abspath(name + ext[:-3])
+    dwi_4D, dwi_data = open_memmap(dwi)
 
     bvecs = np.transpose(np.loadtxt(bvec_file))
     bvals = np.transpose(np.loadtxt(bval_file))
 
     bad_indices = np.where(np.abs(bvecs[:,0]) >= thresh)[0]
     n_removed = len(bad_indices)
+    keep = [j for j in range(len(bvals)) if j not in bad_indices]
 
-    dwi_files = [i for j, i in enumerate(dwi_files) if j not in bad_indices]
-    bvecs = [i for j, i in enumerate(bvecs) if j not in bad_indices]
-    bvals = [i for j, i in enumerate(bvals) if j not in bad_indices]
+    corr_bvecs = np.transpose(bvecs[keep])
+    corr_bvals = np.transpose(bvals[keep])
 
-    corr_dwi = nb.concat_images(dwi_files)
-    corr_bvecs = np.transpose(bvecs)
-    corr_bvals = np.transpose(bvals)
-
-    assert(len(dwi_files) == len(bvecs) == len(bvals))
-
-    _, name, _ = split_filename(dwi)
     out_dwi = op.abspath(base_name + "%f_vib.nii.gz" % thresh)
 
     _, bvec_name, _ = split_filename(bvec_file)
@@ -123,7 +121,11 @@ def remove_bad_volumes(dwi, bvec_file, bval_file, base_name, thresh):
     _, bval_name, _ = split_filename(bval_file)
     out_bvals = op.abspath(base_name + "%f_vib.bval"  % thresh)
 
-    nb.save(corr_dwi, out_dwi)
+    slope, inter = dwi_4D.dataobj.slope, dwi_4D.dataobj.inter
+    write_4d_nifti(out_dwi, (dwi_data[..., j] * slope + inter for j in keep), dwi_4D.get_affine(),
+                   dwi_4D.get_header(), np.float32, n_volumes=len(keep))
+    if uncompressed is not None:
+        os.remove(uncompressed)
     np.savetxt(out_bvecs, corr_bvecs)
     np.savetxt(out_bvals, corr_bvals)
     print("%d volumes were removed at threshold %f" % (n_removed, thresh))